@@ -0,0 +1,239 @@
+#!/bin/env python
+
+# A bank of 1D histograms [sample][selection][variable] stored as numpy arrays
+#
+# All the bins (including the under/overflows) of all the histograms
+# are in one contiguous array of sumw and one of sumw2, with shape
+# (samples, selections, bins of all the variables). The fills are
+# weighted bincounts of whole arrays of values. The TH1F objects are
+# only built when they are needed, e.g. to be written or plotted
+# (see histogram and toHistos). HistogramBankFileStore reads the
+# histograms of many files into banks, one per file, and keeps them
+# in memory within a given budget.
+#
+# davide.gerbaudo@gmail.com
+# April 2014
+
+import array
+import collections
+import unittest
+import numpy as np
+
+from rootUtils import importRoot, setBinContentsArray, binContentsArray, binSumw2Array
+r = importRoot()
+
+class HistogramBank(object) :
+    """Histograms with uniform binning. binning(variable, selection)
+    returns (title, nBins, xMin, xMax); the binning of a variable
+    cannot depend on the selection, the title can. The histogram names
+    are nameTemplate%{'variable':..., 'sample':..., 'selection':...}"""
+    nStats = 5 # entries, sumw, sumw2, sumwx, sumwx2
+    def __init__(self, samples=[], selections=[], variables=[], binning=None,
+                 nameTemplate='h_%(variable)s_%(sample)s_%(selection)s') :
+        self.samples, self.selections, self.variables = list(samples), list(selections), list(variables)
+        self.nameTemplate = nameTemplate
+        self.titles = dict(((sel, v), binning(v, sel)[0]) for sel in self.selections for v in self.variables)
+        self.axes, self.offsets = dict(), dict()
+        offset = 0
+        for v in self.variables :
+            axes = set(tuple(binning(v, sel)[1:]) for sel in self.selections)
+            assert len(axes)<=1,"the binning of %s depends on the selection: %s"%(v, str(axes))
+            nBins, xMin, xMax = axes.pop() if axes else binning(v, '')[1:]
+            self.axes[v] = (int(nBins), float(xMin), float(xMax))
+            self.offsets[v] = offset
+            offset += int(nBins) + 2
+        shape = (len(self.samples), len(self.selections), offset)
+        self.sumw, self.sumw2 = np.zeros(shape), np.zeros(shape)
+        self.stats = np.zeros((len(self.samples), len(self.selections), len(self.variables), HistogramBank.nStats))
+    def __getitem__(self, sample) : return HistogramBankRow(self, self.samples.index(sample))
+    def keys(self) : return list(self.samples)
+    def binIndices(self, variable, values) :
+        "as rootUtils.binIndicesTH1: 0 for underflow, nBins+1 for overflow"
+        nBins, xMin, xMax = self.axes[variable]
+        values = np.asarray(values, dtype=np.float64)
+        bins = np.empty(len(values), dtype=np.int64)
+        under, over = values < xMin, values >= xMax
+        inRange = ~(under | over)
+        bins[under], bins[over] = 0, nBins+1
+        bins[inRange] = 1 + (nBins*(values[inRange]-xMin)/(xMax-xMin)).astype(np.int64)
+        return bins
+    def binSlice(self, variable) :
+        offset = self.offsets[variable]
+        return slice(offset, offset + self.axes[variable][0] + 2)
+    def fill(self, sample, selection, variable, values, weights=None) :
+        "same as TH1::Fill(value, weight) for each value"
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        fillRowsWithWeightMatrix([self[sample]], selection, variable, values, weights.reshape(-1, 1))
+    def add(self, other) :
+        """Add the bins and stats of another bank with the same
+        selections and variables; its samples that are not here are appended"""
+        assert (self.selections, self.variables, self.axes)==(other.selections, other.variables, other.axes),"incompatible banks"
+        newSamples = [s for s in other.samples if s not in self.samples]
+        if newSamples :
+            nNew = len(newSamples)
+            self.samples += newSamples
+            self.sumw  = np.concatenate([self.sumw,  np.zeros((nNew,)+self.sumw.shape[1:])])
+            self.sumw2 = np.concatenate([self.sumw2, np.zeros((nNew,)+self.sumw2.shape[1:])])
+            self.stats = np.concatenate([self.stats, np.zeros((nNew,)+self.stats.shape[1:])])
+        rows = [self.samples.index(s) for s in other.samples]
+        self.sumw[rows] += other.sumw
+        self.sumw2[rows] += other.sumw2
+        self.stats[rows] += other.stats
+        return self
+    def histogram(self, sample, selection, variable) :
+        "a new TH1F with the bins and stats of one histogram of the bank"
+        iSam, iSel, iVar = self.samples.index(sample), self.selections.index(selection), self.variables.index(variable)
+        nBins, xMin, xMax = self.axes[variable]
+        name = self.nameTemplate%{'variable':variable, 'sample':sample, 'selection':selection}
+        h = r.TH1F(name, self.titles[(selection, variable)], nBins, xMin, xMax)
+        h.SetDirectory(0)
+        h.Sumw2()
+        bins = self.binSlice(variable)
+        setBinContentsArray(h, self.sumw[iSam, iSel, bins], self.sumw2[iSam, iSel, bins])
+        entries, sumw, sumw2, sumwx, sumwx2 = self.stats[iSam, iSel, iVar]
+        h.PutStats(array.array('d', [sumw, sumw2, sumwx, sumwx2]+9*[0.0])) # 13 = TH1::kNstat
+        h.SetEntries(entries)
+        return h
+    def setHistogram(self, sample, selection, variable, h) :
+        "copy the bins and stats of a TH1 (with the same axis) into the bank; the inverse of histogram"
+        iSam, iSel, iVar = self.samples.index(sample), self.selections.index(selection), self.variables.index(variable)
+        axis = h.GetXaxis()
+        assert (axis.GetNbins(), axis.GetXmin(), axis.GetXmax())==self.axes[variable],"%s: binning differs from %s"%(h.GetName(), str(self.axes[variable]))
+        bins = self.binSlice(variable)
+        contents = binContentsArray(h).astype(np.float64)
+        sumw2 = binSumw2Array(h)
+        self.sumw [iSam, iSel, bins] = contents
+        self.sumw2[iSam, iSel, bins] = sumw2 if sumw2 is not None else np.abs(contents) # as TH1::GetBinError
+        stats = array.array('d', 13*[0.0]) # TH1::kNstat
+        h.GetStats(stats)
+        self.stats[iSam, iSel, iVar] = [h.GetEntries()] + list(stats[:4])
+        return self
+    def nbytes(self) : return self.sumw.nbytes + self.sumw2.nbytes + self.stats.nbytes
+    def toHistos(self) :
+        "dict of TH1F [sample][selection][variable], as the ones from the bookHistos functions"
+        return dict((sam, dict((sel, dict((v, self.histogram(sam, sel, v)) for v in self.variables))
+                               for sel in self.selections))
+                    for sam in self.samples)
+
+class HistogramBankFileStore(object) :
+    """Read the histograms [selection][variable] of a sample from a file
+    (or from one of its directories) once, into a one-sample
+    HistogramBank, and serve them from memory. The least recently used
+    banks are dropped when their total size exceeds maxBytes. Missing
+    histograms are returned as None. The files with directories (one
+    per syst, see check_hft_trees --consolidated) are kept open until
+    close(), so that each one is opened only once."""
+    def __init__(self, selections, variables, binning, maxBytes=1024*1024*1024, verbose=False) :
+        self.selections, self.variables, self.binning = selections, variables, binning
+        self.maxBytes = maxBytes
+        self.verbose = verbose
+        self.banks = collections.OrderedDict() # (filename, directory, sample) : (bank, set of the histograms found)
+        self.files = dict()
+    def nbytes(self) : return sum(bank.nbytes() for bank, found in self.banks.values())
+    def openFile(self, filename, keepOpen=False) :
+        if filename in self.files : return self.files[filename]
+        file = r.TFile.Open(filename)
+        if not file : print "missing file %s"%filename
+        elif keepOpen : self.files[filename] = file
+        return file
+    def close(self) :
+        for file in self.files.values() : file.Close()
+        self.files = dict()
+    def load(self, filename, sample, directory='') :
+        bank = HistogramBank([sample], self.selections, self.variables, self.binning)
+        found = set()
+        file = self.openFile(filename, keepOpen=bool(directory))
+        source = file.Get(directory) if file and directory else file
+        if file and not source : print "missing directory %s in %s"%(directory, filename)
+        if source :
+            for sel in self.selections :
+                for var in self.variables :
+                    h = source.Get(bank.nameTemplate%{'variable':var, 'sample':sample, 'selection':sel})
+                    if h :
+                        bank.setHistogram(sample, sel, var, h)
+                        found.add((sel, var))
+        if file and not directory : file.Close()
+        if self.verbose : print "loaded %d histograms from %s%s"%(len(found), filename, ':'+directory if directory else '')
+        return bank, found
+    def bank(self, filename, sample, directory='') :
+        "the bank and the set of (selection, variable) found for this file; loaded if needed"
+        key = (filename, directory, sample)
+        if key in self.banks : self.banks[key] = self.banks.pop(key) # move to the end, most recently used
+        else :
+            self.banks[key] = self.load(filename, sample, directory)
+            while len(self.banks)>1 and self.nbytes()>self.maxBytes :
+                dropped, _ = self.banks.popitem(last=False)
+                if self.verbose : print "dropping histograms from %s %s"%dropped[:2]
+        return self.banks[key]
+    def histogram(self, filename, sample, selection, variable, directory='') :
+        bank, found = self.bank(filename, sample, directory)
+        return bank.histogram(sample, selection, variable) if (selection, variable) in found else None
+
+class HistogramBankRow(object) :
+    "the histograms of one sample; fill(selection, variable, values, weights) as HistogramBank.fill"
+    def __init__(self, bank, iSample) :
+        self.bank, self.iSample = bank, iSample
+    def fill(self, selection, variable, values, weights=None) :
+        self.bank.fill(self.bank.samples[self.iSample], selection, variable, values, weights)
+
+def fillRowsWithWeightMatrix(rows, selection, variable, values, weights) :
+    """Fill the histogram (selection, variable) of rows[k] with the
+    values and the weights weights[:,k]; as
+    rootUtils.fillHistosWithWeightMatrix, the bin indices are computed
+    once and there is one bincount per column"""
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    assert weights.shape==(len(values), len(rows)),"weights %s for %d values and %d rows"%(str(weights.shape), len(values), len(rows))
+    if not len(values) or not len(rows) : return rows
+    bank0 = rows[0].bank
+    nBins = bank0.axes[variable][0]
+    bins = bank0.binIndices(variable, values)
+    inRange = (bins>0) & (bins<=nBins)
+    x = values[inRange]
+    for k, row in enumerate(rows) :
+        bank, iSam = row.bank, row.iSample
+        iSel, iVar = bank.selections.index(selection), bank.variables.index(variable)
+        w = weights[:,k]
+        binSlice = bank.binSlice(variable)
+        bank.sumw [iSam, iSel, binSlice] += np.bincount(bins, weights=w,   minlength=nBins+2)
+        bank.sumw2[iSam, iSel, binSlice] += np.bincount(bins, weights=w*w, minlength=nBins+2)
+        w = w[inRange]
+        bank.stats[iSam, iSel, iVar] += [len(values), w.sum(), (w*w).sum(), (w*x).sum(), (w*x*x).sum()]
+    return rows
+
+#
+# testing
+#
+class BankVsTH1(unittest.TestCase) :
+    "the exported histograms should be the same as the ones filled with TH1::Fill"
+    def testFill(self) :
+        def binning(variable, selection) : return (';x;entries', 10, 0.0, 5.0)
+        bank = HistogramBank(['a', 'b'], ['sel0', 'sel1'], ['x', 'y'], binning)
+        rnd = np.random.RandomState(2014)
+        values, weights = rnd.uniform(-1.0, 6.0, 500), rnd.uniform(0.5, 1.5, 500)
+        bank['b'].fill('sel1', 'y', values, weights)
+        other = HistogramBank(['c', 'b'], ['sel0', 'sel1'], ['x', 'y'], binning)
+        other.fill('b', 'sel1', 'y', values, weights)
+        bank.add(other)
+        reference = r.TH1F('reference', '', 10, 0.0, 5.0)
+        reference.SetDirectory(0)
+        reference.Sumw2()
+        for v, w in zip(values, weights) :
+            reference.Fill(v, w)
+            reference.Fill(v, w)
+        h = bank.toHistos()['b']['sel1']['y']
+        self.assertEqual(h.GetName(), 'h_y_b_sel1')
+        self.assertEqual(bank.keys(), ['a', 'b', 'c'])
+        self.assertAlmostEqual(h.GetEntries(), reference.GetEntries())
+        self.assertAlmostEqual(h.GetMean(), reference.GetMean(), places=5)
+        for b in range(12) :
+            self.assertAlmostEqual(h.GetBinContent(b), reference.GetBinContent(b), places=4)
+            self.assertAlmostEqual(h.GetBinError(b), reference.GetBinError(b), places=4)
+        self.assertEqual(bank.histogram('a', 'sel0', 'x').GetEntries(), 0)
+        copy = HistogramBank(['b'], ['sel1'], ['y'], binning).setHistogram('b', 'sel1', 'y', h).histogram('b', 'sel1', 'y')
+        self.assertAlmostEqual(copy.GetMean(), h.GetMean(), places=5)
+        self.assertAlmostEqual(copy.GetBinError(3), h.GetBinError(3), places=5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,27 +2,47 @@
 
 # Utility classes and function to navigate the histograms in a root file
 #
+# The list of keys of a file opened read-only is saved in a sidecar
+# index, <file>.keys.json, valid as long as the file size and mtime
+# do not change; later calls to getAllHistoNames read the index
+# instead of walking the file (see keyIndex).
+#
 # davide.gerbaudo@gmail.com
 # Jan 2013
 
-import collections, re, unittest
+import collections, json, os, re, unittest
 import ROOT as r
 from utils import Memoize
 
 class HistoType(object):
-    "Type of histogram, defined by plot region, channel, variable, syst"
+    """Type of histogram, defined by plot region, channel, variable, syst.
+    The instances are interned and immutable: the same attributes give
+    the same object, so that they are cheap dict keys."""
     attributes = ['pr', 'ch', 'var', 'syst']
-    def __init__(self, pr='', ch='', var='', syst=''):
-        for att in HistoType.attributes : setattr(self, att, eval(att))
+    __slots__ = ('pr', 'ch', 'var', 'syst', '_key', '_hash')
+    _interned = dict()
+    def __new__(cls, pr='', ch='', var='', syst=''):
+        key = (pr, ch, var, syst)
+        try :
+            return cls._interned[key]
+        except KeyError :
+            self = super(HistoType, cls).__new__(cls)
+            for att, value in zip(HistoType.attributes, key) : object.__setattr__(self, att, value)
+            object.__setattr__(self, '_key', key)
+            object.__setattr__(self, '_hash', hash(key))
+            return cls._interned.setdefault(key, self)
+    def __setattr__(self, name, value) : raise AttributeError("HistoType is immutable")
+    def __reduce__(self) : return (HistoType, self._key)
     def sameas(self, rhs):
-        return all([getattr(self,att)==getattr(rhs,att) for att in HistoType.attributes])
-    def __eq__(self, other) : return self.sameas(other)
+        return self is rhs or self._key==rhs._key
+    def __eq__(self, other) : return self is other or (isinstance(other, HistoType) and self._key==other._key)
+    def __ne__(self, other) : return not self.__eq__(other)
     def __str__(self) : return ', '.join(["%s : %s"%(a, getattr(self,a)) for a in HistoType.attributes])
-    def __hash__(self) : return hash(self.__str__())
+    def __hash__(self) : return self._hash
     def matchAllAvailabeAttrs(self, rhs) :
-        "whether all attributes are the same; empty attributes on lhs are skipped"
-        ga, hattrs = getattr, HistoType.attributes
-        return all([ar==al for ar,al in [(ga(self,a), ga(rhs,a)) for a in hattrs] if ar])
+        "whether all attributes are the same; empty attributes on lhs are skipped; False for an unclassified (None) rhs"
+        if rhs is None : return False
+        return all(ar==al for ar, al in zip(self._key, rhs._key) if ar)
 
 def setHistoType(h, type) :
     setattr(h, 'type', type)
@@ -31,60 +51,109 @@ def setHistoSample(h, sample) :
     setattr(h, 'sample', sample)
     return h
 
-class HistoNameClassifier :
+class HistoNameClassifier(object) :
     """Extract pieces of information from the histogram name and attach an HistoType attribute
     See the NEWHIST macro in SusyPlotter::Begin
+    Each name is parsed only once; the classifications are shared by all classifiers.
     """
+    rep = re.compile('(?P<pr>.*?)_'   # plot region (non greedy)
+                     +'(?P<ch>.*?)_'  # channel (non greedy)
+                     +'(?P<var>.*)_'  # var name (greedy, can contain '_')
+                     +'(?P<syst>.*)') # last token, everything that's left
+    _types = dict() # histoname : HistoType (None if it cannot be classified)
     def __init__(self, verbose=False) :
         self.verbose = verbose
-        self.rep = re.compile('(?P<pr>.*?)_'   # plot region (non greedy)
-                              +'(?P<ch>.*?)_'  # channel (non greedy)
-                              +'(?P<var>.*)_'  # var name (greedy, can contain '_')
-                              +'(?P<syst>.*)') # last token, everything that's left
     def histoType(self, histoname='') :
-        match = self.rep.search(histoname)
-        # hack to parse muon_CR_WHSS_ee_l_pt_fake
-        pr = 'CR_WHSS' if 'CR_WHSS' in histoname else None
-        ch = 'ee' if 'ee' in histoname else 'mm' if 'mm' in histoname else 'em' if 'em' in histoname else None
-        var = 'l_pt_fake' if 'l_pt_fake' in histoname else None
-        syst = None
-        return HistoType({'pr':pr, 'ch':ch, 'var':var, 'syst':syst})
-        
-        if not match :
-            if self.verbose : print "cannot classify %s" % histoname
-        else :
-            kargs = dict([(g, match.group(g)) for g in ['pr', 'ch', 'var', 'syst']])
-            return  HistoType(**kargs)
+        try :
+            return HistoNameClassifier._types[histoname]
+        except KeyError :
+            match = HistoNameClassifier.rep.search(histoname)
+            if not match and self.verbose : print "cannot classify %s" % histoname
+            type = HistoType(*match.group('pr', 'ch', 'var', 'syst')) if match else None
+            HistoNameClassifier._types[histoname] = type
+            return type
+    def classify(self, histonames=[]) :
+        "list of HistoType, one for each name"
+        return [self.histoType(n) for n in histonames]
+
+def isTDirClass(classname) : return r.TClass(classname).InheritsFrom(r.TDirectory.Class())
+def histoDimension(classname) :
+    "1, 2, or 3 for TH1, TH2, TH3 (and derived classes); 0 for anything else"
+    cl = r.TClass(classname)
+    if not cl.InheritsFrom(r.TH1.Class()) : return 0
+    return 3 if cl.InheritsFrom(r.TH3.Class()) else 2 if cl.InheritsFrom(r.TH2.Class()) else 1
+isTDirClass, histoDimension = Memoize(isTDirClass), Memoize(histoDimension)
+
+def walkKeys(inputDir, path='', withBinCounts=False) :
+    """List of [name, classname, path, histo dimension, bin counts] for
+    all the keys, recursively: first the keys of inputDir, then the
+    ones of each subdirectory. The bin counts ([nx[, ny[, nz]]]) are
+    only filled withBinCounts, since they require reading the histograms."""
+    entries, dirNames = [], []
+    for k in inputDir.GetListOfKeys() :
+        name, classname = k.GetName(), k.GetClassName()
+        dim = histoDimension(classname)
+        nbins = None
+        if withBinCounts and dim :
+            h = k.ReadObj()
+            nbins = [h.GetNbinsX(), h.GetNbinsY(), h.GetNbinsZ()][:dim]
+        entries.append([name, classname, path, dim, nbins])
+        if isTDirClass(classname) : dirNames.append(name)
+    for d in dirNames :
+        entries += walkKeys(inputDir.Get(d), path+'/'+d if path else d, withBinCounts)
+    return entries
+
+def keyIndexFilename(filename) : return filename+'.keys.json'
+def keyIndex(inputDir, withBinCounts=False, verbose=False) :
+    """Entries of walkKeys for a file opened read-only, from its sidecar
+    index if that is up to date, otherwise walking the file and
+    (re)writing the index. Return None for anything else (e.g. a
+    subdirectory, or a file being written), that has to be walked."""
+    if not inputDir.InheritsFrom(r.TFile.Class()) or inputDir.GetOption()!='READ' : return None
+    filename = inputDir.GetName()
+    if not os.path.isfile(filename) : return None
+    stat = os.stat(filename)
+    fileId = {'size' : stat.st_size, 'mtime' : stat.st_mtime}
+    indexName = keyIndexFilename(filename)
+    try :
+        index = json.load(open(indexName))
+        upToDate = all(index[k]==v for k, v in fileId.iteritems())
+        if upToDate and (not withBinCounts or index['withBinCounts']) :
+            return [[str(n), str(c), str(p), d, nb] for n, c, p, d, nb in index['keys']] # json gives unicode
+    except (IOError, ValueError, KeyError) :
+        pass
+    if verbose : print "building key index %s"%indexName
+    entries = walkKeys(inputDir, withBinCounts=withBinCounts)
+    index = dict(fileId, keys=entries, withBinCounts=withBinCounts)
+    try :
+        json.dump(index, open(indexName, 'w'))
+    except (IOError, OSError) :
+        if verbose : print "cannot write %s, the index will not be saved"%indexName
+    return entries
+
+def histoBinCounts(inputFile, verbose=False) :
+    "dict {'dir/name' : [nx[, ny[, nz]]]} for all the histograms in a file, from its key index"
+    entries = keyIndex(inputFile, withBinCounts=True, verbose=verbose) or walkKeys(inputFile, withBinCounts=True)
+    return dict(((path+'/'+name if path else name), nbins) for name, classname, path, dim, nbins in entries if dim)
 
 def getAllHistoNames(inputDir, verbose=False, onlyTH1=False, onlyTH2=False, onlyTH3=False,
-                     nameStem='') :
+                     nameStem='', useIndex=True) :
 
     """Provide a list of all histograms in the file; search
     recursively (use FindObjectAny to retrieve from subdirs).
-    This function can become slow where there are many histograms.
-    Caching helps, but the best speedup found so far is specifying a
-    stem for the histogram name. Caveat emptor: this trick can miss
-    subdirectories that do not contain the stem.
+    Walking the keys can become slow where there are many histograms;
+    for a file opened read-only, the keys are read from its sidecar
+    index (see keyIndex) after the first walk, unless useIndex=False.
     """
-    univoqueOption = onlyTH1 + onlyTH2 + onlyTH2 <= 1
+    univoqueOption = onlyTH1 + onlyTH2 + onlyTH3 <= 1
     assert univoqueOption, ("one at the time : %s"
                             %' '.join(["%s=%s"%(o, eval(o))\
                                        for o in ['onlyTH1', 'onlyTH2', 'onlyTH3']]))
-    tdir, th1, th2, th3 = r.TDirectory.Class(), r.TH1.Class(), r.TH2.Class(), r.TH3.Class()
-    def isTDir(classname) : return r.TClass(classname).InheritsFrom(tdir)
-    def isTH(classname) : return r.TClass(classname).InheritsFrom(th1)
-    def isTH2(classname) : return r.TClass(classname).InheritsFrom(th2)
-    def isTH3(classname) : return r.TClass(classname).InheritsFrom(th3)
-    def isTH1(classname) : return isTH(classname) and not isTH2(classname) and not isTH3(classname)
-    isTDir = Memoize(isTDir)
-    isTH, isTH1, isTH2, isTH3 = Memoize(isTH), Memoize(isTH1), Memoize(isTH2), Memoize(isTH3)
-    isHist = isTH1 if onlyTH1 else isTH2 if onlyTH2 else isTH3 if onlyTH3 else isTH
-    allKeys = [k for k in inputDir.GetListOfKeys()]
-    histNames = map(lambda k : k.GetName(), [k for k in allKeys if isHist(k.GetClassName())])
-    dirNames  = map(lambda k : k.GetName(), [k for k in allKeys if isTDir(k.GetClassName())])
-    if verbose : print '\n'.join("%s : %s"%(l, str(eval(l))) for l in ['histNames', 'dirNames'])
-    for dir in dirNames :
-        histNames += getAllHistoNames(inputDir.Get(dir), verbose, onlyTH1, onlyTH2, onlyTH3)
+    dims = [1] if onlyTH1 else [2] if onlyTH2 else [3] if onlyTH3 else [1, 2, 3]
+    entries = keyIndex(inputDir, verbose=verbose) if useIndex else None
+    if entries is None : entries = walkKeys(inputDir)
+    histNames = [name for name, classname, path, dim, nbins in entries if dim in dims]
+    if verbose : print "%d histograms in %s"%(len(histNames), inputDir.GetName())
     return histNames
 
 def classifyHistoByName(histo, verbose=False) :
@@ -112,6 +181,39 @@ class KnownHistoTypes(unittest.TestCase) :
             #print l.matchAllAvailabeAttrs(r)," <--> ",l," | ",r
             self.assertEqual(l.matchAllAvailabeAttrs(r), expRes)
 
+class KeyIndexVsWalk(unittest.TestCase) :
+    def testIndex(self) :
+        import tempfile
+        filename = os.path.join(tempfile.mkdtemp(), 'keys.root')
+        out = r.TFile.Open(filename, 'recreate')
+        r.TH1F('h1', '', 3, 0.0, 1.0).Write()
+        out.mkdir('sub').cd()
+        r.TH2F('h2', '', 4, 0.0, 1.0, 5, 0.0, 1.0).Write()
+        r.TH1D('h3', '', 2, 0.0, 1.0).Write()
+        out.Close()
+        for iteration in ['walk', 'index'] :
+            input = r.TFile.Open(filename)
+            self.assertEqual(getAllHistoNames(input), ['h1', 'h2', 'h3'])
+            self.assertEqual(getAllHistoNames(input, onlyTH1=True), ['h1', 'h3'])
+            self.assertEqual(getAllHistoNames(input, onlyTH1=True), getAllHistoNames(input, onlyTH1=True, useIndex=False))
+            self.assertTrue(os.path.exists(keyIndexFilename(filename)))
+            input.Close()
+        input = r.TFile.Open(filename)
+        self.assertEqual(histoBinCounts(input)['sub/h2'], [4, 5])
+        input.Close()
+
+class InternedHistoTypes(unittest.TestCase) :
+    def testInterning(self) :
+        hnc = HistoNameClassifier()
+        types = hnc.classify(['sr1_ee_l0_pt_NOM', 'sr1_ee_l0_pt_NOM', 'sr2_ee_l0_pt_NOM'])
+        self.assertIs(types[0], types[1])
+        self.assertIs(types[0], HistoType('sr1', 'ee', 'l0_pt', 'NOM'))
+        self.assertNotEqual(types[0], types[2])
+        self.assertEqual(len(set(types)), 2)
+        self.assertRaises(AttributeError, setattr, types[0], 'pr', 'sr2')
+        self.assertEqual(hnc.histoType('nounderscores'), None)
+        self.assertFalse(HistoType('', 'ee', 'l0_pt', 'NOM').matchAllAvailabeAttrs(hnc.histoType('ee_l0')))
+
 class KnownHistoNames(unittest.TestCase) :
     def testAttrExtraction(self):
         "Verifiy that we are able to extract the parameters with weird histonames"
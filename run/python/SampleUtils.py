@@ -6,7 +6,7 @@
 # Jan 2013
 
 import glob, os, re, unittest
-from datasets import datasets, allGroups, allDatasets, activeDatasets
+from datasets import datasets, allGroups, allDatasets, activeDatasets, registry
 from rootUtils import importRoot
 r = importRoot()
 
@@ -44,9 +44,7 @@ def guessGroupFromFilename(filename='') :
     return group
 def guessSampleFromFilename(filename='') :
     "Guess sample from filename"
-    def longest(lst=[]) : return max(lst, key=len) if lst else None
-    def filenameMatchesSample(fn, smp) : return re.search('([_.])'+smp+'([_.])', fn)
-    return longest([s for s in allDatasets if filenameMatchesSample(filename, s)])
+    return registry.longestNameIn(filename)
 
 
 def isDataSample(samplename) : return 'data' in samplename or 'period' in samplename
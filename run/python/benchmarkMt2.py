@@ -0,0 +1,78 @@
+#!/bin/env python
+
+# Compare the per-event mt2j (one mt2_bisect::mt2 per call) with the
+# batched one from kin.computeMt2jArray: timing and agreement
+#
+# Input: none, the l0, l1, j0, j1, met are generated at random
+#
+# davide.gerbaudo@gmail.com
+# April 2014
+
+import math
+import optparse
+import time
+import numpy as np
+
+from kin import (tlv,
+                 TlvArray,
+                 computeMt2j,
+                 computeMt2jArray,
+                 mt2jScale,
+                 MT2_RELATIVE_PRECISION,
+                 )
+
+def benchmarkMt2() :
+    options = parseOptions()
+    nEvents, verbose = options.events, options.verbose
+    rnd = np.random.RandomState(options.seed)
+    def randomTlvArray(ptMin, ptMax, m) :
+        return TlvArray.fromPtEtaPhiM(rnd.uniform(ptMin, ptMax, nEvents), rnd.uniform(-2.5, 2.5, nEvents),
+                                      rnd.uniform(-math.pi, math.pi, nEvents), m*np.ones(nEvents))
+    l0, l1 = randomTlvArray(20.0, 200.0, 0.1), randomTlvArray(10.0, 100.0, 0.1)
+    j0, j1 = randomTlvArray(30.0, 300.0, 10.0), randomTlvArray(20.0, 150.0, 5.0)
+    met = TlvArray.fromPtEtaPhiM(rnd.uniform(0.0, 200.0, nEvents), np.zeros(nEvents),
+                                 rnd.uniform(-math.pi, math.pi, nEvents), np.zeros(nEvents))
+    def toTlvs(ta) :
+        tlvs = []
+        for px, py, pz, E in zip(ta.px, ta.py, ta.pz, ta.E) :
+            l = tlv()
+            l.SetPxPyPzE(px, py, pz, E)
+            tlvs.append(l)
+        return tlvs
+    l0s, l1s, j0s, j1s, mets = [toTlvs(v) for v in [l0, l1, j0, j1, met]]
+    zeroMass, lspMass = options.zero_mass, options.lsp_mass
+    start = time.time()
+    perEvent = np.array([computeMt2j(a, b, j, k, m, zeroMass, lspMass) for a, b, j, k, m in zip(l0s, l1s, j0s, j1s, mets)])
+    timePerEvent = time.time() - start
+    start = time.time()
+    batched = computeMt2jArray(l0, l1, j0, j1, met, zeroMass, lspMass)
+    timeBatched = time.time() - start
+    absDiff = np.abs(batched - perEvent)
+    relDiff = absDiff/np.maximum(perEvent, 1.0)
+    print "mt2j on %d events (zeroMass %s, lspMass %.1f)"%(nEvents, zeroMass, lspMass)
+    print "per-event : %.3f s (%.0f evt/s)"%(timePerEvent, nEvents/max(timePerEvent, 1.0e-9))
+    print "batched   : %.3f s (%.0f evt/s)"%(timeBatched, nEvents/max(timeBatched, 1.0e-9))
+    print "speedup   : %.1f"%(timePerEvent/max(timeBatched, 1.0e-9))
+    print "max |diff| : %.4f GeV, max rel diff %.2e"%(absDiff.max(), relDiff.max())
+    precision = MT2_RELATIVE_PRECISION*mt2jScale(l0, l1, j0, j1, met, zeroMass)
+    print "max |diff|/precision : %.3f (bisection precision: %.4f GeV on average)"%((absDiff/precision).max(), precision.mean())
+    if verbose :
+        for i in np.argsort(absDiff)[::-1][:10] :
+            print "evt %d : per-event %.4f, batched %.4f"%(i, perEvent[i], batched[i])
+
+def parseOptions() :
+    usage="""%prog [options]
+    Example:
+    %prog -n 100000 --lsp-mass 100
+    """
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--events', type='int', default=10000, help='number of random events')
+    parser.add_option('-s', '--seed', type='int', default=12345, help='random seed')
+    parser.add_option('--zero-mass', action='store_true', help='use massless visible systems')
+    parser.add_option('--lsp-mass', type='float', default=0.0, help='mass of the invisible particles')
+    parser.add_option('-v', '--verbose', action='store_true', help='print the events with the largest differences')
+    (options, args) = parser.parse_args()
+    return options
+
+if __name__=='__main__' :
+    benchmarkMt2()
@@ -24,11 +24,11 @@
 # davide.gerbaudo@gmail.com
 # October 2013
 
-from math import sqrt
 import operator
 import optparse
 import os
-from rootUtils import importRoot, buildRatioHistogram, drawLegendWithDictKeys, getMinMax, getBinIndices
+from rootUtils import (importRoot, buildRatioHistogram, drawLegendWithDictKeys, getMinMax,
+                       binContentsArray, binErrorsArray, setBinContentsArray, innerBins)
 r = importRoot()
 r.gStyle.SetPadTickX(1)
 r.gStyle.SetPadTickY(1)
@@ -182,23 +182,28 @@ def buildPercentagesTwice(inputFiles, histoName, binLabelA, binLabelB) :
     countsA = dict((p, c/norm if norm else 0.0)for p,c in countsA.iteritems())
     countsB = dict((p, c/norm if norm else 0.0)for p,c in countsB.iteritems())
     return countsA, countsB
-def binWeightedSum(histos={}, weights={}, bin=1) :
+def binWeightedSum(histos={}, weights={}) :
+    "arrays (see rootUtils.binContentsArray) of the weighted sum of the bin contents, and of its err^2"
     assert not set(histos)-set(weights), "different keys: histos[%s], weights[%s]"%(str(histos.keys()), str(weights.keys()))
-    cews = [(h.GetBinContent(bin), h.GetBinError(bin), w)
-            for h, w in [(histos[k], weights[k]) for k in histos.keys()]]
-    tot  = sum(c*w     for c, e, w in cews)
-    err2 = sum(e*e*w*w for c, e, w in cews)
+    tot, err2 = 0.0, 0.0
+    for k, h in histos.iteritems() :
+        w = weights[k]
+        tot  = tot  + w*binContentsArray(h)
+        err2 = err2 + w*w*np.square(binErrorsArray(h))
     return tot, err2
+def fillWeightedHisto(hout, tot, err2) :
+    "set the contents and errors of the bins (not of the under/overflows, that stay empty after Reset)"
+    contents, sumw2 = np.zeros(binContentsArray(hout).shape), np.zeros(binContentsArray(hout).shape)
+    innerBins(contents)[...] = innerBins(tot)
+    innerBins(sumw2)[...] = innerBins(err2)
+    return setBinContentsArray(hout, contents, sumw2)
 def buildWeightedHisto(histos={}, fractions={}, histoName='', histoTitle='') :
     "was getFinalRate"
     hout = first(histos).Clone(histoName if histoName else 'final_rate') # should pick a better default
     hout.SetTitle(histoTitle)
     hout.Reset()
-    for b in getBinIndices(hout) :
-        tot, err2 = binWeightedSum(histos, fractions, b)
-        hout.SetBinContent(b, tot)
-        hout.SetBinError(b, sqrt(err2))
-    return hout
+    tot, err2 = binWeightedSum(histos, fractions)
+    return fillWeightedHisto(hout, tot, err2)
 def buildWeightedHistoTwice(histosA={}, fractionsA={}, histosB={}, fractionsB={},
                             histoName='', histoTitle='') :
     "was getFinalRate"
@@ -206,12 +211,9 @@ def buildWeightedHistoTwice(histosA={}, fractionsA={}, histosB={}, fractionsB={}
     hout = first(histosA).Clone(histoName if histoName else 'final_rate') # should pick a better default
     hout.SetTitle(histoTitle)
     hout.Reset()
-    for b in getBinIndices(hout) :
-        totA, errA2 = binWeightedSum(histosA, fractionsA, b)
-        totB, errB2 = binWeightedSum(histosB, fractionsB, b)
-        hout.SetBinContent(b, totA + totB)
-        hout.SetBinError(b, sqrt(errA2 + errB2))
-    return hout
+    totA, errA2 = binWeightedSum(histosA, fractionsA)
+    totB, errB2 = binWeightedSum(histosB, fractionsB)
+    return fillWeightedHisto(hout, totA + totB, errA2 + errB2)
 def buildMuonRates(inputFiles, outputfile, outplotdir, verbose=False) :
     """
     For each selection region, build the real eff and fake rate
@@ -11,9 +11,11 @@
 import collections
 import datetime
 import math
+import multiprocessing
 import optparse
 import os
 import pprint
+import traceback
 from rootUtils import (drawAtlasLabel
                        ,getBinContents
                        ,getMinMax
@@ -24,10 +26,13 @@ from rootUtils import (drawAtlasLabel
                        ,integralAndError
                        ,setWhPlotStyle
                        ,setAtlasStyle
+                       ,treeToArrays
                        )
 r = importRoot()
 from utils import (first
                    ,getCommandOutput
+                   ,Memoize
+                   ,entryRanges
                    ,mkdirIfNeeded
                    ,filterWithRegexp
                    ,remove_duplicates
@@ -37,6 +42,14 @@ from utils import (first
 import SampleUtils
 from CutflowTable import CutflowTable
 import systUtils
+try:
+    import numpy as np
+    from selectionUtils import parseFormula, formulaVariables, evaluateFormula, SelectionCompiler
+    from HistogramBank import HistogramBank, HistogramBankFileStore, fillRowsWithWeightMatrix
+except ImportError:
+    print "missing numpy: only the event-loop fill will be available (no --columnar, no plot mode)"
+    np, HistogramBank, HistogramBankFileStore = None, None, None
+def isHistogramBank(histos) : return HistogramBank is not None and isinstance(histos, HistogramBank)
 
 usage="""
 
@@ -55,6 +68,11 @@ Example usage ('fill' mode):
  --verbose
  >& log/hft/check_hft_trees_fill.log
 
+With --consolidated, the histograms of each group are written to (and
+read from) one file, <group>_allsyst.root, with one directory per syst;
+the directories in the file are the catalog of the available
+variations.
+
 Example usage ('plot' mode):
 %prog \\
  --syst ANY                 \\
@@ -66,17 +84,25 @@ Example usage ('plot' mode):
 def main() :
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('-b', '--batch',  action='store_true', default=False, help='submit to batch (used in fill mode)')
+    parser.add_option('-C', '--columnar', action='store_true', default=False, help='fill reading the trees in bulk with numpy (used in fill mode)')
+    parser.add_option('-j', '--jobs', type='int', default=0, help='use a local pool of N processes: one (syst, group) unit each in fill mode, one (selection, variable) plot each in plot mode')
+    parser.add_option('--shard-size', type='int', default=None, help='with --jobs, split the trees with more entries in ranges of this size')
+    parser.add_option('-W', '--weights-one-pass', action='store_true', default=False, help='fill NOM and all weight variations in one columnar pass; requires --columnar (used in fill mode)')
     parser.add_option('-f', '--input-fake', help='location hft trees for fake')
     parser.add_option('-g', '--input-gen', help='location hft trees for everything else')
     parser.add_option('-i', '--input-dir')
     parser.add_option('-o', '--output-dir')
     parser.add_option('-s', '--syst', help="variations to process (default all). Give a comma-sep list or say 'weight', 'object', or 'fake'")
     parser.add_option('-e', '--exclude', help="skip some systematics, example 'EL_FR_.*'")
+    parser.add_option('--consolidated', action='store_true', default=False, help='one file per group, with one directory per syst (both modes)')
+    parser.add_option('--store-mb', type='float', default=1024.0, help='memory budget for the histograms read from the input files (used in plot mode)')
     parser.add_option('-v', '--verbose', action='store_true', default=False)
     parser.add_option('-l', '--list-systematics', action='store_true', default=False, help='list what is already in output_dir')
     parser.add_option('-L', '--list-all-systematics', action='store_true', default=False, help='list all possible systematics')
 
     (opts, args) = parser.parse_args()
+    if opts.weights_one_pass and not opts.columnar : parser.error("--weights-one-pass requires --columnar")
+    if opts.columnar and np is None : parser.error("--columnar requires numpy")
     if opts.list_all_systematics :
         print "All systematics:\n\t%s"%'\n\t'.join(systUtils.getAllVariations())
         return
@@ -87,6 +113,7 @@ def main() :
     eitherMode = inGenSpecified != inDirSpecified
     if not eitherMode : parser.error("Run either in 'fill' or 'plot' mode")
     mode = 'fill' if inGenSpecified else 'plot' if inDirSpecified else None
+    if mode=='plot' and np is None : parser.error("plot mode requires numpy")
     requiredOptions = (['input_fake', 'input_gen', 'output_dir'] if mode=='fill' else ['input_dir', 'output_dir'])
     allOptions = [x.dest for x in parser._get_all_options()[1:]]
     def optIsNotSpecified(o) : return not hasattr(opts, o) or getattr(opts,o) is None
@@ -105,8 +132,16 @@ def runFill(opts) :
     sysOption    = opts.syst
     excludedSyst = opts.exclude
     verbose      = opts.verbose
+    columnar     = opts.columnar
+    weightsOnePass = opts.weights_one_pass
+    nJobs        = opts.jobs
+    shardSize    = opts.shard_size
+    consolidated = opts.consolidated
 
     if verbose : print "filling histos"
+    if batchMode and nJobs : raise ValueError("choose either --batch or --jobs")
+    if batchMode and consolidated : raise ValueError("--consolidated cannot be used with --batch (concurrent writes to the same file)")
+    if shardSize and not nJobs : raise ValueError("--shard-size requires --jobs")
     mkdirIfNeeded(outputDir)
     systematics = ['NOM']
     anySys = sysOption==None
@@ -119,13 +154,23 @@ def runFill(opts) :
     if excludedSyst : systematics = [s for s in systematics if s not in filterWithRegexp(systematics, excludedSyst)]
 
     if verbose : print "about to loop over these systematics:\n %s"%str(systematics)
-    for syst in systematics :
+    systGroups = [[s] for s in systematics]
+    if weightsOnePass :
+        onePassSysts = [s for s in systematics if s=='NOM' or s in systUtils.mcWeightVariations()]
+        systGroups = ([onePassSysts] if onePassSysts else []) + [[s] for s in systematics if s not in onePassSysts]
+    if nJobs :
+        runFillWithProcessPool(systGroups, nJobs, columnar, outputDir, shardSize, verbose, consolidated)
+        return
+    for systs in systGroups :
+        syst = systs[0] if len(systs)==1 else 'weights'
         if batchMode :
             newOptions  = " --input-gen %s" % opts.input_gen
             newOptions += " --input-fake %s" % opts.input_fake
             newOptions += " --output-dir %s" % opts.output_dir
             newOptions += " --verbose %s" % opts.verbose
-            newOptions += " --syst %s" % syst
+            newOptions += " --syst %s" % ','.join(systs)
+            newOptions += (" --columnar" if columnar else '')
+            newOptions += (" --weights-one-pass" if weightsOnePass else '')
             template = 'batch/templates/check_hft_fill.sh.template'
             script = "batch/hft_%s.sh"%syst
             scriptFile = open(script, 'w')
@@ -140,12 +185,123 @@ def runFill(opts) :
             if verbose : print out['stdout']
             if out['stderr'] : print  out['stderr']
             continue
+        if len(systs)>1 :
+            if verbose : print '---- filling in one pass ',', '.join(systs)
+            samplesPerGroup = allSamplesAllGroups()
+            countersPerSyst, histosPerSyst = countAndFillHistosMultiWeight(samplesPerGroup=samplesPerGroup, systs=systs, verbose=verbose)
+            for syst in systs :
+                [s.setSyst(syst) for g, samples in samplesPerGroup.iteritems() for s in samples]
+                printCounters(countersPerSyst[syst])
+                saveHistos(samplesPerGroup, histosPerSyst[syst], outputDir, verbose, consolidated)
+            continue
         if verbose : print '---- filling ',syst
         samplesPerGroup = allSamplesAllGroups()
         [s.setSyst(syst) for g, samples in samplesPerGroup.iteritems() for s in samples]
-        counters, histos = countAndFillHistos(samplesPerGroup=samplesPerGroup, syst=syst, verbose=verbose, outdir=outputDir)
+        counters, histos = countAndFillHistos(samplesPerGroup=samplesPerGroup, syst=syst, verbose=verbose, outdir=outputDir,
+                                              columnar=columnar)
         printCounters(counters)
-        saveHistos(samplesPerGroup, histos, outputDir, verbose)
+        saveHistos(samplesPerGroup, histos, outputDir, verbose, consolidated)
+
+def fillWorkUnit(unit) :
+    """Fill the histograms of one group (or of some of its samples, or
+    of an entry range of one sample), either for one syst or for
+    several in one pass; executed by the workers of the process pool.
+    Return (unit, counters[syst], histos[syst], error)"""
+    systs, group, sampleNames, entryRange, columnar, verbose = unit
+    try :
+        samplesPerGroup = dict((g, [s for s in samples if sampleNames is None or s.name in sampleNames])
+                               for g, samples in allSamplesAllGroups().iteritems() if g==group)
+        if entryRange : [s.setEntryRange(*entryRange) for s in samplesPerGroup[group]]
+        if len(systs)>1 :
+            counters, histos = countAndFillHistosMultiWeight(samplesPerGroup=samplesPerGroup, systs=systs, verbose=verbose)
+        else :
+            syst = systs[0]
+            [s.setSyst(syst) for s in samplesPerGroup[group]]
+            counters, histos = countAndFillHistos(samplesPerGroup=samplesPerGroup, syst=syst, verbose=verbose, columnar=columnar)
+            counters, histos = {syst : counters}, {syst : histos}
+        return unit, counters, histos, None
+    except Exception :
+        return unit, None, None, traceback.format_exc()
+
+def planWorkUnits(systGroups=[], columnar=False, shardSize=None, verbose=False) :
+    """One unit for each (syst, group); with a shardSize, the samples
+    with more entries are split in entry ranges, one unit per range"""
+    units = []
+    nEntriesPerFile = dict() # several systs read the same file
+    def nEntries(sample) :
+        filename = sample.filenameHftTree
+        if filename not in nEntriesPerFile :
+            nEntriesPerFile[filename] = sample.nEntries if os.path.exists(filename) else 0
+        return nEntriesPerFile[filename]
+    for group, samples in allSamplesAllGroups().iteritems() :
+        for systs in systGroups :
+            if not any(groupIsRelevantForSys(group, s) for s in systs) : continue
+            [s.setSyst(systs[0]) for s in samples] # the first syst determines the input file
+            ranges = dict((s.name, entryRanges(nEntries(s), shardSize))
+                          for s in samples if shardSize and nEntries(s) > shardSize)
+            otherSamples = [s.name for s in samples if s.name not in ranges]
+            if otherSamples : units.append((systs, group, otherSamples if ranges else None, None, columnar, verbose))
+            units += [(systs, group, [name], entryRange, columnar, verbose)
+                      for name, rr in sorted(ranges.iteritems()) for entryRange in rr]
+            if verbose and ranges : print "%s %s : sharded %s"%(','.join(systs), group,
+                                                                 ', '.join("%s (%d)"%(n, len(rr)) for n, rr in ranges.iteritems()))
+    return units
+def addCountersAndHistos(counters={}, histos={}, countersToAdd={}, histosToAdd={}) :
+    """reduce the partial results of the work units: counters[group][sel],
+    histos[group][sel][var] or HistogramBank; return the reduced counters and histos"""
+    if isHistogramBank(histosToAdd) :
+        histos = histos.add(histosToAdd) if isHistogramBank(histos) else histosToAdd
+    for group, countersGroup in countersToAdd.iteritems() :
+        if group not in counters :
+            counters[group] = countersGroup
+            if not isHistogramBank(histosToAdd) : histos[group] = histosToAdd[group]
+            continue
+        for sel, count in countersGroup.iteritems() : counters[group][sel] += count
+        if isHistogramBank(histosToAdd) : continue
+        for sel, histosSel in histosToAdd[group].iteritems() :
+            for var, h in histosSel.iteritems() : histos[group][sel][var].Add(h)
+    return counters, histos
+def runFillWithProcessPool(systGroups=[], nJobs=1, columnar=False, outputDir='./', shardSize=None, verbose=False, consolidated=False) :
+    """Send the (syst, group) units, or the (syst, sample, entry range)
+    shards, to a local pool of processes, reduce the histograms per
+    syst, and write the same output files as the serial fill"""
+    units = planWorkUnits(systGroups, columnar, shardSize, verbose)
+    nUnits = len(units)
+    print "filling %d units with %d processes"%(nUnits, nJobs)
+    countersPerSyst, histosPerSyst = collections.defaultdict(dict), collections.defaultdict(dict) # histos[syst] can become a HistogramBank
+    failures = []
+    pool = multiprocessing.Pool(processes=nJobs)
+    start = datetime.datetime.now()
+    for iUnit, (unit, counters, histos, error) in enumerate(pool.imap_unordered(fillWorkUnit, units)) :
+        systs, group = unit[0], unit[1]
+        label = "%s : %s"%(','.join(systs), group)
+        if unit[3] : label += " %s [%d, %d)"%(unit[2][0], unit[3][0], unit[3][1])
+        elapsed = datetime.datetime.now() - start
+        if error :
+            failures.append((tuple(systs), group))
+            print "[%d/%d] failed %s (%s)\n%s"%(iUnit+1, nUnits, label, elapsed, error)
+            continue
+        print "[%d/%d] done %s (%s)"%(iUnit+1, nUnits, label, elapsed)
+        for syst in counters.keys() :
+            if not isHistogramBank(histos[syst]) :
+                [h.SetDirectory(0) for hs in histos[syst].values() for hh in hs.values() for h in hh.values()]
+            countersPerSyst[syst], histosPerSyst[syst] = addCountersAndHistos(countersPerSyst[syst], histosPerSyst[syst],
+                                                                              counters[syst], histos[syst])
+    pool.close()
+    pool.join()
+    failures = sorted(set(failures))
+    failedSysts = set(s for systs, g in failures for s in systs)
+    for systs in systGroups :
+        for syst in systs :
+            if syst in failedSysts :
+                print "skipping output for %s, failed groups : %s"%(syst, ', '.join(g for ss, g in failures if syst in ss))
+                continue
+            if syst not in histosPerSyst : continue
+            samplesPerGroup = allSamplesAllGroups()
+            [s.setSyst(syst) for g, samples in samplesPerGroup.iteritems() for s in samples]
+            printCounters(countersPerSyst[syst])
+            saveHistos(samplesPerGroup, histosPerSyst[syst], outputDir, verbose, consolidated)
+    if failures : print "%d/%d units failed : %s"%(len(failures), nUnits, str(failures))
 
 def runPlot(opts) :
     inputDir     = opts.input_dir
@@ -154,15 +310,16 @@ def runPlot(opts) :
     excludedSyst = opts.exclude
     verbose      = opts.verbose
     mkdirIfNeeded(outputDir)
-    buildTotBkg = systUtils.buildTotBackgroundHisto
-    buildStat = systUtils.buildStatisticalErrorBand
-    buildSyst = systUtils.buildSystematicErrorBand
+    buildSysts = systUtils.buildSystematicErrorBands
 
     groups = allGroups()
     selections = allRegions()
     variables = variablesToPlot()
+    histoStore = HistogramBankFileStore(selections, variables, histoBinning, maxBytes=opts.store_mb*1024*1024, verbose=verbose)
     for group in groups :
         group.setHistosDir(inputDir)
+        group.setConsolidated(opts.consolidated)
+        group.setHistoStore(histoStore)
         group.exploreAvailableSystematics(verbose)
         group.filterAndDropSystematics(sysOption, excludedSyst, verbose)
 
@@ -184,25 +341,18 @@ def runPlot(opts) :
     simBkgs = [g for g in groups if g.isMcBkg]
     data, fake, signal = findByName(groups, 'data'), findByName(groups, 'fake'), findByName(groups, 'signal')
 
-    for sel in selections :
-        if verbose : print '-- plotting ',sel
-        for var in variables :
-            if verbose : print '---- plotting ',var
-            for g in groups : g.setSystNominal()
-            nominalHistoData    = data.getHistogram(variable=var, selection=sel, cacheIt=True)
-            nominalHistoSign    = signal.getHistogram(variable=var, selection=sel, cacheIt=True)
-            nominalHistoFakeBkg = fake.getHistogram(variable=var, selection=sel, cacheIt=True)
-            nominalHistosSimBkg = dict([(g.name, g.getHistogram(variable=var, selection=sel, cacheIt=True)) for g in simBkgs])
-            nominalHistosBkg    = dict([('fake', nominalHistoFakeBkg)] + [(g, h) for g, h in nominalHistosSimBkg.iteritems()])
-            nominalHistoTotBkg  = buildTotBkg(histoFakeBkg=nominalHistoFakeBkg, histosSimBkgs=nominalHistosSimBkg)
-            statErrBand = buildStat(nominalHistoTotBkg)
-            systErrBand = buildSyst(fake=fake, simBkgs=simBkgs, variable=var, selection=sel,
-                                    fakeVariations=fakeSystematics, mcVariations=mcSystematics, verbose=verbose)
-
-            plotHistos(histoData=nominalHistoData, histoSignal=nominalHistoSign, histoTotBkg=nominalHistoTotBkg,
-                       histosBkg=nominalHistosBkg,
-                       statErrBand=statErrBand, systErrBand=systErrBand,
-                       canvasName=(sel+'_'+var), outdir=outputDir, verbose=verbose)
+    systErrBands = buildSysts(fake=fake, simBkgs=simBkgs, variables=variables, selections=selections,
+                              fakeVariations=fakeSystematics, mcVariations=mcSystematics, verbose=verbose)
+    plotContext.update({'groups' : groups, 'simBkgs' : simBkgs, 'data' : data, 'fake' : fake, 'signal' : signal,
+                        'systErrBands' : systErrBands, 'outputDir' : outputDir, 'verbose' : verbose})
+    plotJobs = [(sel, var) for sel in selections for var in variables]
+    if opts.jobs :
+        runPlotWithProcessPool(plotJobs, opts.jobs)
+    else :
+        for sel, var in plotJobs :
+            if verbose : print '---- plotting ',sel,var
+            plotSelectionVariable(sel, var)
+    histoStore.close()
     for group in groups :
         summary = group.variationsSummary()
         for selection, summarySel in summary.iteritems() :
@@ -217,27 +367,74 @@ def runPlot(opts) :
                                           'delta' :(("%.3f"%d) if type(d) is float else '--' if d==None else (str(d)+str(type(d)))) }
                             for s,c,d in summarySel)
 
-def countAndFillHistos(samplesPerGroup={}, syst='', verbose=False, outdir='./') :
+plotContext = dict() # what runPlot has prepared for plotSelectionVariable; the plot workers inherit it when forked
+def plotSelectionVariable(sel, var) :
+    "draw and save the plot of one (selection, variable), with the nominal histograms and the precomputed syst band"
+    c = plotContext
+    data, signal, fake, simBkgs = c['data'], c['signal'], c['fake'], c['simBkgs']
+    for g in c['groups'] : g.setSystNominal()
+    nominalHistoData    = data.getHistogram(variable=var, selection=sel, cacheIt=True)
+    nominalHistoSign    = signal.getHistogram(variable=var, selection=sel, cacheIt=True)
+    nominalHistoFakeBkg = fake.getHistogram(variable=var, selection=sel, cacheIt=True)
+    nominalHistosSimBkg = dict([(g.name, g.getHistogram(variable=var, selection=sel, cacheIt=True)) for g in simBkgs])
+    nominalHistosBkg    = dict([('fake', nominalHistoFakeBkg)] + [(g, h) for g, h in nominalHistosSimBkg.iteritems()])
+    nominalHistoTotBkg  = systUtils.buildTotBackgroundHisto(histoFakeBkg=nominalHistoFakeBkg, histosSimBkgs=nominalHistosSimBkg)
+    statErrBand = systUtils.buildStatisticalErrorBand(nominalHistoTotBkg)
+    systErrBand = c['systErrBands'][(sel, var)]
+
+    plotHistos(histoData=nominalHistoData, histoSignal=nominalHistoSign, histoTotBkg=nominalHistoTotBkg,
+               histosBkg=nominalHistosBkg,
+               statErrBand=statErrBand, systErrBand=systErrBand,
+               canvasName=(sel+'_'+var), outdir=c['outputDir'], verbose=c['verbose'])
+def plotWorkUnit(selVar) :
+    """Plot one (selection, variable) in a worker of the plot pool.
+    Return (selVar, varCounts[group], error); the variations logged
+    by the worker are sent back for the summary."""
+    try :
+        plotSelectionVariable(*selVar)
+        varCounts = dict((g.name, dict((sel, dict(counts)) for sel, counts in g.varCounts.iteritems()))
+                         for g in plotContext['groups'])
+        return selVar, varCounts, None
+    except Exception :
+        return selVar, None, traceback.format_exc()
+def runPlotWithProcessPool(plotJobs=[], nJobs=1) :
+    """Draw the plots with a pool of processes, each one with its own
+    ROOT. Each plot goes to its own files, and the results are
+    collected in the order of plotJobs, so the output does not depend
+    on nJobs."""
+    groups = plotContext['groups']
+    nPlots = len(plotJobs)
+    print "plotting %d histograms with %d processes"%(nPlots, nJobs)
+    failures = []
+    for group in groups :
+        if group.histoStore : group.histoStore.close() # the workers open their own files
+    pool = multiprocessing.Pool(processes=nJobs)
+    for iPlot, (selVar, varCounts, error) in enumerate(pool.imap(plotWorkUnit, plotJobs)) :
+        label = "%s_%s"%selVar
+        if error :
+            failures.append(label)
+            print "[%d/%d] failed %s\n%s"%(iPlot+1, nPlots, label, error)
+            continue
+        if plotContext['verbose'] : print "[%d/%d] plotted %s"%(iPlot+1, nPlots, label)
+        for group in groups :
+            for sel, counts in varCounts[group.name].iteritems() : group.varCounts[sel].update(counts)
+    pool.close()
+    pool.join()
+    if failures : print "%d/%d plots failed : %s"%(len(failures), nPlots, ', '.join(failures))
+
+def countAndFillHistos(samplesPerGroup={}, syst='', verbose=False, outdir='./', columnar=False) :
 
     selections = allRegions()
     variables = variablesToPlot()
 
-    mcGroups, fakeGroups = mcDatasetids().keys(), ['fake']
-    objVariations, weightVariations, fakeVariations = systUtils.mcObjectVariations(), systUtils.mcWeightVariations(), systUtils.fakeSystVariations()
-    def groupIsRelevantForSys(g, s) :
-        isRelevant = (s=='NOM' or (g in mcGroups and s in objVariations+weightVariations) or (g in fakeGroups and s in fakeVariations))
-        if verbose and not isRelevant : print "skipping %s for %s"%(g, s)
-        return isRelevant
-    def dropIrrelevantGroupsForThisSys(groups, sys) : return dict((g, samples) for g, samples in groups.iteritems() if groupIsRelevantForSys(g, syst))
-    def dropSamplesWithoutTree(samples) : return [s for s in samples if s.hasInputHftTree(msg='Warning! ')]
-    def dropGroupsWithoutSamples(groups) : return dict((g, samples) for g, samples in groups.iteritems() if len(samples))
-    samplesPerGroup = dropIrrelevantGroupsForThisSys(samplesPerGroup, syst)
-    samplesPerGroup = dict((g, dropSamplesWithoutTree(samples)) for g, samples in samplesPerGroup.iteritems())
-    samplesPerGroup = dropGroupsWithoutSamples(samplesPerGroup)
+    samplesPerGroup = dropIrrelevantGroupsForSys(samplesPerGroup, syst, verbose)
+    samplesPerGroup = dropSamplesWithoutTree(samplesPerGroup)
 
     groups = samplesPerGroup.keys()
     counters = bookCounters(groups, selections)
-    histos = bookHistos(variables, groups, selections)
+    histos = bookHistoBank(variables, groups, selections) if columnar else bookHistos(variables, groups, selections)
+    fill = fillAndCountColumnar if columnar else fillAndCount
+    if verbose and columnar : print compiledSelectionFormulas().summary()
     for group, samplesGroup in samplesPerGroup.iteritems() :
         logLine = "---->"
         if verbose : print 1*' ',group
@@ -245,11 +442,61 @@ def countAndFillHistos(samplesPerGroup={}, syst='', verbose=False, outdir='./')
         countsGroup = counters[group]
         for sample in samplesGroup :
             if verbose : logLine +=" %s"%sample.name
-            fillAndCount(histosGroup, countsGroup, sample, blind=False)
+            fill(histosGroup, countsGroup, sample, blind=False)
+        if verbose : print logLine
+    if verbose : print 'done'
+    return counters, histos
+
+def countAndFillHistosMultiWeight(samplesPerGroup={}, systs=['NOM'], verbose=False) :
+    """Fill 'NOM' and the mc weight variations in one pass: each
+    nominal tree is read once, and each variation is just a different
+    weight column. Return counters[syst], histos[syst].
+    """
+    weightVariations = systUtils.mcWeightVariations()
+    assert all(s=='NOM' or s in weightVariations for s in systs),"only NOM and weight variations: %s"%str(systs)
+    selections = allRegions()
+    variables = variablesToPlot()
+    samplesPerGroup = dropIrrelevantGroupsForSys(samplesPerGroup, systs, verbose)
+    samplesPerGroup = dropSamplesWithoutTree(samplesPerGroup)
+    systsPerGroup = dict((g, [s for s in systs if groupIsRelevantForSys(g, s)]) for g in samplesPerGroup.keys())
+    counters, histos = dict(), dict()
+    for s in systs :
+        groups = [g for g, ss in systsPerGroup.iteritems() if s in ss]
+        counters[s] = bookCounters(groups, selections)
+        histos[s] = bookHistoBank(variables, groups, selections)
+    for group, samplesGroup in samplesPerGroup.iteritems() :
+        logLine = "---->"
+        if verbose : print 1*' ',group,' : ',', '.join(systsPerGroup[group])
+        histosPerSyst   = dict((s, histos  [s][group]) for s in systsPerGroup[group])
+        countersPerSyst = dict((s, counters[s][group]) for s in systsPerGroup[group])
+        for sample in samplesGroup :
+            if verbose : logLine +=" %s"%sample.name
+            weightLeafnames = dict((s, sample.weightLeafnameForSyst(s)) for s in systsPerGroup[group])
+            fillAndCountColumnarWeights(histosPerSyst, countersPerSyst, sample, weightLeafnames, blind=False)
         if verbose : print logLine
     if verbose : print 'done'
     return counters, histos
 
+def groupIsRelevantForSys(group, sys) :
+    mcGroups, fakeGroups = mcDatasetids().keys(), ['fake']
+    objVariations, weightVariations, fakeVariations = systUtils.mcObjectVariations(), systUtils.mcWeightVariations(), systUtils.fakeSystVariations()
+    return (sys=='NOM'
+            or (group in mcGroups and sys in objVariations+weightVariations)
+            or (group in fakeGroups and sys in fakeVariations))
+def dropIrrelevantGroupsForSys(samplesPerGroup={}, systs=[], verbose=False) :
+    "keep the groups needed for at least one of the systs (can also be a single syst)"
+    systs = [systs] if type(systs) is str else systs
+    def isRelevant(g) :
+        relevant = any(groupIsRelevantForSys(g, s) for s in systs)
+        if verbose and not relevant : print "skipping %s for %s"%(g, ', '.join(systs))
+        return relevant
+    return dict((g, samples) for g, samples in samplesPerGroup.iteritems() if isRelevant(g))
+def dropSamplesWithoutTree(samplesPerGroup={}) :
+    "drop the samples without input tree, and the groups left without samples"
+    samplesPerGroup = dict((g, [s for s in samples if s.hasInputHftTree(msg='Warning! ')])
+                           for g, samples in samplesPerGroup.iteritems())
+    return dict((g, samples) for g, samples in samplesPerGroup.iteritems() if len(samples))
+
 def printCounters(counters):
     countTotalBkg(counters)
     blindGroups   = [g for g in counters.keys() if g!='data']
@@ -319,6 +566,11 @@ class Sample(BaseSampleGroup) :
         super(Sample, self).__init__(name) # this is either the name (for data and fake) or the dsid (for mc)
         self.groupname = groupname
         self.setHftInputDir()
+        self.setEntryRange()
+    def setEntryRange(self, start=0, stop=None) :
+        "process only the entries [start, stop) of the tree; by default all of them"
+        self.entryRange = (start, stop)
+        return self
     def setHftInputDir(self, dir='') :
         useDefaults = not dir
         defaultDir = 'out/fakepred' if self.isFake else 'out/susyplot'
@@ -326,8 +578,10 @@ class Sample(BaseSampleGroup) :
         return self
     @property
     def weightLeafname(self) :
+        return self.weightLeafnameForSyst(self.syst if self.isWeightSys else 'NOM')
+    def weightLeafnameForSyst(self, sys='NOM') :
         leafname = 'eventweight'
-        if  self.isWeightSys : leafname += " * %s"%systUtils.mcWeightBranchname(self.syst)
+        if sys in systUtils.mcWeightVariations() : leafname += " * %s"%systUtils.mcWeightBranchname(sys)
         return leafname
     @property
     def filenameHftTree(self) :
@@ -361,6 +615,13 @@ class Sample(BaseSampleGroup) :
                 else : print msg+"%s %s missing tree '%s' from %s"%(self.groupname, self.name, treename, filename)
             inputFile.Close()
         return treeIsThere
+    @property
+    def nEntries(self) :
+        inputFile = r.TFile.Open(self.filenameHftTree)
+        tree = inputFile.Get(self.hftTreename) if inputFile else None
+        nEntries = tree.GetEntries() if tree else 0
+        if inputFile : inputFile.Close()
+        return nEntries
     def group(self) :
         return Group(self.groupname).setSyst(self.syst)
 #___________________________________________________________
@@ -370,17 +631,32 @@ class Group(BaseSampleGroup) :
         self.setSyst()
         self.setHistosDir()
         self._histoCache = collections.defaultdict(dict) # [syst][histoname]
+        self.histoStore = None
+        self.consolidated = False
     def setHistosDir(self, dir='') :
         self.histosDir = dir if dir else 'out/hft'
         return self
+    def setConsolidated(self, consolidated=True) :
+        "read/write all the systematics from/to one file, one directory per syst"
+        self.consolidated = consolidated
+        return self
+    @property
+    def histoDirectory(self) :
+        "directory of the current syst within filenameHisto ('' when not consolidated)"
+        return self.syst if self.consolidated else ''
     @property
     def filenameHisto(self) :
         "file containig the histograms for the current syst"
+        if self.consolidated : return "%(dir)s/%(gr)s_allsyst.root" % {'dir':self.histosDir, 'gr':self.name}
         def dataFilename(group, dir, sys) : return "%(dir)s/%(sys)s_%(gr)s.PhysCont.root" % {'dir':dir, 'gr':group, 'sys':sys}
         def fakeFilename(group, dir, sys) : return "%(dir)s/%(sys)s_fake.%(gr)s.PhysCont.root" % {'dir':dir, 'gr':group, 'sys':sys}
         def mcFilename  (group, dir, sys) : return "%(dir)s/%(sys)s_%(gr)s.root" % {'dir':dir, 'sys':sys, 'gr':group}
         fnameFunc = dataFilename if self.isData else fakeFilename if self.isFake else mcFilename
         return fnameFunc(self.name, self.histosDir, self.syst)
+    def setHistoStore(self, store=None) :
+        "read the histograms through a HistogramBankFileStore (shared by all groups) rather than opening the file for each one"
+        self.histoStore = store
+        return self
     def exploreAvailableSystematics(self, verbose=False) :
         systs = ['NOM']
         if self.isFake :
@@ -389,9 +665,10 @@ class Group(BaseSampleGroup) :
             systs += systUtils.mcObjectVariations()
             systs += systUtils.mcWeightVariations()
         self.systematics = []
+        catalog = consolidatedCatalog(self.filenameHisto) if self.consolidated else None
         for sys in systs :
             self.setSyst(sys)
-            if os.path.exists(self.filenameHisto) :
+            if (self.syst in catalog) if self.consolidated else os.path.exists(self.filenameHisto) :
                 self.systematics.append(sys)
         if verbose : print "%s : found %d variations : %s"%(self.name, len(self.systematics), str(self.systematics))
     def filterAndDropSystematics(self, include='.*', exclude=None, verbose=False) :
@@ -408,14 +685,22 @@ class Group(BaseSampleGroup) :
         assert self.systematics.count('NOM')==1 or not nBefore, "%s : 'NOM' required %s"%(self.name, str(self.systematics))
     def getHistogram(self, variable, selection, cacheIt=False) :
         hname = histoName(sample=self.name, selection=selection, variable=variable)
+        if self.histoStore :
+            histo = self.histoStore.histogram(self.filenameHisto, self.name, selection, variable, self.histoDirectory)
+            if not histo : print "%s : cannot get histo %s"%(self.name, hname)
+        else :
+            histo = self.readHistogram(hname, cacheIt)
+        if variable=='onebin' and histo : self.logVariation(self.syst, selection, histo.Integral(0, -1))
+        return histo
+    def readHistogram(self, hname, cacheIt=False) :
+        "get the histogram from the file of the current syst (or from the cache)"
         histo = None
         try :
             histo = self._histoCache[self.syst][hname]
         except KeyError :
             file = r.TFile.Open(self.filenameHisto)
             if not file : print "missing file %s"%self.filenameHisto
-            hname = histoName(sample=self.name, selection=selection, variable=variable)
-            histo = file.Get(hname)
+            histo = file.Get(os.path.join(self.histoDirectory, hname))
             if not histo : print "%s : cannot get histo %s"%(self.name, hname)
             elif cacheIt :
                 histo.SetDirectory(0)
@@ -423,7 +708,6 @@ class Group(BaseSampleGroup) :
             else :
                 histo.SetDirectory(0)
                 file.Close()
-        if variable=='onebin' and histo : self.logVariation(self.syst, selection, histo.Integral(0, -1))
         return histo
     def getBinContents(self, variable, selection) :
         return getBinContents(self.getHistogram)
@@ -478,6 +762,11 @@ def selectionFormulas(sel) :
         formulas['bld'+f] = formulas[f].replace(mlj1, mlj1Not).replace(mlj2, mlj2Not)
     return formulas[sel]
 
+def compileSelectionFormulas() :
+    "all the region selections, compiled into shared atomic predicates; see selectionUtils.SelectionCompiler"
+    return SelectionCompiler([(s, selectionFormulas(s)) for s in allRegions()])
+compiledSelectionFormulas = Memoize(compileSelectionFormulas)
+
 def fillAndCount(histos, counters, sample, blind=True) :
     group    = sample.group
     filename = sample.filenameHftTree
@@ -490,7 +779,11 @@ def fillAndCount(histos, counters, sample, blind=True) :
     l1 = r.TLorentzVector()
     l2 = r.TLorentzVector()
     met = r.TLorentzVector()
-    for iEvent, event in enumerate(tree) :
+    start, stop = sample.entryRange
+    stop = tree.GetEntries() if stop is None else min(stop, tree.GetEntries())
+    for iEvent in xrange(start, stop) :
+        tree.GetEntry(iEvent)
+        event = tree
         weight = weightFormula.EvalInstance()
         passSels = dict((s, selWeights[s].EvalInstance()) for s in selections)
         for sel in selections : counters[sel] += (weight if passSels[sel] else 0.0)
@@ -529,6 +822,90 @@ def fillAndCount(histos, counters, sample, blind=True) :
                 print "ev %d run %d channel %s sel %s sample %s weight %f"%(event.runNumber, event.eventNumber, channel, sel, dataOrFake, weight)
     file.Close()
 
+def hftKinematicBranches() :
+    "branches needed to compute the variables filled in fillAndCount"
+    return ['L2nCentralLightJets', 'mlj', 'mljj',
+            'lept1Pt', 'lept1Eta', 'lept1Phi', 'lept1Flav',
+            'lept2Pt', 'lept2Eta', 'lept2Phi', 'lept2Flav',
+            'met', 'metPhi',
+            'isEE', 'isMUMU', 'runNumber', 'eventNumber']
+def deltaPhi(phi1, phi2) :
+    "vectorized TLorentzVector::DeltaPhi, in [-pi, pi); inputs in [-pi, pi] need at most one shift"
+    pi, twopi = math.pi, 2.0*math.pi
+    dphi = phi1 - phi2
+    return np.where(dphi >= pi, dphi-twopi, np.where(dphi < -pi, dphi+twopi, dphi))
+def computeHftKinematics(columns) :
+    """Vectorized version of the per-event computation in fillAndCount;
+    leptons are massless and in GeV, as they are there"""
+    mev2gev = 1.0e-3
+    c = columns
+    oneJet = c['L2nCentralLightJets']==1
+    pt1, pt2 = mev2gev*c['lept1Pt'], mev2gev*c['lept2Pt']
+    eta1, eta2, phi1, phi2 = c['lept1Eta'], c['lept2Eta'], c['lept1Phi'], c['lept2Phi']
+    px = pt1*np.cos(phi1) + pt2*np.cos(phi2)
+    py = pt1*np.sin(phi1) + pt2*np.sin(phi2)
+    pz = pt1*np.sinh(eta1) + pt2*np.sinh(eta2)
+    e  = pt1*np.cosh(eta1) + pt2*np.cosh(eta2)
+    m2 = e*e - (px*px + py*py + pz*pz)
+    l1IsMu, l2IsMu = c['lept1Flav']==1, c['lept2Flav']==1
+    dphil1met = np.abs(deltaPhi(phi1, c['metPhi']))
+    dphil2met = np.abs(deltaPhi(phi2, c['metPhi']))
+    return {'mljj'      : mev2gev*np.where(oneJet, c['mlj'], c['mljj']),
+            'ptll'      : np.sqrt(px*px + py*py),
+            'mll'       : np.where(m2<0.0, -np.sqrt(np.abs(m2)), np.sqrt(np.abs(m2))), # as TLorentzVector::M
+            'onebin'    : np.ones(len(pt1)),
+            'dphil0met' : np.where(pt1>pt2, dphil1met, dphil2met),
+            'dphimumet' : np.where(l1IsMu, dphil1met, dphil2met),
+            'hasMu'     : l1IsMu | l2IsMu,
+            }
+def fillAndCountColumnar(histos, counters, sample, blind=True) :
+    """Same as fillAndCount, but read the tree in bulk, evaluate the
+    selections as boolean masks, and fill with weighted bincounts"""
+    fillAndCountColumnarWeights({'' : histos}, {'' : counters}, sample, {'' : sample.weightLeafname}, blind)
+def fillAndCountColumnarWeights(histosPerWeight={}, countersPerWeight={}, sample=None, weightLeafnames={}, blind=True) :
+    """Columnar fill of several sets of histos (HistogramBank rows)
+    and counters[sel] in one pass over the tree, one set for each weight
+    expression. The weights are treated as an (entries x weights) matrix.
+    """
+    keys = sorted(weightLeafnames.keys())
+    filename = sample.filenameHftTree
+    treename = sample.hftTreename
+    file = r.TFile.Open(filename)
+    tree = file.Get(treename)
+    selections = allRegions()
+    compiledSels = compiledSelectionFormulas()
+    weightFormulas = [parseFormula(weightLeafnames[k]) for k in keys]
+    branches = set(hftKinematicBranches()) | compiledSels.variables
+    branches = branches.union(*[formulaVariables(f) for f in weightFormulas])
+    start, stop = sample.entryRange
+    columns = treeToArrays(tree, sorted(branches), start, stop)
+    file.Close()
+    nEntries = len(columns['lept1Pt'])
+    weights = np.column_stack([evaluateFormula(f, columns, nEntries) for f in weightFormulas])
+    passSels = compiledSels.regionMasks(compiledSels.regionBitmask(columns, nEntries))
+    kin = computeHftKinematics(columns)
+    for sel in selections :
+        sumWeights = weights[passSels[sel]].sum(axis=0)
+        for k, key in enumerate(keys) : countersPerWeight[key][sel] += sumWeights[k]
+    for sel in selections :
+        fillMask = passSels[sel]
+        if blind and sample.isData :
+            if sel in signalRegions() : fillMask = np.zeros(nEntries, dtype=bool)
+            else : fillMask = passSels[blindRegionFromAnyRegion(sel)] & ~passSels[signalRegionFromAnyRegion(sel)]
+        rows = [histosPerWeight[k] for k in keys]
+        for var in ['mll', 'mljj', 'ptll', 'onebin', 'dphil0met'] :
+            fillRowsWithWeightMatrix(rows, sel, var, kin[var][fillMask], weights[fillMask])
+        muMask = fillMask & kin['hasMu']
+        fillRowsWithWeightMatrix(rows, sel, 'dphimumet', kin['dphimumet'][muMask], weights[muMask])
+        # checks
+        if (sel in signalRegions()
+            and (sample.isData or sample.isFake)) :
+            dataOrFake = 'data' if sample.isData else 'fake' if sample.isFake else 'other'
+            for i in np.nonzero(fillMask)[0] :
+                channel = 'ee' if columns['isEE'][i] else 'mm' if columns['isMUMU'][i] else 'em'
+                print "ev %d run %d channel %s sel %s sample %s weight %f"%(columns['runNumber'][i], columns['eventNumber'][i],
+                                                                            channel, sel, dataOrFake, weights[i, 0])
+
 def dataSampleNames() :
     return ["period%(period)s.physics_%(stream)s"%{'period':p, 'stream':s}
             for p in ['A','B','C','D','E','G','H','I','J','L']
@@ -588,37 +965,44 @@ def variablesToPlot() :
     return ['pt0','pt1','mll','mtmin','mtmax','mtllmet','ht','metrel','dphill','detall',
             'mt2j','mljj','dphijj','detajj']
 def histoName(sample, selection, variable) : return "h_%s_%s_%s"%(variable, sample, selection)
+def histoBinning(variable, selection) :
+    "(title, nBins, xMin, xMax) of the histogram of a variable"
+    v, sel = variable, selection
+    twopi = +2.0*math.pi
+    mljjLab = 'm_{lj}' if '1j' in sel else 'm_{ljj}'
+    if   v=='onebin'   : return (';; entries',                                 1, 0.5,   1.5)
+    elif v=='pt0'      : return (';p_{T,l0} [GeV]; entries/bin',              12, 0.0, 240.0)
+    elif v=='pt1'      : return (';p_{T,l1} [GeV]; entries/bin',              12, 0.0, 240.0)
+    elif v=='mll'      : return (';m_{l0,l1} [GeV]; entries/bin',             12, 0.0, 240.0)
+    elif v=='ptll'     : return (';p_{T,l0+l1} [GeV]; entries/bin',           12, 0.0, 240.0)
+    elif v=='mtmin'    : return (';m_{T,min}(l, MET) [GeV]; entries/bin',     12, 0.0, 360.0)
+    elif v=='mtmax'    : return (';m_{T,max}(l, MET) [GeV]; entries/bin',     12, 0.0, 360.0)
+    elif v=='mtllmet'  : return (';m_{T}(l+l, MET) [GeV]; entries/bin',       12, 0.0, 600.0)
+    elif v=='ht'       : return (';H_{T} [GeV]; entries/bin',                 12, 0.0, 600.0)
+    elif v=='metrel'   : return (';MET_{rel} [GeV]; entries/bin',             12, 0.0, 360.0)
+    elif v=='dphill'   : return (';#Delta#phi(l, l) [rad]; entries/bin',      10, 0.0, twopi)
+    elif v=='detall'   : return (';#Delta#eta(l, l); entries/bin',            10, 0.0, +3.0 )
+    elif v=='dphil0met': return (';#Delta#phi(l0, met) [rad]; entries/bin',   10, 0.0, twopi)
+    elif v=='dphimumet': return (';#Delta#phi(#mu, met) [rad]; entries/bin',  10, 0.0, twopi)
+    elif v=='mt2j'     : return (';m^{J}_{T2} [GeV]; entries/bin',            12, 0.0, 480.0)
+    elif v=='mljj'     : return (';'+mljjLab+' [GeV]; entries/30GeV',         12, 0.0, 480.0)
+    elif v=='dphijj'   : return (';#Delta#phi(j, j) [rad]; entries/bin',      10, 0.0, twopi)
+    elif v=='detajj'   : return (';#Delta#eta(j, j); entries/bin',            10, 0.0, +3.0 )
+    else : print "unknown variable %s"%v
 def bookHistos(variables, samples, selections) :
     "book a dict of histograms with keys [sample][selection][var]"
     def histo(variable, sam, sel) :
-        twopi = +2.0*math.pi
-        mljjLab = 'm_{lj}' if '1j' in sel else 'm_{ljj}'
-        h = None
-        if   v=='onebin'  : h = r.TH1F(histoName(sam, sel, 'onebin' ), ';; entries',                             1, 0.5,   1.5)
-        elif v=='pt0'     : h = r.TH1F(histoName(sam, sel, 'pt0'    ), ';p_{T,l0} [GeV]; entries/bin',          12, 0.0, 240.0)
-        elif v=='pt1'     : h = r.TH1F(histoName(sam, sel, 'pt1'    ), ';p_{T,l1} [GeV]; entries/bin',          12, 0.0, 240.0)
-        elif v=='mll'     : h = r.TH1F(histoName(sam, sel, 'mll'    ), ';m_{l0,l1} [GeV]; entries/bin',         12, 0.0, 240.0)
-        elif v=='ptll'    : h = r.TH1F(histoName(sam, sel, 'ptll'   ), ';p_{T,l0+l1} [GeV]; entries/bin',       12, 0.0, 240.0)
-        elif v=='mtmin'   : h = r.TH1F(histoName(sam, sel, 'mtmin'  ), ';m_{T,min}(l, MET) [GeV]; entries/bin', 12, 0.0, 360.0)
-        elif v=='mtmax'   : h = r.TH1F(histoName(sam, sel, 'mtmax'  ), ';m_{T,max}(l, MET) [GeV]; entries/bin', 12, 0.0, 360.0)
-        elif v=='mtllmet' : h = r.TH1F(histoName(sam, sel, 'mtllmet'), ';m_{T}(l+l, MET) [GeV]; entries/bin',   12, 0.0, 600.0)
-        elif v=='ht'      : h = r.TH1F(histoName(sam, sel, 'ht'     ), ';H_{T} [GeV]; entries/bin',             12, 0.0, 600.0)
-        elif v=='metrel'  : h = r.TH1F(histoName(sam, sel, 'metrel' ), ';MET_{rel} [GeV]; entries/bin',         12, 0.0, 360.0)
-        elif v=='dphill'  : h = r.TH1F(histoName(sam, sel, 'dphill' ), ';#Delta#phi(l, l) [rad]; entries/bin',  10, 0.0, twopi)
-        elif v=='detall'  : h = r.TH1F(histoName(sam, sel, 'detall' ), ';#Delta#eta(l, l); entries/bin',        10, 0.0, +3.0 )
-        elif v=='dphil0met': h= r.TH1F(histoName(sam, sel, 'dphil0met'),';#Delta#phi(l0, met) [rad]; entries/bin',  10, 0.0, twopi)
-        elif v=='dphimumet': h= r.TH1F(histoName(sam, sel, 'dphimumet'),';#Delta#phi(#mu, met) [rad]; entries/bin', 10, 0.0, twopi)
-        elif v=='mt2j'    : h = r.TH1F(histoName(sam, sel, 'mt2j'   ), ';m^{J}_{T2} [GeV]; entries/bin',        12, 0.0, 480.0)
-        elif v=='mljj'    : h = r.TH1F(histoName(sam, sel, 'mljj'   ), ';'+mljjLab+' [GeV]; entries/30GeV',     12, 0.0, 480.0)
-        elif v=='dphijj'  : h = r.TH1F(histoName(sam, sel, 'dphijj' ), ';#Delta#phi(j, j) [rad]; entries/bin',  10, 0.0, twopi)
-        elif v=='detajj'  : h = r.TH1F(histoName(sam, sel, 'detajj' ), ';#Delta#eta(j, j); entries/bin',        10, 0.0, +3.0 )
-        else : print "unknown variable %s"%v
+        title, nBins, xMin, xMax = histoBinning(variable, sel)
+        h = r.TH1F(histoName(sam, sel, variable), title, nBins, xMin, xMax)
         h.Sumw2()
         h.SetDirectory(0)
         return h
     return dict([(sam, dict([(sel, dict([(v, histo(v, sam, sel)) for v in variables]))
                          for sel in selections]))
                  for sam in samples])
+def bookHistoBank(variables, samples, selections) :
+    "same as bookHistos, but with all the bins in one HistogramBank; the TH1F are created when saving"
+    return HistogramBank(samples, selections, variables, histoBinning)
 def bookCounters(samples, selections) :
     "book a dict of counters with keys [sample][selection]"
     return dict((s, dict((sel, 0.0) for sel in selections)) for s in samples)
@@ -712,13 +1096,35 @@ def plotHistos(histoData=None, histoSignal=None, histoTotBkg=None, histosBkg={},
     can.Update() # force stack to create padMaster
     for ext in ['png','eps'] : can.SaveAs(outdir+'/'+can.GetName()+'.'+ext)
 
+def consolidatedCatalog(filename) :
+    "the systematics available in a consolidated file, i.e. its directories"
+    if not os.path.exists(filename) : return []
+    file = r.TFile.Open(filename)
+    systs = [k.GetName() for k in file.GetListOfKeys() if k.GetClassName().startswith('TDirectory')] if file else []
+    if file : file.Close()
+    return systs
 def listExistingSyst(dir) :
     print "listing systematics from ",dir
-    print "...not implemented..."
-def saveHistos(samplesPerGroup={}, histosPerGroup={}, outdir='./', verbose=False) :
+    filenames = sorted(f for f in os.listdir(dir) if f.endswith('_allsyst.root'))
+    if not filenames : print "...not implemented (only for --consolidated files)..."
+    return '\n'.join("%s : %s"%(f, ' '.join(consolidatedCatalog(os.path.join(dir, f)))) for f in filenames)
+def saveHistos(samplesPerGroup={}, histosPerGroup={}, outdir='./', verbose=False, consolidated=False) :
+    """histosPerGroup[group][sel][var], or a HistogramBank that is converted to TH1F here.
+    With consolidated, the histograms of each group are written to the
+    directory of the current syst in the group file, replacing it if it exists."""
+    if isHistogramBank(histosPerGroup) : histosPerGroup = histosPerGroup.toHistos()
     for groupname, histos in histosPerGroup.iteritems() :
-        group = first(samplesPerGroup[groupname]).group().setHistosDir(outdir)
+        group = first(samplesPerGroup[groupname]).group().setHistosDir(outdir).setConsolidated(consolidated)
         outFilename = group.filenameHisto
+        if consolidated :
+            if verbose : print "writing %s to %s"%(group.histoDirectory, outFilename)
+            file = r.TFile.Open(outFilename, 'update')
+            file.Delete(group.histoDirectory+';*')
+            file.mkdir(group.histoDirectory).cd()
+            for sel, histosSel in histos.iteritems() :
+                for var, h in histosSel.iteritems() : h.Write()
+            file.Close()
+            continue
         if verbose : print "creating file %s"%outFilename
         file = r.TFile.Open(outFilename, 'recreate')
         file.cd()
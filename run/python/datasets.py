@@ -6,10 +6,14 @@
 # see the Dataset class for more info on their attributes.
 # Datasets can also be defined without being used; search for
 # 'placeholder' to see the disabled samples.
+# The module-level 'registry' indexes all of them by name, dsid, group,
+# and type (see DatasetRegistry).
 #
 # davide.gerbaudo@gmail.com
 # Jan 2013
 
+import collections
+import re
 import unittest
 
 def rzip(*iterables) :
@@ -20,9 +24,10 @@ def rzip(*iterables) :
            "%s"%'\n'.join(["[%d] : %s"%(len(l), str(l)) for l in iterables])
     return zip(*iterables)
 
-class Dataset :
+class Dataset(object) :
     """Container to uniquely specify a dataset (through a dsid), and
     specify additional user-friendly attributes"""
+    __slots__ = ('type', 'dsid', 'group', 'name', 'process', 'placeholder') # there are a few thousands of them
     def __init__(self, sampleType, dsid=None, group=None, name=None, process=None, placeholder=False) :
         assert sampleType in ['data','mc'], "sampleType: %s for %s"%(sampleType, name)
         self.type = sampleType # data or mc
@@ -47,14 +52,53 @@ class Dataset :
         "not written in stone (include higgs?), but that's what we need for the fake estimate"
         return self.type is 'mc' and not self.isSignalOrHiggs
 
-def allGroups(datasets=[]) : return list(set(d.group for d in datasets))
-def allDatasets(datasets=[]) : return list(set(d.name for d in datasets))
+def allGroups(datasets=[]) :
+    if isinstance(datasets, DatasetRegistry) : return list(datasets.groups)
+    return list(set(d.group for d in datasets))
+def allDatasets(datasets=[]) :
+    if isinstance(datasets, DatasetRegistry) : return list(datasets.names)
+    return list(set(d.name for d in datasets))
 def activeDatasets(datasets=[]) : return filter(lambda d : not d.placeholder, datasets)
 def setSameGroupForAllData(datasets=[], group='data') :
     for d in datasets :
         if d.type is 'data' : d.group = group
+    if isinstance(datasets, DatasetRegistry) : datasets.reindex()
     return datasets
 
+class DatasetRegistry(object) :
+    """The datasets indexed by name, dsid, group, and type; iterating
+    over it gives the datasets in their definition order.
+    Call reindex() after modifying the datasets (e.g. their group)."""
+    nameSeparators = re.compile('[_.]')
+    def __init__(self, datasets=[]) :
+        self.datasets = list(datasets)
+        self.reindex()
+    def reindex(self) :
+        self.byName, self.byDsid = dict(), dict()
+        self.byGroup, self.byType = collections.defaultdict(list), collections.defaultdict(list)
+        for d in self.datasets :
+            self.byName.setdefault(d.name, d) # first definition wins, as in a linear search
+            if d.dsid is not None : self.byDsid.setdefault(d.dsid, d)
+            self.byGroup[d.group].append(d)
+            self.byType[d.type].append(d)
+        self.groups = frozenset(self.byGroup.keys())
+        self.names = frozenset(self.byName.keys())
+        return self
+    def __iter__(self) : return iter(self.datasets)
+    def __len__(self) : return len(self.datasets)
+    def active(self) : return DatasetRegistry(activeDatasets(self.datasets))
+    def withName(self, name) : return self.byName.get(name)
+    def withDsid(self, dsid) : return self.byDsid.get(dsid)
+    def inGroup(self, group) : return self.byGroup.get(group, [])
+    def ofType(self, sampleType) : return self.byType.get(sampleType, [])
+    def longestNameIn(self, filename='') :
+        """Longest dataset name found in filename with a '_' or '.' on
+        both sides; same as a regexp search with each name, but with
+        one dict lookup for each pair of separators"""
+        seps = [m.start() for m in DatasetRegistry.nameSeparators.finditer(filename)]
+        names = [filename[i+1:j] for k, i in enumerate(seps) for j in seps[k+1:]]
+        return max([n for n in names if n in self.byName] or [None], key=lambda n : len(n) if n else 0)
+
 datasets = []
 sampleType, group, process = None, None, None
 placeholder = True
@@ -369,6 +413,8 @@ datasets += [Dataset(sampleType, dsid, groupTemplate%(p1, p2), template%(p1, p2)
                                              for p1 in ['100', '150', '200', '250', '300', '350', '3E3', '400', '450', '500']
                                              for p2 in ['100', '150', '200', '250', '300', '350', '3E3', '400', '450', '500']])]
 
+registry = DatasetRegistry(datasets)
+
 #
 # testing
 #
@@ -401,6 +447,17 @@ class CategorizationTest(unittest.TestCase) :
                              +', '.join(["%s : %s"%(k, eval(k))
                                          for k in ['isSignal', 'notData', 'notBkg', 'notHf']]))
 
+class RegistryTest(unittest.TestCase) :
+    def testLookupsMatchLinearSearch(self) :
+        for d in datasets[::50] :
+            self.assertIs(registry.withName(d.name), next(x for x in datasets if x.name==d.name))
+            if d.dsid : self.assertIs(registry.withDsid(d.dsid), next(x for x in datasets if x.dsid==d.dsid))
+            self.assertEqual(registry.inGroup(d.group), [x for x in datasets if x.group==d.group])
+        self.assertEqual(sorted(allGroups(registry)), sorted(allGroups(datasets)))
+        name = datasets[-1].name
+        self.assertEqual(registry.longestNameIn('out/mc12_8TeV.186099.'+name+'_Apr_10.root'), name)
+        self.assertEqual(registry.longestNameIn('unknown_sample.root'), None)
+
 if __name__=='__main__' :
     def filterByGroup(dsets) :
         groups = sorted(d.group for d in dsets)
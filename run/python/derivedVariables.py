@@ -0,0 +1,177 @@
+# Compute the per-event variables derived from the SusySel trees
+# (pt0, mll, mtmax, mt2j, ...) and cache them on disk, one .npy file
+# per variable, so that they can be memory-mapped by the scripts that
+# need them (optimizeSelection, writeTrainingTree, ...).
+#
+# The cache entry is keyed by the input file identity (path, size,
+# mtime), by the tree name, and by the code version (a hash of the
+# source of this module and of kin.py), so that a stale entry is never
+# read: modifying the input or the code just leads to a new entry.
+#
+# davide.gerbaudo@gmail.com
+# April 2014
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from kin import (phi_mpi_pi_array,
+                 TlvArray,
+                 LeptonArray,
+                 JaggedTlvArray,
+                 computeMtArray,
+                 computeHtArray,
+                 computeMetRelArray,
+                 computeMljArray,
+                 computeMljjArray,
+                 computeMt2jArray,
+                 massBestZcandidateArray)
+from rootUtils import importRoot
+r = importRoot()
+from utils import Memoize, mkdirIfNeeded, sourceDigest
+
+defaultCacheDir = '/tmp/derived_variables'
+dilepTypes = ['ee', 'em', 'mm'] # index stored in the 'dilepType' column (-1 for anything else)
+variableNames = ['pt0', 'pt1', 'mll', 'mtmin', 'mtmax', 'mtllmet', 'ht', 'metrel', 'dphill', 'detall',
+                 'mlj', 'mt2j', 'mljj', 'dphijj', 'detajj',
+                 'mZcand', 'dilepType', 'nJets', 'weight']
+
+def codeVersion() :
+    "hash of the source files that determine the values of the cached variables"
+    return sourceDigest([__file__, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kin.py')])
+codeVersion = Memoize(codeVersion)
+
+def cacheKey(filename, treename='SusySel') :
+    "identity of the input file + tree + code version"
+    stat = os.stat(filename)
+    identity = '|'.join([os.path.abspath(filename), str(stat.st_size), str(stat.st_mtime), treename, codeVersion()])
+    return hashlib.sha1(identity).hexdigest()
+
+def cacheEntryDir(filename, treename='SusySel', cacheDir=defaultCacheDir) :
+    return os.path.join(cacheDir, os.path.splitext(os.path.basename(filename))[0]+'_'+cacheKey(filename, treename))
+
+def derivedVariables(filename, treename='SusySel', cacheDir=defaultCacheDir, verbose=False) :
+    """Return a dict[variable] of arrays (memory-mapped, read-only) for
+    the events of the input file; compute and store them if they are
+    not in the cache yet. With cacheDir=None, just compute them."""
+    if not cacheDir : return computeDerivedVariablesFromFile(filename, treename)
+    entryDir = cacheEntryDir(filename, treename, cacheDir)
+    if not os.path.isdir(entryDir) :
+        if verbose : print "caching the derived variables of %s in %s"%(filename, entryDir)
+        writeCacheEntry(entryDir, computeDerivedVariablesFromFile(filename, treename))
+    elif verbose : print "reading the derived variables of %s from %s"%(filename, entryDir)
+    return readCacheEntry(entryDir)
+
+def writeCacheEntry(entryDir, columns) :
+    "write to a temporary directory and rename it, so that an existing entry is always complete"
+    parentDir = os.path.dirname(entryDir)
+    mkdirIfNeeded(parentDir)
+    tmpDir = tempfile.mkdtemp(dir=parentDir, prefix='.tmp_')
+    for v, values in columns.iteritems() : np.save(os.path.join(tmpDir, v+'.npy'), values)
+    try :
+        os.rename(tmpDir, entryDir)
+    except OSError : # written in the meantime by another process
+        shutil.rmtree(tmpDir)
+
+def readCacheEntry(entryDir) :
+    return dict((v, np.load(os.path.join(entryDir, v+'.npy'), mmap_mode='r')) for v in variableNames)
+
+def computeDerivedVariablesFromFile(filename, treename='SusySel') :
+    file = r.TFile.Open(filename)
+    tree = file.Get(treename)
+    columns = computeDerivedVariables(*readEventObjects(tree))
+    file.Close()
+    return columns
+
+def readEventObjects(tree) :
+    """Read the susy::wh::FourMom objects from the tree; return l0, l1
+    (LeptonArray), met (TlvArray), jets, lepts (JaggedTlvArray), weight.
+    The values must be copied event by event, because the tree reuses
+    the same objects at each entry."""
+    p4Attrs, lepAttrs = ['px', 'py', 'pz', 'E'], ['px', 'py', 'pz', 'E', 'isEl', 'isMu', 'charge']
+    l0s, l1s, mets, jets, lepts, nJets, nLepts, weights = [], [], [], [], [], [], [], []
+    for event in tree :
+        l0s.append([getattr(event.l0, a) for a in lepAttrs])
+        l1s.append([getattr(event.l1, a) for a in lepAttrs])
+        mets.append([getattr(event.met, a) for a in p4Attrs])
+        eventJets, eventLepts = [[getattr(j, a) for a in p4Attrs] for j in event.jets], [[getattr(l, a) for a in lepAttrs] for l in event.lepts]
+        jets += eventJets
+        lepts += eventLepts
+        nJets.append(len(eventJets))
+        nLepts.append(len(eventLepts))
+        weights.append(event.pars.weight)
+    def columns(values, nColumns) : return np.array(values, dtype=np.float64).reshape(len(values), nColumns).T
+    l0, l1 = LeptonArray(*columns(l0s, len(lepAttrs))), LeptonArray(*columns(l1s, len(lepAttrs)))
+    met = TlvArray(*columns(mets, len(p4Attrs)))
+    jets = JaggedTlvArray(nJets, TlvArray(*columns(jets, len(p4Attrs))))
+    lepts = JaggedTlvArray(nLepts, LeptonArray(*columns(lepts, len(lepAttrs))))
+    return l0, l1, met, jets, lepts, np.array(weights, dtype=np.float64)
+
+def computeDerivedVariables(l0, l1, met, jets, lepts, weight) :
+    "vectorized version of the per-event computations done in optimizeSelection and writeTrainingTree"
+    nJets = jets.counts
+    j0, j1 = jets.nth(0), jets.nth(1)
+    mt0, mt1 = computeMtArray(l0, met), computeMtArray(l1, met)
+    v = dict()
+    v['pt0'], v['pt1'] = l0.Pt(), l1.Pt()
+    v['mll'] = (l0+l1).M()
+    v['mtmin'], v['mtmax'] = np.minimum(mt0, mt1), np.maximum(mt0, mt1)
+    v['mtllmet'] = computeMtArray(l0+l1, met)
+    v['ht'] = computeHtArray(met, [l0, l1], jets)
+    v['metrel'] = computeMetRelArray(met, [l0, l1], jets)
+    v['dphill'] = np.abs(phi_mpi_pi_array(l0.DeltaPhi(l1)))
+    v['detall'] = np.abs(l0.Eta() - l1.Eta())
+    ge1j, ge2j = nJets>0, nJets>1
+    v['mlj'] = np.where(ge1j, computeMljArray(l0, l1, j0), 0.0)
+    for var in ['mt2j', 'mljj', 'dphijj', 'detajj'] : v[var] = np.zeros(len(nJets)) # 0.0 when undefined, as in the training trees
+    if ge2j.any() :
+        l0j, l1j, j0j, j1j, metj = l0[ge2j], l1[ge2j], j0[ge2j], j1[ge2j], met[ge2j]
+        v['mt2j'][ge2j] = computeMt2jArray(l0j, l1j, j0j, j1j, metj)
+        v['mljj'][ge2j] = computeMljjArray(l0j, l1j, j0j, j1j)
+        v['dphijj'][ge2j] = np.abs(phi_mpi_pi_array(j0j.DeltaPhi(j1j)))
+        v['detajj'][ge2j] = np.abs(j0j.Eta() - j1j.Eta())
+    v['mZcand'] = massBestZcandidateArray(l0, l1, lepts)
+    v['dilepType'] = dilepTypeCodes(l0, l1)
+    v['nJets'] = nJets.astype(np.int32)
+    v['weight'] = np.asarray(weight, dtype=np.float64)
+    return v
+
+def dilepTypeCodes(l0, l1) :
+    "index in dilepTypes, same as kin.getDilepType (sorted, so 'em' and not 'me')"
+    nEl, nMu = l0.isEl.astype(int) + l1.isEl, (l0.isMu & ~l0.isEl).astype(int) + (l1.isMu & ~l1.isEl)
+    return np.where(nEl==2, 0, np.where((nEl==1) & (nMu==1), 1, np.where(nMu==2, 2, -1))).astype(np.int32)
+
+def mZcandIsInWindow(mZcand, windowHalfwidth=20.0) :
+    "same as kin.thirdLepZcandidateIsInWindow, from the cached 'mZcand'"
+    return np.abs(np.asarray(mZcand) - 91.2) < windowHalfwidth
+
+#
+# testing
+#
+class CacheRoundTrip(unittest.TestCase) :
+    def setUp(self) :
+        self.cacheDir = tempfile.mkdtemp()
+        self.inputFile = os.path.join(self.cacheDir, 'sample_Apr_01.root')
+        open(self.inputFile, 'w').write('dummy')
+    def tearDown(self) :
+        shutil.rmtree(self.cacheDir)
+    def testKeyChangesWithInput(self) :
+        key = cacheKey(self.inputFile)
+        self.assertEqual(key, cacheKey(self.inputFile))
+        open(self.inputFile, 'a').write('more')
+        self.assertNotEqual(key, cacheKey(self.inputFile))
+    def testWriteRead(self) :
+        columns = dict((v, np.arange(10, dtype=np.float64)) for v in variableNames)
+        entryDir = cacheEntryDir(self.inputFile, cacheDir=self.cacheDir)
+        writeCacheEntry(entryDir, columns)
+        writeCacheEntry(entryDir, columns) # second writer: no error, first entry kept
+        values = readCacheEntry(entryDir)
+        self.assertEqual(sorted(values.keys()), sorted(variableNames))
+        self.assertTrue(all((values[v]==columns[v]).all() for v in variableNames))
+        self.assertEqual([d for d in os.listdir(self.cacheDir) if d.startswith('.tmp_')], [])
+
+if __name__ == "__main__":
+    unittest.main()
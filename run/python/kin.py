@@ -7,6 +7,11 @@
 import array
 import math
 import os
+import unittest
+try:
+    import numpy as np
+except ImportError:
+    print "missing numpy: the vectorized functions will not be available"
 
 from rootUtils import importRoot
 r = importRoot()
@@ -20,9 +25,9 @@ except KeyError :
 fabs, cos, sin, pi, sqrt = math.fabs, math.cos, math.sin, math.pi, math.sqrt
 
 def phi_mpi_pi(phi) :
-    pi = math.pi
-    while phi < -pi : phi += pi
-    while phi > +pi : phi -= pi
+    pi, twopi = math.pi, 2.0*math.pi
+    while phi < -pi : phi += twopi
+    while phi > +pi : phi -= twopi
     return phi
 
 tlv = r.TLorentzVector
@@ -89,3 +94,343 @@ def computeMljj(l0, l1, j0, j1) :
 def computeMlj(l0, l1, j) :
     dr0, dr1 = j.DeltaR(l0), j.DeltaR(l1)
     return (j+l0).M() if dr0<dr1 else (j+l1).M()
+
+#___________________________________________________________
+# Vectorized versions of the functions above: each array element is
+# one event, and the numbers are the same as the ones from the
+# corresponding TLorentzVector functions.
+
+def phi_mpi_pi_array(phi) :
+    "same as phi_mpi_pi, for an array of angles"
+    pi, twopi = math.pi, 2.0*math.pi
+    phi = np.asarray(phi, dtype=np.float64)
+    return np.where(phi < -pi, phi + twopi*np.ceil((-pi-phi)/twopi),
+                    np.where(phi > +pi, phi - twopi*np.ceil((phi-pi)/twopi), phi))
+
+class TlvArray(object) :
+    """Arrays of px, py, pz, E behaving like a TLorentzVector with one
+    element per event (same method names, as far as we need them)"""
+    def __init__(self, px=[], py=[], pz=[], E=[]) :
+        self.px, self.py, self.pz, self.E = [np.asarray(v, dtype=np.float64) for v in [px, py, pz, E]]
+    @classmethod
+    def fromPtEtaPhiE(cls, pt, eta, phi, E) :
+        pt = np.asarray(pt, dtype=np.float64)
+        return cls(pt*np.cos(phi), pt*np.sin(phi), pt*np.sinh(eta), E)
+    @classmethod
+    def fromPtEtaPhiM(cls, pt, eta, phi, m) :
+        pt = np.asarray(pt, dtype=np.float64)
+        px, py, pz = pt*np.cos(phi), pt*np.sin(phi), pt*np.sinh(eta)
+        return cls(px, py, pz, np.sqrt(px*px + py*py + pz*pz + np.asarray(m)*m))
+    @classmethod
+    def fromFourMoms(cls, fms=[]) :
+        "from a list of susy::wh::FourMom (or anything with px, py, pz, E)"
+        return cls(*[np.array([getattr(fm, a) for fm in fms], dtype=np.float64) for a in ['px', 'py', 'pz', 'E']])
+    def __len__(self) : return len(self.px)
+    def __getitem__(self, indices) : return TlvArray(self.px[indices], self.py[indices], self.pz[indices], self.E[indices])
+    def __add__(self, other) : return TlvArray(self.px+other.px, self.py+other.py, self.pz+other.pz, self.E+other.E)
+    def Pt(self) : return np.sqrt(self.px*self.px + self.py*self.py)
+    def P(self) : return np.sqrt(self.px*self.px + self.py*self.py + self.pz*self.pz)
+    def Phi(self) : return np.arctan2(self.py, self.px)
+    def Eta(self) :
+        "TLorentzVector::PseudoRapidity, including the +/-10e10 convention for pt=0"
+        pt = self.Pt()
+        safePt = np.where(pt>0.0, pt, 1.0)
+        return np.where(pt>0.0, np.arcsinh(self.pz/safePt), np.where(self.pz==0.0, 0.0, np.sign(self.pz)*10e10))
+    def M(self) :
+        mm = self.E*self.E - self.P()**2
+        return np.where(mm<0.0, -np.sqrt(np.abs(mm)), np.sqrt(np.abs(mm)))
+    def Et(self) :
+        pt2, pz = self.px*self.px + self.py*self.py, self.pz
+        return np.where(pt2>0.0, self.E*np.sqrt(pt2/np.where(pt2>0.0, pt2 + pz*pz, 1.0)), 0.0)
+    def DeltaPhi(self, other) : return phi_mpi_pi_array(self.Phi() - other.Phi())
+    def DeltaR(self, other) :
+        deta, dphi = self.Eta() - other.Eta(), self.DeltaPhi(other)
+        return np.sqrt(deta*deta + dphi*dphi)
+
+class LeptonArray(TlvArray) :
+    "TlvArray with the lepton attributes of susy::wh::FourMom (isEl, isMu, charge)"
+    def __init__(self, px=[], py=[], pz=[], E=[], isEl=None, isMu=None, charge=None) :
+        super(LeptonArray, self).__init__(px, py, pz, E)
+        n = len(self.px)
+        self.isEl = np.asarray(isEl, dtype=bool) if isEl is not None else np.zeros(n, dtype=bool)
+        self.isMu = np.asarray(isMu, dtype=bool) if isMu is not None else np.zeros(n, dtype=bool)
+        self.charge = np.asarray(charge, dtype=np.float64) if charge is not None else np.zeros(n)
+    @classmethod
+    def fromFourMoms(cls, fms=[]) :
+        return cls(*[np.array([getattr(fm, a) for fm in fms]) for a in ['px', 'py', 'pz', 'E', 'isEl', 'isMu', 'charge']])
+    def __getitem__(self, indices) :
+        return LeptonArray(self.px[indices], self.py[indices], self.pz[indices], self.E[indices],
+                           self.isEl[indices], self.isMu[indices], self.charge[indices])
+    def flavor(self) :
+        "same as lepFlavor in massBestZcandidate, as codes: 1 el, 2 mu, 0 other"
+        return np.where(self.isEl, 1, np.where(self.isMu, 2, 0))
+
+class JaggedTlvArray(object) :
+    """A variable number of TLorentzVector per event (e.g. the jets):
+    one flat TlvArray, and the number of elements for each event"""
+    def __init__(self, counts=[], flat=None) :
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.flat = flat if flat is not None else TlvArray()
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)]).astype(np.int64)
+        self.parents = np.repeat(np.arange(len(self.counts)), self.counts) # event index of each flat element
+        assert self.offsets[-1]==len(self.flat),"%d elements for counts summing to %d"%(len(self.flat), self.offsets[-1])
+    @classmethod
+    def fromFourMomVectors(cls, fmVectors=[], flatType=TlvArray) :
+        "from a list (one entry per event) of lists of susy::wh::FourMom"
+        return cls([len(v) for v in fmVectors], flatType.fromFourMoms([fm for v in fmVectors for fm in v]))
+    def __len__(self) : return len(self.counts)
+    def sum(self, flatValues) :
+        "per-event sum of one value per element (0.0 for events without elements)"
+        return np.bincount(self.parents, weights=flatValues, minlength=len(self.counts))
+    def min(self, flatValues, initial) :
+        "per-event minimum of one value per element, never above initial"
+        mins = np.full(len(self.counts), initial, dtype=np.float64)
+        np.minimum.at(mins, self.parents, flatValues)
+        return mins
+    def nth(self, n) :
+        "TlvArray with the n-th element of each event (zeros for the events with fewer elements)"
+        has = self.counts > n
+        indices = self.offsets[:-1][has] + n
+        px, py, pz, E = [np.zeros(len(self.counts)) for i in range(4)]
+        for v, fv in zip([px, py, pz, E], [self.flat.px, self.flat.py, self.flat.pz, self.flat.E]) : v[has] = fv[indices]
+        return TlvArray(px, py, pz, E)
+
+def computeMtArray(lep, met) :
+    "same as computeMt, inputs are TlvArray"
+    return np.sqrt(2.0 * lep.Pt() * met.Et() *(1.0-np.cos(lep.DeltaPhi(met))))
+def computeHtArray(met, leptsJets=[], jaggedJets=None) :
+    "same as computeHt; leptsJets are TlvArray, jaggedJets an optional JaggedTlvArray"
+    ht = sum((o.Pt() for o in leptsJets), np.zeros(len(met))) + met.Et()
+    return ht + (jaggedJets.sum(jaggedJets.flat.Pt()) if jaggedJets is not None else 0.0)
+def computeMetRelArray(met, leptsJets=[], jaggedJets=None) :
+    "same as computeMetRel; leptsJets are TlvArray, jaggedJets an optional JaggedTlvArray"
+    minDphi = np.full(len(met), 0.5*math.pi)
+    for o in leptsJets : minDphi = np.minimum(minDphi, np.abs(met.DeltaPhi(o)))
+    if jaggedJets is not None :
+        minDphi = np.minimum(minDphi, jaggedJets.min(np.abs(met[jaggedJets.parents].DeltaPhi(jaggedJets.flat)), 0.5*math.pi))
+    return met.Et()*np.sin(minDphi)
+def computeMljArray(l0, l1, j) :
+    "same as computeMlj, inputs are TlvArray"
+    dr0, dr1 = j.DeltaR(l0), j.DeltaR(l1)
+    return np.where(dr0<dr1, (j+l0).M(), (j+l1).M())
+def computeMljjArray(l0, l1, j0, j1) :
+    "same as computeMljj, inputs are TlvArray"
+    jj = j0+j1
+    dr0, dr1 = jj.DeltaR(l0), jj.DeltaR(l1)
+    return np.where(dr0<dr1, (jj+l0).M(), (jj+l1).M())
+def massBestZcandidateArray(l0, l1, otherLeps) :
+    """same as massBestZcandidate: l0, l1 are LeptonArray, otherLeps a
+    JaggedTlvArray of LeptonArray; 0.0 for the events without candidates"""
+    mZ0, minDr = 91.2, 0.05
+    others, parents = otherLeps.flat, otherLeps.parents
+    separated = (others.DeltaR(l0[parents]) > minDr) & (others.DeltaR(l1[parents]) > minDr)
+    candMasses, candDeltas = [], []
+    for lh in [l0, l1] : # l0 pairs first, as in the scalar version, so that ties are resolved the same way
+        lh = lh[parents]
+        lhFlavor = lh.flavor()
+        isZcand = separated & (lhFlavor>0) & (lhFlavor==others.flavor()) & (lh.charge*others.charge < 0.0)
+        mll = (lh + others).M()
+        candMasses.append(mll)
+        candDeltas.append(np.where(isZcand, np.abs(mll - mZ0), np.inf))
+    masses, deltas = np.concatenate(candMasses), np.concatenate(candDeltas)
+    events = np.concatenate([parents, parents])
+    order = np.lexsort((deltas, events)) # stable: the first of the best candidates, as with sorted()
+    events, masses, deltas = events[order], masses[order], deltas[order]
+    first = np.ones(len(events), dtype=bool)
+    first[1:] = events[1:] != events[:-1]
+    best = np.zeros(len(otherLeps))
+    hasCand = first & np.isfinite(deltas)
+    best[events[hasCand]] = masses[hasCand]
+    return best
+def thirdLepZcandidateIsInWindowArray(l0, l1, otherLeps, windowHalfwidth=20.0) :
+    "same as thirdLepZcandidateIsInWindow, for LeptonArray inputs"
+    mZ0 = 91.2
+    return np.abs(massBestZcandidateArray(l0, l1, otherLeps) - mZ0) < windowHalfwidth
+
+#___________________________________________________________
+# Batched mt2: same algorithm and precision as mt2_bisect (momenta
+# normalized so that the largest energy is 100, bisection on
+# Deltasq=mt2^2-mn^2 until mt2 is known within 100*RELATIVE_PRECISION,
+# massless solver when both masses are small), but the test whether the
+# two ellipses (parabolas if massless) intersect is done on the conic
+# coefficients, so that all the events can be bisected at once.
+MT2_RELATIVE_PRECISION = 0.00001 # as RELATIVE_PRECISION in mt2_bisect.h
+MT2_MIN_MASS = 0.1 # as MIN_MASS in mt2_bisect.h: (normalized) mass^2 below which, on both sides, the visible systems are massless
+MT2_CONTAINED = 0.01 # as in mt2_bisect::mt2_bisect: a is contained in b at the lower bound when their conic is below this
+
+def transverseMassSquared(m, px, py, qx, qy, mn) :
+    "mT^2 of a visible system (m, px, py) and an invisible one (qx, qy, mn)"
+    return m*m + mn*mn + 2.0*(np.sqrt(m*m + px*px + py*py)*np.sqrt(qx*qx + qy*qy + mn*mn) - px*qx - py*qy)
+def mt2Conic(m, px, py, mn, deltasq) :
+    """conic a*x^2 + b*y^2 + 2h*x*y + 2g*x + 2f*y + c <= 0 of the invisible
+    momenta giving mT^2 <= deltasq + mn^2; returns (a, b, h, g, f, c)"""
+    e2, k = m*m + px*px + py*py, 0.5*(deltasq - m*m)
+    return (e2 - px*px, e2 - py*py, -px*py, -k*px, -k*py, e2*mn*mn - k*k)
+def mirrorConic(conic, sx, sy) :
+    "conic in x, given the one in s-x (i.e. from qb to qa=pmiss-qb)"
+    a, b, h, g, f, c = conic
+    return (a, b, h, -(a*sx + h*sy + g), -(h*sx + b*sy + f),
+            a*sx*sx + 2.0*h*sx*sy + b*sy*sy + 2.0*g*sx + 2.0*f*sy + c)
+def evaluateConic(conic, x, y) :
+    a, b, h, g, f, c = conic
+    return a*x*x + b*y*y + 2.0*h*x*y + 2.0*g*x + 2.0*f*y + c
+def ellipsesAreDisjoint(conicA, conicB) :
+    "two (interior-negative) ellipses, or parabolas, are disjoint iff det(lambda*A + B) has two distinct positive roots"
+    def columns(conic) :
+        a, b, h, g, f, c = conic
+        return (a, h, g), (h, b, f), (g, f, c)
+    def cross(u, v) : return (u[1]*v[2] - u[2]*v[1], u[2]*v[0] - u[0]*v[2], u[0]*v[1] - u[1]*v[0])
+    def dot(u, v) : return u[0]*v[0] + u[1]*v[1] + u[2]*v[2]
+    (a0, a1, a2), (b0, b1, b2) = columns(conicA), columns(conicB)
+    a1a2, b1b2, a1b2, b1a2 = cross(a1, a2), cross(b1, b2), cross(a1, b2), cross(b1, a2)
+    c3, c0 = dot(a0, a1a2), dot(b0, b1b2)
+    c2 = dot(b0, a1a2) + dot(a0, b1a2) + dot(a0, a1b2)
+    c1 = dot(a0, b1b2) + dot(b0, a1b2) + dot(b0, b1a2)
+    p, q, s = c2/c3, c1/c3, c0/c3 # lambda^3 + p lambda^2 + q lambda + s
+    discriminant = -27.0*s*s + 18.0*s*p*q + p*p*q*q - 4.0*p*p*p*s - 4.0*q*q*q
+    signChanges = (p<0.0).astype(int) + (p*q<0.0) + (q*s<0.0) # all roots real -> Descartes' count is exact
+    return (discriminant>0.0) & (signChanges==2)
+def mt2Bisect(ma, pax, pay, mb, pbx, pby, pmissx, pmissy, mn=0.0, relativePrecision=MT2_RELATIVE_PRECISION) :
+    "mt2 for arrays of visible systems a, b and missing momentum; mn is the mass of the invisible particles"
+    ma, mb = np.abs(np.asarray(ma, dtype=np.float64)), np.abs(np.asarray(mb, dtype=np.float64))
+    swap = ma < mb # as in mt2_bisect: ma >= mb
+    ma, mb, pax, pbx, pay, pby = [np.where(swap, v1, v0) for v0, v1 in [(ma, mb), (mb, ma), (pax, pbx), (pbx, pax), (pay, pby), (pby, pay)]]
+    scale = np.maximum(np.maximum(np.sqrt(ma*ma + pax*pax + pay*pay), np.sqrt(mb*mb + pbx*pbx + pby*pby)),
+                       np.sqrt(pmissx*pmissx + pmissy*pmissy))/100.0
+    scale = np.where(scale>0.0, scale, 1.0)
+    ma, pax, pay, mb, pbx, pby, pmissx, pmissy = [v/scale for v in [ma, pax, pay, mb, pbx, pby, pmissx, pmissy]]
+    mn = np.abs(mn)/scale*np.ones(len(ma))
+    massless = (ma*ma < MT2_MIN_MASS) & (mb*mb < MT2_MIN_MASS)
+    ma, mb = np.where(massless, 0.0, ma), np.where(massless, 0.0, mb)
+    precision = 100.0*relativePrecision
+    def overlap(i, deltasq) :
+        return ~ellipsesAreDisjoint(mt2Conic(ma[i], pax[i], pay[i], mn[i], deltasq),
+                                    mirrorConic(mt2Conic(mb[i], pbx[i], pby[i], mn[i], deltasq), pmissx[i], pmissy[i]))
+    # lower bound: a at its minimum mT; mt2 is there if a, shrunk to a point, is inside b (massive case), or
+    # if the parabolas already overlap (massless case)
+    low = np.where(massless, precision, ma*(ma + 2.0*mn))
+    a0 = mt2Conic(ma, pax, pay, mn, low)
+    detA0 = np.where(massless, 1.0, a0[0]*a0[1] - a0[2]*a0[2])
+    x0, y0 = (a0[2]*a0[4] - a0[1]*a0[3])/detA0, (a0[2]*a0[3] - a0[0]*a0[4])/detA0
+    eb2 = mb*mb + pbx*pbx + pby*pby
+    contained = evaluateConic(mirrorConic(mt2Conic(mb, pbx, pby, mn, low), pmissx, pmissy), x0, y0) <= MT2_CONTAINED*eb2
+    solved, iMassless = contained, np.where(massless)[0]
+    solved[iMassless] = overlap(iMassless, low[iMassless])
+    # upper bound: best of a few splits of the missing momentum
+    def mtsqMax(qax, qay) :
+        return np.maximum(transverseMassSquared(ma, pax, pay, qax, qay, mn),
+                          transverseMassSquared(mb, pbx, pby, pmissx-qax, pmissy-qay, mn))
+    safeMa, safeMb = np.where(ma>0.0, ma, 1.0), np.where(mb>0.0, mb, 1.0)
+    det = pax*pby - pay*pbx
+    safeDet = np.where(det!=0.0, det, 1.0)
+    t, u = (pmissx*pby - pmissy*pbx)/safeDet, (pax*pmissy - pay*pmissx)/safeDet # pmiss = t*pa + u*pb
+    t = np.where((det!=0.0) & (t>0.0) & (u>0.0), t, 0.0)
+    splits = [(pax*mn/safeMa*(ma>0.0), pay*mn/safeMa*(ma>0.0)), (pmissx - pbx*mn/safeMb*(mb>0.0), pmissy - pby*mn/safeMb*(mb>0.0)),
+              (t*pax, t*pay), (0.5*pmissx, 0.5*pmissy), (0.0*pmissx, 0.0*pmissy), (pmissx, pmissy)]
+    high = np.maximum(np.minimum.reduce([mtsqMax(qx, qy) for qx, qy in splits]) - mn*mn, low)
+    # bisection on mt2, as mt2_bisect: the result is the upper end of the interval for massive
+    # visible systems, the lower end for massless ones
+    lowMt2, highMt2 = np.sqrt(mn*mn + low), np.sqrt(mn*mn + high)
+    active = np.where(~solved & (highMt2 - lowMt2 > precision))[0]
+    while len(active) :
+        i = active
+        mid = 0.5*(highMt2[i] + lowMt2[i])
+        overlapping = overlap(i, mid*mid - mn[i]*mn[i])
+        highMt2[i] = np.where(overlapping, mid, highMt2[i])
+        lowMt2[i] = np.where(overlapping, lowMt2[i], mid)
+        active = i[highMt2[i] - lowMt2[i] > precision]
+    mt2 = np.where(solved, np.where(massless, mn, lowMt2), np.where(massless, lowMt2, highMt2))
+    return mt2*scale
+def computeMt2Array(a, b, met, zeroMass, lspMass) :
+    "same as computeMt2, inputs are TlvArray"
+    ma = np.zeros(len(a)) if zeroMass else a.M()
+    mb = np.zeros(len(b)) if zeroMass else b.M()
+    return mt2Bisect(ma, a.px, a.py, mb, b.px, b.py, met.px, met.py, lspMass)
+def computeMt2jArray(l0, l1, j0, j1, met, zeroMass=False, lspMass=0.0) :
+    "same as computeMt2j, inputs are TlvArray"
+    mt2_00 = computeMt2Array(l0+j0, l1+j1, met, zeroMass, lspMass)
+    mt2_01 = computeMt2Array(l1+j0, l0+j1, met, zeroMass, lspMass)
+    return np.minimum(mt2_00, mt2_01)
+def mt2jScale(l0, l1, j0, j1, met, zeroMass=False) :
+    "largest transverse energy entering computeMt2jArray; the bisection precision is MT2_RELATIVE_PRECISION times this"
+    def et(t) : return t.Pt() if zeroMass else np.sqrt(t.Pt()**2 + t.M()**2)
+    return np.maximum.reduce([et(l0+j0), et(l1+j1), et(l1+j0), et(l0+j1), met.Pt()])
+#
+# testing
+#
+class ArrayVsScalar(unittest.TestCase) :
+    "the vectorized functions should give the same numbers as the TLorentzVector ones"
+    def setUp(self) :
+        rnd = np.random.RandomState(12345)
+        n = 100
+        def randomTlv(ptMax, m) :
+            return TlvArray.fromPtEtaPhiM(rnd.uniform(5.0, ptMax, n), rnd.uniform(-2.5, 2.5, n), rnd.uniform(-math.pi, math.pi, n), m*np.ones(n))
+        self.l0, self.l1, self.j0, self.j1 = randomTlv(200.0, 0.1), randomTlv(100.0, 0.1), randomTlv(300.0, 10.0), randomTlv(100.0, 5.0)
+        self.met = TlvArray.fromPtEtaPhiM(rnd.uniform(0.0, 200.0, n), np.zeros(n), rnd.uniform(-math.pi, math.pi, n), np.zeros(n))
+        self.nJets = rnd.randint(0, 4, n)
+        self.jets = JaggedTlvArray(self.nJets, randomTlv(100.0, 5.0)[rnd.randint(0, n, self.nJets.sum())])
+    def toTlvs(self, ta) :
+        tlvs = []
+        for px, py, pz, E in zip(ta.px, ta.py, ta.pz, ta.E) :
+            l = tlv()
+            l.SetPxPyPzE(px, py, pz, E)
+            tlvs.append(l)
+        return tlvs
+    def testKnownFunctions(self) :
+        l0s, l1s, j0s, j1s, mets = [self.toTlvs(v) for v in [self.l0, self.l1, self.j0, self.j1, self.met]]
+        jets = self.toTlvs(self.jets.flat)
+        jetsPerEvent = [jets[o:o+c] for o, c in zip(self.jets.offsets[:-1], self.jets.counts)]
+        for values, expected in [(computeMtArray(self.l0, self.met),       [computeMt(l, m) for l, m in zip(l0s, mets)]),
+                                 (computeMljArray(self.l0, self.l1, self.j0), [computeMlj(a, b, j) for a, b, j in zip(l0s, l1s, j0s)]),
+                                 (computeMljjArray(self.l0, self.l1, self.j0, self.j1),
+                                  [computeMljj(a, b, j, k) for a, b, j, k in zip(l0s, l1s, j0s, j1s)]),
+                                 (computeHtArray(self.met, [self.l0, self.l1], self.jets),
+                                  [computeHt(m, [a, b]+jj) for m, a, b, jj in zip(mets, l0s, l1s, jetsPerEvent)]),
+                                 (computeMetRelArray(self.met, [self.l0, self.l1], self.jets),
+                                  [computeMetRel(m, [a, b]+jj) for m, a, b, jj in zip(mets, l0s, l1s, jetsPerEvent)]),
+                                 (phi_mpi_pi_array(self.l0.DeltaPhi(self.l1)),
+                                  [phi_mpi_pi(a.DeltaPhi(b)) for a, b in zip(l0s, l1s)]),
+                                 ] :
+            self.assertTrue(np.allclose(values, expected, rtol=1.0e-9, atol=1.0e-9))
+    def testZcandidate(self) :
+        "third leptons are either random or recoiling against l0 with a mass close to the Z"
+        class FourMom(object) :
+            def __init__(self, l, isEl, charge) :
+                self.p4, self.isEl, self.isMu, self.charge = l, isEl, not isEl, charge
+        rnd = np.random.RandomState(54321)
+        n = len(self.l0)
+        lepton = lambda ta, isEl, charge : LeptonArray(ta.px, ta.py, ta.pz, ta.E, isEl, ~np.asarray(isEl), charge)
+        l0 = lepton(self.l0, rnd.randint(0, 2, n).astype(bool), rnd.choice([-1.0, 1.0], n))
+        l1 = lepton(self.l1, rnd.randint(0, 2, n).astype(bool), rnd.choice([-1.0, 1.0], n))
+        nOthers = rnd.randint(0, 4, n)
+        parents = np.repeat(np.arange(n), nOthers)
+        hasPartner = rnd.randint(0, 2, len(parents)).astype(bool)
+        partner = l0[parents] # a lepton recoiling against l0 with mll ~ mZ, or a random one
+        randomLep = lepton(TlvArray.fromPtEtaPhiM(rnd.uniform(10.0, 100.0, len(parents)), rnd.uniform(-2.5, 2.5, len(parents)),
+                                                  rnd.uniform(-math.pi, math.pi, len(parents)), 0.1*np.ones(len(parents))),
+                           rnd.randint(0, 2, len(parents)).astype(bool), rnd.choice([-1.0, 1.0], len(parents)))
+        pt = rnd.uniform(0.5, 1.5, len(parents))*91.2**2/(2.0*partner.Pt()*(np.cosh(partner.Eta()) + 1.0))
+        recoil = TlvArray.fromPtEtaPhiM(pt, -partner.Eta(), phi_mpi_pi_array(partner.Phi() + math.pi), 0.1*np.ones(len(parents)))
+        others = LeptonArray(np.where(hasPartner, recoil.px, randomLep.px), np.where(hasPartner, recoil.py, randomLep.py),
+                             np.where(hasPartner, recoil.pz, randomLep.pz), np.where(hasPartner, recoil.E, randomLep.E),
+                             np.where(hasPartner, partner.isEl, randomLep.isEl), np.where(hasPartner, partner.isMu, randomLep.isMu),
+                             np.where(hasPartner, -partner.charge, randomLep.charge))
+        others = JaggedTlvArray(nOthers, others)
+        values = massBestZcandidateArray(l0, l1, others)
+        def fourMoms(la) : return [FourMom(t, e, c) for t, e, c in zip(self.toTlvs(la), la.isEl, la.charge)]
+        fm0s, fm1s, fmOthers = fourMoms(l0), fourMoms(l1), fourMoms(others.flat)
+        expected = [massBestZcandidate(a, b, fmOthers[o:o+c])
+                    for a, b, o, c in zip(fm0s, fm1s, others.offsets[:-1], others.counts)]
+        self.assertTrue(np.allclose(values, expected, rtol=1.0e-9, atol=1.0e-9))
+        self.assertTrue((values>0.0).any())
+    def testMt2j(self) :
+        "agreement within the bisection precision, i.e. RELATIVE_PRECISION times the largest energy, also when massless"
+        l0s, l1s, j0s, j1s, mets = [self.toTlvs(v) for v in [self.l0, self.l1, self.j0, self.j1, self.met]]
+        for zeroMass, lspMass in [(False, 0.0), (True, 0.0), (False, 100.0), (True, 100.0)] :
+            values = computeMt2jArray(self.l0, self.l1, self.j0, self.j1, self.met, zeroMass, lspMass)
+            expected = [computeMt2j(a, b, j, k, m, zeroMass, lspMass) for a, b, j, k, m in zip(l0s, l1s, j0s, j1s, mets)]
+            tolerance = MT2_RELATIVE_PRECISION*mt2jScale(self.l0, self.l1, self.j0, self.j1, self.met, zeroMass)
+            self.assertTrue((np.abs(values - np.array(expected)) <= tolerance).all())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,12 +8,16 @@
 import collections
 import datetime
 import glob
+import json
 import optparse
 import os
 import re
 import subprocess
-from datasets import datasets, setSameGroupForAllData
+import time
+from multiprocessing.pool import ThreadPool
+from datasets import datasets, setSameGroupForAllData, DatasetRegistry
 from utils import (getCommandOutput,
+                   filesIdentityKey,
                    guessLatestTagFromLatestRootFiles,
                    guessMonthDayTagFromLastRootFile,
                    isMonthDayTag
@@ -24,6 +28,13 @@ Merge root files from samples belonging to the same group.
 
 Example:
 .%prog -v -g ttbar out/susysel
+
+With '-j N', N hadd commands run at the same time. The groups with
+more than '--max-inputs' files are merged as a tree, through partial
+files in <output>/partial/. The input files (path, size, mtime) of
+each output are recorded in <output>/merge_manifest.json; a group
+whose output is up to date with its inputs is skipped, unless
+'--overwrite' is given.
 """
 parser = optparse.OptionParser(usage=usage)
 parser.add_option('--onedata', action='store_true', help='merge all data (e+mu) together; for fake estimate')
@@ -31,7 +42,9 @@ parser.add_option('--allBkg', action='store_true', help='also merge all bkg; for
 parser.add_option('--allBkgButHf', action='store_true', help='also merge all bkg w/out heavy flavor; for fake estimate')
 parser.add_option("--alsoplaceholders", action="store_true", default=False, help="placeholder samples might be needed for the fake; otherwise they should be excluded")
 parser.add_option('-o', '--output', help='output directory; default <input>/merged/')
-parser.add_option('-O', '--overwrite', action='store_true', help='overwrite output')
+parser.add_option('-O', '--overwrite', action='store_true', help='overwrite output, even when up to date')
+parser.add_option('-j', '--jobs', type='int', default=1, help='number of hadd commands running in parallel')
+parser.add_option('--max-inputs', type='int', default=0, help='merge groups with more files as a tree of partial merges (default: no limit)')
 parser.add_option('-g', '--groupregexp', default='.*', help='only matching groups')
 parser.add_option('-t', '--tag', help='production tag; by default the latest one')
 parser.add_option('-v', '--verbose', action='store_true', help='print details')
@@ -47,6 +60,8 @@ group_regexp  = options.groupregexp
 verbose       = options.verbose
 debug         = options.debug
 dryrun        = options.dryrun
+nJobs         = max(1, options.jobs)
+maxInputs     = options.max_inputs
 onedata       = options.onedata
 overwrite     = options.overwrite
 outdir        = options.output if options.output else inputdir+'/merged/'
@@ -57,14 +72,14 @@ tag           = tag.strip('_') # leading/trailing separators are not part of the
 if verbose :
     print "Options:"
     print '\n'.join(["%s : %s" % (o, eval(o))
-                     for o in ['inputdir', 'outdir', 'group_regexp', 'tag', 'overwrite',
+                     for o in ['inputdir', 'outdir', 'group_regexp', 'tag', 'overwrite', 'nJobs', 'maxInputs',
                                'allBkg', 'allBkgButHf', 'onedata',
                                'verbose', 'debug',]])
 if not isMonthDayTag(tag) : print "warning, non-standard tag might lead to bugs '%s'"%tag
 if not os.path.isdir(outdir) :
     os.mkdir(outdir)
     if verbose : print "created directory '%s'"%outdir
-allDatasets = [d for d in datasets if alsoph or not d.placeholder]
+allDatasets = DatasetRegistry(d for d in datasets if alsoph or not d.placeholder)
 if onedata : allDatasets = setSameGroupForAllData(allDatasets)
 filenamesByGroup = collections.defaultdict(list)
 rootfiles = filter(os.path.isfile, glob.glob(inputdir + "*.root"))
@@ -73,7 +88,7 @@ for rf in rootfiles :
     dsname = os.path.basename(rf).replace('.root','').replace(tag,'')
     dsname = dsname.rstrip('_') # depending on the specified tag there might be a leftover '_'
     if debug : print "'%s' -> dataset '%s'"%(rf, dsname)
-    dataset = next((d for d in allDatasets if d.name==dsname), None)
+    dataset = allDatasets.withName(dsname)
     if not dataset :
         print "warning, cannot identify dataset for '%s'"%rf
         print "using tag '%s'; if it does not look right, specify it with '-t'"%tag
@@ -88,22 +103,82 @@ for rf in rootfiles :
     if allBkgButHf and dataset.isMcBackground and not dataset.isHeavyFlavor :
         filenamesByGroup['allBkgButHf'].append(rf)
 
+def mergePlan(outfile, files, maxInputs=0, partialDir='./') :
+    """Levels of hadd commands [(target, inputs)] that merge files into
+    outfile, with at most maxInputs inputs per command (no limit if 0)"""
+    levels = []
+    inputs = list(files)
+    base = os.path.splitext(os.path.basename(outfile))[0]
+    while maxInputs>1 and len(inputs)>maxInputs :
+        chunks = [inputs[i:i+maxInputs] for i in range(0, len(inputs), maxInputs)]
+        targets = [os.path.join(partialDir, "%s_l%d_%d.root"%(base, len(levels), i)) for i in range(len(chunks))]
+        levels.append(zip(targets, chunks))
+        inputs = targets
+    levels.append([(outfile, inputs)])
+    return levels
+def runHadd(job) :
+    "run one hadd command; return (group, target, output of getCommandOutput, seconds)"
+    group, target, inputs = job
+    if target.startswith(partialDir) and os.path.isfile(target) : os.remove(target) # leftover from an interrupted merge
+    cmd = "hadd %s %s" % (target, ' '.join(inputs))
+    if debug : print cmd
+    start = time.time()
+    out = ({'stdout':'', 'stderr':'', 'returncode':0} if dryrun else getCommandOutput(cmd))
+    return group, target, out, time.time()-start
+def readManifest(filename) :
+    return json.load(open(filename)) if os.path.isfile(filename) else dict()
+def isUpToDate(outfile, files, manifest) :
+    "the output exists, and was merged by us from the same input files, none of them modified since then"
+    return (os.path.isfile(outfile)
+            and manifest.get(os.path.basename(outfile))==filesIdentityKey(files)
+            and all(os.path.getmtime(outfile) >= os.path.getmtime(f) for f in files))
+
+manifestFilename = outdir+'/merge_manifest.json'
+manifest = readManifest(manifestFilename)
+partialDir = outdir+'/partial/'
 nGroupsToMerge = len(filenamesByGroup.keys())
-groupCounter = 0
 logFilename = outdir+"merge_%s.log"%datetime.date.today().strftime('%Y-%m-%d')
 logFile     = open(logFilename, 'w')
-for group, files in filenamesByGroup.iteritems() :
-    groupCounter += 1
-    if verbose :
-        print "[%d/%d] %s (%d files)"%(groupCounter, nGroupsToMerge, group, len(files))
+plans = dict()
+for groupCounter, (group, files) in enumerate(sorted(filenamesByGroup.iteritems())) :
     outfile = outdir+'/'+group+'_'+tag+'.root'
+    if not overwrite and isUpToDate(outfile, files, manifest) :
+        if verbose : print "[%d/%d] %s : up to date, skipping"%(groupCounter+1, nGroupsToMerge, group)
+        continue
+    if verbose : print "[%d/%d] %s (%d files)"%(groupCounter+1, nGroupsToMerge, group, len(files))
     if overwrite and os.path.isfile(outfile) : os.remove(outfile)
+    elif os.path.basename(outfile) in manifest and os.path.isfile(outfile) : os.remove(outfile) # stale output from a previous merge
+    elif os.path.isfile(outfile) : print "warning, '%s' exists and is not in the manifest; use --overwrite to replace it"%outfile
     if debug : print "hadd %s\n\t%s"%(outfile, '\n\t'.join(files))
-    cmd = "hadd %s %s" % (outfile, ' '.join(files))
-    out = 0 if dryrun else getCommandOutput(cmd)
-    success = dryrun or out['returncode']==0
-    logFile.write(out['stdout'])
-    if not success : print "'%s' failed..."%group
-    if debug : print out['stderr']+'\n'+out['stdout']
+    plans[group] = (outfile, files, mergePlan(outfile, files, maxInputs, partialDir))
+if any(len(levels)>1 for outfile, files, levels in plans.values()) and not os.path.isdir(partialDir) : os.mkdir(partialDir)
+
+failed = set()
+seconds = collections.defaultdict(float)
+start = time.time()
+pool = ThreadPool(nJobs) # hadd runs as a subprocess, threads are enough
+for level in range(max([len(levels) for outfile, files, levels in plans.values()] or [0])) :
+    jobs = [(group, target, inputs) for group, (outfile, files, levels) in sorted(plans.iteritems())
+            if group not in failed and level<len(levels) for target, inputs in levels[level]]
+    for group, target, out, sec in pool.imap_unordered(runHadd, jobs) :
+        seconds[group] += sec
+        logFile.write(out['stdout'])
+        if out['returncode']!=0 :
+            failed.add(group)
+            print "'%s' failed..."%group
+        if debug : print out['stderr']+'\n'+out['stdout']
+pool.close()
+pool.join()
+for group, (outfile, files, levels) in sorted(plans.iteritems()) :
+    for target, inputs in [j for l in levels[:-1] for j in l] :
+        if os.path.isfile(target) : os.remove(target)
+    if group not in failed and not dryrun : manifest[os.path.basename(outfile)] = filesIdentityKey(files)
+    elif group in failed : manifest.pop(os.path.basename(outfile), None)
+    timing = "%s : %d files, %d hadd, %.1f s%s"%(group, len(files), sum(len(l) for l in levels), seconds[group],
+                                                 ' (failed)' if group in failed else '')
+    logFile.write(timing+'\n')
+    if verbose : print timing
+if not dryrun : json.dump(manifest, open(manifestFilename, 'w'), indent=1, sort_keys=True)
 logFile.close()
+if verbose : print "merged %d groups in %.1f s with %d jobs"%(len(plans), time.time()-start, nJobs)
 if verbose : print "hadd commands logged to '%s'"%logFilename
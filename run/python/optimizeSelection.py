@@ -12,8 +12,10 @@ import datetime
 import glob
 import math
 fabs = math.fabs
+import multiprocessing
 import optparse
 import os
+import numpy as np
 from rootUtils import (importRoot,
                        buildBotTopPads,
                        summedHisto,
@@ -50,10 +52,21 @@ from utils import (getCommandOutput,
                    mergeOuter,
                    renameDictKey,
                    mkdirIfNeeded,
-                   filterWithRegexp
+                   filterWithRegexp,
+                   entryRanges,
+                   filesIdentityKey,
+                   sourceDigest,
+                   Memoize
                    )
-from SampleUtils import isSigSample, colors
+from SampleUtils import isSigSample, colors, ModeAWhDbPar, ModeAWhDbReqid
+from derivedVariables import derivedVariables, defaultCacheDir, dilepTypes, mZcandIsInWindow
+from selectionScan import (ScanGrid, scanVariables, sampleGridYields, totalGridYields, rankWorkingPoints, formatRankedTable,
+                           channelMask, columnsHisto2d, bestCorner2d)
+from significance import znArray, binomialExpZ
 from CutflowTable import CutflowTable
+from HistogramBank import HistogramBank
+
+defaultBkgStore = '/tmp/bkg_store'
 
 def optimizeSelection() :
     inputdir, options = parseOptions()
@@ -64,9 +77,21 @@ def optimizeSelection() :
     sigFiles, bkgFiles = getInputFilenames(inputdir, tag, options) # todo: filter with regexp
     sigFiles = dict([(s, k) for s, k in sigFiles.iteritems() if s in filterWithRegexp(sigFiles.keys(), options.sigreg)])
     allSamples = dictSum(sigFiles, bkgFiles)
+    if options.scan :
+        scanSelection(sigFiles, bkgFiles, options.ll, options.nj, options.cache_dir, options.scan_top,
+                      options.summary, options.jobs, options.bkg_store)
+        return
+    if options.scan2d :
+        xVar, yVar = options.scan2d.split(',')
+        scan2dSelection(sigFiles, bkgFiles, options.ll, options.nj, xVar, yVar, options.y_max,
+                        options.cache_dir, options.summary)
+        return
     vars = variablesToPlot()
-    histos = bookHistos(vars, allSamples.keys(), options.ll, options.nj)
-    counts = fillHistosAndCount(histos, dictSum(sigFiles, bkgFiles), options.ll, options.nj, options.quicktest)
+    book = bookHistoBank if options.cache_dir else bookHistos
+    histos = book(vars, allSamples.keys(), options.ll, options.nj)
+    counts = fillHistosAndCount(histos, dictSum(sigFiles, bkgFiles), options.ll, options.nj, options.quicktest,
+                                options.jobs, options.shard_size, options.cache_dir)
+    if isinstance(histos, HistogramBank) : histos = histos.toHistos()
     bkgHistos = dict((s, h) for s, h in histos.iteritems() if s in bkgFiles.keys())
     sigHistos = dict((s, h) for s, h in histos.iteritems() if s in sigFiles.keys())
     plotHistos(bkgHistos, sigHistos, options.plotdir)
@@ -86,6 +111,16 @@ def parseOptions() :
     parser.add_option("-e", "--exclude-regexp", dest="exclude", default=None, help="exclude matching samples")
     parser.add_option('-t', '--tag', help='production tag; by default the latest one')
     parser.add_option('--quicktest', action='store_true', help='run only on a fraction of the events')
+    parser.add_option('-j', '--jobs', type='int', default=0, help='fill with a pool of N processes')
+    parser.add_option('--shard-size', type='int', default=None, help='with --jobs, split each tree in ranges of at most this many entries')
+    parser.add_option('--scan', action='store_true', help='scan the thresholds on a grid and rank the working points by Zn')
+    parser.add_option('--scan-top', type='int', default=10, help='with --scan, number of working points to print (default %default)')
+    parser.add_option('--scan2d', default=None, help='scan the (x_min, y_min) corners of two variables, e.g. pt0,mtllmet')
+    parser.add_option('--y-max', action='store_true', help='with --scan2d, scan (x_min, y_max) instead')
+    parser.add_option('--bkg-store', default=defaultBkgStore, help='store the background yields here, to reuse them with other signals (default %default)')
+    parser.add_option('--no-bkg-store', action='store_true', help='always recompute the background yields')
+    parser.add_option('--cache-dir', default=defaultCacheDir, help='cache of the derived variables (default %default)')
+    parser.add_option('--no-cache', action='store_true', help='compute the variables event by event from the trees')
     parser.add_option('--plotdir', default='./', help="save the plots to this directory")
     parser.add_option('--summary', default=None, help="write the summary txt to this file")
     parser.add_option('-v', '--verbose', action='store_true', help='print details')
@@ -98,6 +133,13 @@ def parseOptions() :
         setattr(opts, o, defaults if v is None else [v])
     validateMultiOpt('ll', options, lls)
     validateMultiOpt('nj', options, njs)
+    if options.no_cache : options.cache_dir = None
+    if options.no_bkg_store : options.bkg_store = None
+    if options.scan2d :
+        if len(options.scan2d.split(','))!=2 : parser.error("--scan2d needs two variables (got '%s')"%options.scan2d)
+        unknown = [v for v in options.scan2d.split(',') if v not in variablesToPlot()]
+        if unknown : parser.error("invalid --scan2d variables %s (should be in %s)"%(unknown, variablesToPlot()))
+        if not options.cache_dir : parser.error("--scan2d reads the cached variables, it cannot be used with --no-cache")
     inputdir = args[0]
     return inputdir, options
 
@@ -127,27 +169,31 @@ def variablesToPlot() :
 def llnjKey(ll, nj) : return "%s_%s"%(ll, nj)
 def histoSuffix(sample, ll, nj) : return "%s_%s_%s"%(sample, ll, nj)
 
+def histoBinning(variable, selection='') :
+    "(title, nBins, xMin, xMax) of the histogram of a variable"
+    v = variable
+    twopi = +2.0*math.pi
+    if   v=='pt0'     : return (';p_{T,l0} [GeV]; entries/bin',          25, 0.0, 250.0)
+    elif v=='pt1'     : return (';p_{T,l1} [GeV]; entries/bin',          25, 0.0, 250.0)
+    elif v=='mll'     : return (';m_{l0,l1} [GeV]; entries/bin',         25, 0.0, 250.0)
+    elif v=='mtmin'   : return (';m_{T,min}(l, MET) [GeV]; entries/bin', 25, 0.0, 400.0)
+    elif v=='mtmax'   : return (';m_{T,max}(l, MET) [GeV]; entries/bin', 25, 0.0, 400.0)
+    elif v=='mtllmet' : return (';m_{T}(l+l, MET) [GeV]; entries/bin',   25, 0.0, 600.0)
+    elif v=='ht'      : return (';H_{T} [GeV]; entries/bin',             25, 0.0, 800.0)
+    elif v=='metrel'  : return (';MET_{rel} [GeV]; entries/bin',         25, 0.0, 300.0)
+    elif v=='dphill'  : return (';#Delta#phi(l, l) [rad]; entries/bin',  25, 0.0, twopi)
+    elif v=='detall'  : return (';#Delta#eta(l, l); entries/bin',        25, 0.0, +3.0 )
+    elif v=='mt2j'    : return (';m^{J}_{T2} [GeV]; entries/bin',        25, 0.0, 500.0)
+    elif v=='mljj'    : return (';m_{ljj} [GeV]; entries/bin',           25, 0.0, 500.0)
+    elif v=='dphijj'  : return (';#Delta#phi(j, j) [rad]; entries/bin',  25, 0.0, twopi)
+    elif v=='detajj'  : return (';#Delta#eta(j, j); entries/bin',        25, 0.0, +3.0 )
+    else : print "unknown variable %s"%v
+
 def bookHistos(variables, samples, lls, njs) :
     "book a dict of histograms with keys [sample][ll_nj][var]"
     def histo(variable, suffix) :
-        s = suffix
-        twopi = +2.0*math.pi
-        h = None
-        if   v=='pt0'     : h = r.TH1F('h_pt0_'    +s, ';p_{T,l0} [GeV]; entries/bin',          25, 0.0, 250.0)
-        elif v=='pt1'     : h = r.TH1F('h_pt1_'    +s, ';p_{T,l1} [GeV]; entries/bin',          25, 0.0, 250.0)
-        elif v=='mll'     : h = r.TH1F('h_mll_'    +s, ';m_{l0,l1} [GeV]; entries/bin',         25, 0.0, 250.0)
-        elif v=='mtmin'   : h = r.TH1F('h_mtmin_'  +s, ';m_{T,min}(l, MET) [GeV]; entries/bin', 25, 0.0, 400.0)
-        elif v=='mtmax'   : h = r.TH1F('h_mtmax_'  +s, ';m_{T,max}(l, MET) [GeV]; entries/bin', 25, 0.0, 400.0)
-        elif v=='mtllmet' : h = r.TH1F('h_mtllmet_'+s, ';m_{T}(l+l, MET) [GeV]; entries/bin',   25, 0.0, 600.0)
-        elif v=='ht'      : h = r.TH1F('h_ht_'     +s, ';H_{T} [GeV]; entries/bin',             25, 0.0, 800.0)
-        elif v=='metrel'  : h = r.TH1F('h_metrel_' +s, ';MET_{rel} [GeV]; entries/bin',         25, 0.0, 300.0)
-        elif v=='dphill'  : h = r.TH1F('h_dphill_' +s, ';#Delta#phi(l, l) [rad]; entries/bin',  25, 0.0, twopi)
-        elif v=='detall'  : h = r.TH1F('h_detall_' +s, ';#Delta#eta(l, l); entries/bin',        25, 0.0, +3.0 )
-        elif v=='mt2j'    : h = r.TH1F('h_mt2j_'   +s, ';m^{J}_{T2} [GeV]; entries/bin',        25, 0.0, 500.0)
-        elif v=='mljj'    : h = r.TH1F('h_mljj_'   +s, ';m_{ljj} [GeV]; entries/bin',           25, 0.0, 500.0)
-        elif v=='dphijj'  : h = r.TH1F('h_dphijj_' +s, ';#Delta#phi(j, j) [rad]; entries/bin',  25, 0.0, twopi)
-        elif v=='detajj'  : h = r.TH1F('h_detajj_' +s, ';#Delta#eta(j, j); entries/bin',        25, 0.0, +3.0 )
-        else : print "unknown variable %s"%v
+        title, nBins, xMin, xMax = histoBinning(variable)
+        h = r.TH1F('h_'+variable+'_'+suffix, title, nBins, xMin, xMax)
         h.SetDirectory(0)
         return h
     return dict([(s,
@@ -156,128 +202,322 @@ def bookHistos(variables, samples, lls, njs) :
                          for ll in lls for nj in njs]))
                  for s in samples])
 
-def fillHistosAndCount(histos, files, lls, njs, testRun=False) :
-    "Fill the histograms, and provide a dict of event counters[sample][sel] for the summary"
+def bookHistoBank(variables, samples, lls, njs) :
+    "same as bookHistos, with all the bins in one HistogramBank (see toHistos to get the TH1F)"
+    return HistogramBank(samples, [llnjKey(ll, nj) for ll in lls for nj in njs], variables, histoBinning)
+
+def fillHistosAndCount(histos, files, lls, njs, testRun=False, nJobs=0, shardSize=None, cacheDir=None) :
+    """Fill the histograms, and provide a dict of event counters[sample][sel] for the summary.
+    With nJobs, the (sample, entry range) shards are processed by a
+    pool of processes, and the partial histograms and counts are summed.
+    With cacheDir, the variables are read from the cache of derived
+    variables, and histos is a HistogramBank (see bookHistoBank).
+    """
     treename = 'SusySel'
+    if cacheDir : return fillHistosAndCountFromCache(histos, files, lls, njs, testRun, nJobs, shardSize, cacheDir)
     counts = dict()
+    shards = []
     for sample, filename in files.iteritems() :
-        countsSample = collections.defaultdict(float)
-        histosSample = histos[sample]
         file = r.TFile.Open(filename)
         tree = file.Get(treename)
         nEvents = tree.GetEntries()
         nEventsToProcess = nEvents if not testRun else nEvents/10
         print "processing %s (%d entries %s) %s"%(sample, nEventsToProcess, ", 10% test" if testRun else "", datetime.datetime.now())
-        for iEvent, event in enumerate(tree) :
-            if iEvent > nEventsToProcess : break
-            l0, l1, met, pars = addTlv(event.l0), addTlv(event.l1), addTlv(event.met), event.pars
-            jets, lepts = [addTlv(j) for j in event.jets], [addTlv(l) for l in event.lepts]
-            ll = getDilepType(l0, l1)
-            nJets = len(jets)
-            nj = 'eq1j' if nJets==1 else 'ge2j'
-            assert nJets>0,"messed something up in the selection upstream"
-            if ll not in lls or nj not in njs : continue
-            pt0 = l0.p4.Pt()
-            pt1 = l1.p4.Pt()
-            j0  = jets[0]
-            mll  = (l0.p4 + l1.p4).M()
-            mtllmet = computeMt(l0.p4 + l1.p4, met.p4)
-            ht      = computeHt(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
-            metrel  = computeMetRel(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
-            mtl0    = computeMt(l0.p4, met.p4)
-            mtl1    = computeMt(l1.p4, met.p4)
-            mtmin   = min([mtl0, mtl1])
-            mtmax   = max([mtl0, mtl1])
-            mlj     = computeMlj(l0.p4, l1.p4, j0.p4)
-            dphill  = abs(phi_mpi_pi(l0.p4.DeltaPhi(l1.p4)))
-            detall  = fabs(l0.p4.Eta() - l1.p4.Eta())
-            l3Veto  =  not thirdLepZcandidateIsInWindow(l0, l1, lepts)
-            mljj = None
-            if nJets >1 :
-                j0, j1 = jets[0], jets[1]
-                mt2j   = computeMt2j(l0.p4, l1.p4, j0.p4, j1.p4, met.p4)
-                mljj   = computeMljj(l0.p4, l1.p4, j0.p4, j1.p4)
-                dphijj = fabs(phi_mpi_pi(j0.p4.DeltaPhi(j1.p4)))
-                detajj = fabs(j0.p4.Eta() - j1.p4.Eta())
-            if passSelection(pt0, pt1, mll, mtllmet, ht, metrel, l3Veto,
-                             detall, mtmax, mlj, mljj,
-                             ll, nj) :
-                llnj = llnjKey(ll, nj)
-                weight = pars.weight
-                varHistos = histosSample[llnj]
-                varValues = dict([(v, eval(v)) for v in variablesToPlot()])
-                fillVarHistos(varHistos, varValues, weight, nj)
-                countsSample[llnj] += weight
+        nEventsToProcess = min(nEvents, nEventsToProcess+1) # the event loop used to stop at iEvent > nEventsToProcess
+        if nJobs :
+            shards += [(sample, filename, lls, njs, start, stop) for start, stop in entryRanges(nEventsToProcess, shardSize)]
+        else :
+            counts[sample] = fillHistosAndCountRange(histos[sample], tree, lls, njs, 0, nEventsToProcess)
         file.Close()
         file.Delete()
-        counts[sample] = countsSample
+    if nJobs :
+        counts = dict((sample, collections.defaultdict(float)) for sample in files.keys())
+        pool = multiprocessing.Pool(processes=nJobs)
+        for iShard, (shard, histosShard, countsShard) in enumerate(pool.imap_unordered(fillShard, shards)) :
+            sample, start, stop = shard[0], shard[4], shard[5]
+            print "[%d/%d] done %s [%d, %d) %s"%(iShard+1, len(shards), sample, start, stop, datetime.datetime.now())
+            for llnj, histosVar in histosShard.iteritems() :
+                for v, h in histosVar.iteritems() : histos[sample][llnj][v].Add(h)
+            for llnj, count in countsShard.iteritems() : counts[sample][llnj] += count
+        pool.close()
+        pool.join()
+    return counts
+
+def fillHistosAndCountFromCache(histos, files, lls, njs, testRun=False, nJobs=0, shardSize=None, cacheDir=defaultCacheDir) :
+    """Same as fillHistosAndCount, from the cached derived variables.
+    With nJobs the missing cache entries are built in parallel, and
+    the (sample, entry range) shards of the memmapped columns are
+    filled by the pool, each one into its own HistogramBank."""
+    pool = multiprocessing.Pool(processes=nJobs) if nJobs else None
+    if pool : pool.map(cacheDerivedVariables, [(filename, cacheDir) for filename in files.values()])
+    counts = dict()
+    shards = []
+    for sample, filename in files.iteritems() :
+        columns = derivedVariables(filename, 'SusySel', cacheDir)
+        nEvents = len(columns['weight'])
+        nEventsToProcess = nEvents if not testRun else nEvents/10
+        print "processing %s (%d entries %s, from cache) %s"%(sample, nEventsToProcess, ", 10% test" if testRun else "", datetime.datetime.now())
+        nEventsToProcess = min(nEvents, nEventsToProcess+1)
+        if pool :
+            shards += [(sample, filename, lls, njs, start, stop, histos.variables, cacheDir)
+                       for start, stop in entryRanges(nEventsToProcess, shardSize)]
+        else :
+            counts[sample] = fillHistosAndCountColumns(histos[sample], columns, lls, njs, 0, nEventsToProcess)
+    if pool :
+        counts = dict((sample, collections.defaultdict(float)) for sample in files.keys())
+        for iShard, (shard, bankShard, countsShard) in enumerate(pool.imap_unordered(fillColumnsShard, shards)) :
+            sample, start, stop = shard[0], shard[4], shard[5]
+            print "[%d/%d] done %s [%d, %d) %s"%(iShard+1, len(shards), sample, start, stop, datetime.datetime.now())
+            histos.add(bankShard)
+            for llnj, count in countsShard.iteritems() : counts[sample][llnj] += count
+        pool.close()
+        pool.join()
     return counts
 
+def fillColumnsShard(shard) :
+    "fill a one-sample HistogramBank with the cached entries [start, stop); executed by the workers of the process pool"
+    sample, filename, lls, njs, start, stop, variables, cacheDir = shard
+    bank = bookHistoBank(variables, [sample], lls, njs)
+    columns = derivedVariables(filename, 'SusySel', cacheDir)
+    counts = fillHistosAndCountColumns(bank[sample], columns, lls, njs, start, stop)
+    return shard, bank, dict(counts)
+
+def cacheDerivedVariables((filename, cacheDir)) :
+    "build the cache entry of one file; executed by the workers of the process pool"
+    derivedVariables(filename, 'SusySel', cacheDir)
+
+def fillHistosAndCountColumns(histosSample, columns, lls, njs, start, stop) :
+    """Same as fillHistosAndCountRange, with the values from the
+    derived-variable columns: the selection is evaluated on the
+    arrays, and histosSample is a row of a HistogramBank"""
+    countsSample = collections.defaultdict(float)
+    varNames = variablesToPlot()
+    values = dict((v, np.asarray(columns[v][start:stop])) for v in set(varNames+['mlj', 'dilepType', 'nJets', 'weight']))
+    l3Vetos = ~mZcandIsInWindow(columns['mZcand'][start:stop])
+    assert (values['nJets']>0).all(),"messed something up in the selection upstream"
+    for ll in lls :
+        for nj in njs :
+            inChannel = (values['dilepType']==dilepTypes.index(ll)) & ((values['nJets']==1) if nj=='eq1j' else (values['nJets']>1))
+            v = dict((k, a[inChannel]) for k, a in values.iteritems())
+            passed = passSelection(v['pt0'], v['pt1'], v['mll'], v['mtllmet'], v['ht'], v['metrel'], l3Vetos[inChannel],
+                                   v['detall'], v['mtmax'], v['mlj'], v['mljj'],
+                                   ll, nj)
+            if not passed.any() : continue
+            llnj = llnjKey(ll, nj)
+            weights = v['weight'][passed]
+            for var in variablesToFill(varNames, nj) : histosSample.fill(llnj, var, v[var][passed], weights)
+            countsSample[llnj] += weights.sum()
+    return countsSample
+
+def scanSelection(sigFiles, bkgFiles, lls, njs, cacheDir=defaultCacheDir, nTop=10, outFilename='', nJobs=0,
+                  bkgStore=defaultBkgStore) :
+    """Compute the yields for all the working points of the threshold
+    grid (see selectionScan), and print the best ones for each signal
+    and channel, followed by the best Zn of each signal point. The
+    background yields are stored in bkgStore and reused when only the
+    signals change."""
+    if nJobs and cacheDir :
+        pool = multiprocessing.Pool(processes=nJobs)
+        pool.map(cacheDerivedVariables, [(filename, cacheDir) for filename in dictSum(sigFiles, bkgFiles).values()])
+        pool.close()
+        pool.join()
+    print "background grid yields %s"%datetime.datetime.now()
+    bkgYields = totalGridYields(bkgFiles.values(), lls, njs, cacheDir, bkgStore, verbose=True)
+    tables = []
+    bestZn = dict()
+    for signal, filename in sorted(sigFiles.iteritems()) :
+        print "scanning %s %s"%(signal, datetime.datetime.now())
+        sigYields = sampleGridYields(derivedVariables(filename, 'SusySel', cacheDir), lls, njs)
+        bestZn[signal] = dict()
+        for ll in lls :
+            for nj in njs :
+                llnj, grid = llnjKey(ll, nj), ScanGrid(scanVariables(nj))
+                rankedPoints = rankWorkingPoints(sigYields[llnj], bkgYields[llnj], grid, nTop)
+                tables.append(formatRankedTable(rankedPoints, grid, "%s %s (%d working points)"%(signal, llnj, grid.nPoints)))
+                bestZn[signal][llnj] = rankedPoints[0][0] if rankedPoints else 0.0
+    tables.append(formatBestZnGrid(bestZn, [llnjKey(ll, nj) for ll in lls for nj in njs]))
+    if outFilename :
+        with open(outFilename, 'w') as f :
+            f.write('\n\n'.join(tables)+'\n')
+    else :
+        print
+        print '\n\n'.join(tables)
+
+def formatBestZnGrid(bestZn, llnjs) :
+    "one line per signal point, with its (mc1, mn1) when they can be looked up, and the best Zn per channel"
+    def mc1Mn1(sample) :
+        try :
+            return ModeAWhDbPar().mc1Mn1ByReqid(ModeAWhDbReqid().reqidBySample(sample))
+        except (IOError, KeyError, StopIteration) :
+            return None, None
+    mc1Mn1 = Memoize(mc1Mn1)
+    lines = ['best Zn per signal point',
+             ' '.join(["%50s"%'signal', "%6s"%'mc1', "%6s"%'mn1']+["%8s"%llnj for llnj in llnjs])]
+    for signal in sorted(bestZn.keys()) :
+        mc1, mn1 = mc1Mn1(signal)
+        lines.append(' '.join(["%50s"%signal]+["%6s"%('%.0f'%m if m is not None else '--') for m in [mc1, mn1]]
+                              +["%8.3f"%bestZn[signal][llnj] for llnj in llnjs]))
+    return '\n'.join(lines)
+
+def variableEdges(variable) :
+    "bin edges of the histogram booked for this variable"
+    title, nBins, xMin, xMax = histoBinning(variable)
+    return np.linspace(xMin, xMax, nBins+1)
+
+def scan2dSelection(sigFiles, bkgFiles, lls, njs, xVar, yVar, yMax=False, cacheDir=defaultCacheDir, outFilename='') :
+    """Compute Zn for all the (x_min, y_min) or (x_min, y_max) corners,
+    with the binning of the plotted histograms, and print the best
+    corner for each signal and channel"""
+    xEdges, yEdges = variableEdges(xVar), variableEdges(yVar)
+    def channelHistos(filename) :
+        columns = derivedVariables(filename, 'SusySel', cacheDir)
+        return dict((llnjKey(ll, nj), columnsHisto2d(columns, channelMask(columns, ll, nj), xVar, yVar, xEdges, yEdges))
+                    for ll in lls for nj in njs)
+    bkgHistos = None
+    for sample, filename in bkgFiles.iteritems() :
+        histos = channelHistos(filename)
+        bkgHistos = histos if bkgHistos is None else dict((k, bkgHistos[k] + h) for k, h in histos.iteritems())
+    yCut = yVar+('<' if yMax else '>')
+    lines = [' '.join(["%50s"%'signal', "%8s"%'ll_nj']+["%8s"%c for c in ['Zn', 'sig', 'bkg', xVar+'>', yCut]])]
+    for signal, filename in sorted(sigFiles.iteritems()) :
+        sigHistos = channelHistos(filename)
+        for ll in lls :
+            for nj in njs :
+                llnj = llnjKey(ll, nj)
+                zn, best = bestCorner2d(sigHistos[llnj], bkgHistos[llnj], xEdges, yEdges, yMax)
+                lines.append(' '.join(["%50s"%signal, "%8s"%llnj]+["%8.3f"%best[0]]+["%8.2f"%v for v in best[1:]]))
+    table = '\n'.join(lines)
+    if outFilename :
+        with open(outFilename, 'w') as f :
+            f.write(table+'\n')
+    else :
+        print
+        print table
+
+def fillShard(shard) :
+    "fill the histograms for the entries [start, stop) of one sample; executed by the workers of the process pool"
+    sample, filename, lls, njs, start, stop = shard
+    histos = bookHistos(variablesToPlot(), [sample], lls, njs)[sample]
+    file = r.TFile.Open(filename)
+    tree = file.Get('SusySel')
+    counts = fillHistosAndCountRange(histos, tree, lls, njs, start, stop)
+    file.Close()
+    return shard, histos, dict(counts)
+
+def fillHistosAndCountRange(histosSample, tree, lls, njs, start, stop) :
+    "Fill the histograms of one sample with the entries [start, stop); return the counters[sel]"
+    countsSample = collections.defaultdict(float)
+    for iEvent in xrange(start, stop) :
+        tree.GetEntry(iEvent)
+        event = tree
+        l0, l1, met, pars = addTlv(event.l0), addTlv(event.l1), addTlv(event.met), event.pars
+        jets, lepts = [addTlv(j) for j in event.jets], [addTlv(l) for l in event.lepts]
+        ll = getDilepType(l0, l1)
+        nJets = len(jets)
+        nj = 'eq1j' if nJets==1 else 'ge2j'
+        assert nJets>0,"messed something up in the selection upstream"
+        if ll not in lls or nj not in njs : continue
+        pt0 = l0.p4.Pt()
+        pt1 = l1.p4.Pt()
+        j0  = jets[0]
+        mll  = (l0.p4 + l1.p4).M()
+        mtllmet = computeMt(l0.p4 + l1.p4, met.p4)
+        ht      = computeHt(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
+        metrel  = computeMetRel(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
+        mtl0    = computeMt(l0.p4, met.p4)
+        mtl1    = computeMt(l1.p4, met.p4)
+        mtmin   = min([mtl0, mtl1])
+        mtmax   = max([mtl0, mtl1])
+        mlj     = computeMlj(l0.p4, l1.p4, j0.p4)
+        dphill  = abs(phi_mpi_pi(l0.p4.DeltaPhi(l1.p4)))
+        detall  = fabs(l0.p4.Eta() - l1.p4.Eta())
+        l3Veto  =  not thirdLepZcandidateIsInWindow(l0, l1, lepts)
+        mljj = None
+        if nJets >1 :
+            j0, j1 = jets[0], jets[1]
+            mt2j   = computeMt2j(l0.p4, l1.p4, j0.p4, j1.p4, met.p4)
+            mljj   = computeMljj(l0.p4, l1.p4, j0.p4, j1.p4)
+            dphijj = fabs(phi_mpi_pi(j0.p4.DeltaPhi(j1.p4)))
+            detajj = fabs(j0.p4.Eta() - j1.p4.Eta())
+        if passSelection(pt0, pt1, mll, mtllmet, ht, metrel, l3Veto,
+                         detall, mtmax, mlj, mljj,
+                         ll, nj) :
+            llnj = llnjKey(ll, nj)
+            weight = pars.weight
+            varHistos = histosSample[llnj]
+            varValues = dict([(v, eval(v)) for v in variablesToPlot()])
+            fillVarHistos(varHistos, varValues, weight, nj)
+            countsSample[llnj] += weight
+    return countsSample
+
 def passSelection(l0pt, l1pt, mll, mtllmet, ht, metrel, l3Veto,
                   detall, mtmax, mlj, mljj,
                   ll, nj) :
-
+    "works both on the values of one event and on numpy arrays of values"
     if ll=='mm' and nj=='eq1j':
-        return (    l0pt    >  30.0
-                and l1pt    >  20.0
-                and detall  <   1.5
-                and mtmax   > 100.0
-                and ht      > 200.0
-                and mlj     <  90.0
-                and l3Veto
+        return (    (l0pt    >  30.0)
+                  & (l1pt    >  20.0)
+                  & (detall  <   1.5)
+                  & (mtmax   > 100.0)
+                  & (ht      > 200.0)
+                  & (mlj     <  90.0)
+                  & l3Veto
                     )
     elif ll=='mm' and nj=='ge2j':
-        return (    l0pt    >  30.0
-                and l1pt    >  20.0
-                and detall  <   1.5
-                and ht      > 220.0
-                and mljj    < 120.0
-                and l3Veto
+        return (    (l0pt    >  30.0)
+                  & (l1pt    >  20.0)
+                  & (detall  <   1.5)
+                  & (ht      > 220.0)
+                  & (mljj    < 120.0)
+                  & l3Veto
                     )
     elif ll=='em' and nj=='eq1j':
-        return (    l0pt    >  30.0
-                and l1pt    >  30.0
-                and detall  <   1.5
-                and mtmax   > 110.0
-                and mlj     <  90.0
-                and mtllmet > 110.0
-                and l3Veto
+        return (    (l0pt    >  30.0)
+                  & (l1pt    >  30.0)
+                  & (detall  <   1.5)
+                  & (mtmax   > 110.0)
+                  & (mlj     <  90.0)
+                  & (mtllmet > 110.0)
+                  & l3Veto
                     )
     elif ll=='em' and nj=='ge2j':
-        return (    l0pt    >  30.0
-                and l1pt    >  30.0
-                and detall  <   1.5
-                and mljj    < 120.0
-                and mtllmet > 110.0
-                and l3Veto
+        return (    (l0pt    >  30.0)
+                  & (l1pt    >  30.0)
+                  & (detall  <   1.5)
+                  & (mljj    < 120.0)
+                  & (mtllmet > 110.0)
+                  & l3Veto
                     )
     elif ll=='ee' and nj=='eq1j':
-        return (    l0pt    >  30.0
-                and l1pt    >  30.0
-                and fabs(mll-91.2) > 10.0
-                and mtllmet > 100.0
-                and detall  <   1.5
-                and mtmax   > 100.0
-                and ht      > 200.0
-                and mlj     <  90.0
-                and l3Veto
+        return (    (l0pt    >  30.0)
+                  & (l1pt    >  30.0)
+                  & (abs(mll-91.2) > 10.0)
+                  & (mtllmet > 100.0)
+                  & (detall  <   1.5)
+                  & (mtmax   > 100.0)
+                  & (ht      > 200.0)
+                  & (mlj     <  90.0)
+                  & l3Veto
                     )
     elif ll=='ee' and nj=='ge2j':
-        return (    l0pt    >  30.0
-                and l1pt    >  30.0
-                and fabs(mll-91.2) > 10.0
-                and detall  <   1.5
-                and mtllmet > 150.0
-                and mljj    < 120.0
-                and ht      > 200.0
-                and l3Veto
+        return (    (l0pt    >  30.0)
+                  & (l1pt    >  30.0)
+                  & (abs(mll-91.2) > 10.0)
+                  & (detall  <   1.5)
+                  & (mtllmet > 150.0)
+                  & (mljj    < 120.0)
+                  & (ht      > 200.0)
+                  & l3Veto
                     )
 
-def fillVarHistos(varHistos, varValues, weight, nj) :
+def variablesToFill(variables, nj) :
+    "the jet-jet variables are not defined for eq1j, mlj is not used for ge2j"
     assert nj in ['eq1j', 'ge2j']
     exclVars = ['mt2j','mljj','dphijj','detajj'] if nj=='eq1j' else ['mlj']
-    vars = [v for v in varHistos.keys() if v not in exclVars]
-    for v in vars :
+    return [v for v in variables if v not in exclVars]
+
+def fillVarHistos(varHistos, varValues, weight, nj) :
+    for v in variablesToFill(varHistos.keys(), nj) :
         varHistos[v].Fill(varValues[v], weight)
 
 def plotHistos(bkgHistos, sigHistos, plotdir) :
@@ -350,10 +590,9 @@ def drawTop(pad, hBkg, hSig) :
     bcLS, bcLB = cumsum(mergeOuter(bcS), leftToRight), cumsum(mergeOuter(bcB), leftToRight),
     leftToRight = False
     bcRS, bcRB = cumsum(mergeOuter(bcS), leftToRight), cumsum(mergeOuter(bcB), leftToRight)
-    zn = r.RooStats.NumberCountingUtils.BinomialExpZ
     bkgUnc = 0.3
-    znL = [zn(s, b, bkgUnc) if (b>4.0 and s>0.01) else 0.0 for s,b in zip(bcLS, bcLB)]
-    znR = [zn(s, b, bkgUnc) if (b>4.0 and s>0.01) else 0.0 for s,b in zip(bcRS, bcRB)]
+    znL = list(znArray(bcLS, bcLB, bkgUnc, minBkg=4.0, minSig=0.01))
+    znR = list(znArray(bcRS, bcRB, bkgUnc, minBkg=4.0, minSig=0.01))
     leftToRight = max(znL) >= max(znR)
     zn = znL if leftToRight else znR
     hZn = cloneAndFillHisto(hSig, zn, '_zn')
@@ -429,8 +668,9 @@ def printSummary(counts, outfilename='') :
                                            for sam, countsSample in counts.iteritems() if not isSignal(sam)))
                                  for sel in first(counts).keys()])
     bkgUnc = 0.30
-    zn = r.RooStats.NumberCountingUtils.BinomialExpZ
-    counts['Zn'] = dict([(sel, zn(counts['signal'][sel], counts['totbkg'][sel], bkgUnc)) for sel in selections])
+    counts['Zn'] = dict(zip(selections, binomialExpZ([counts['signal'][sel] for sel in selections],
+                                                     [counts['totbkg'][sel] for sel in selections],
+                                                     bkgUnc)))
     firstThreeColumns = ['Zn', 'signal', 'totbkg']
     otherSamples = sorted([s for s in samples if s not in firstThreeColumns])
     table = CutflowTable(firstThreeColumns + otherSamples, selections, counts)
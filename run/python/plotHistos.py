@@ -35,6 +35,8 @@ parser.add_option("-s", "--sig-file", dest="sigFname", default=defaultSigFile,
                   help="signal file (default %s)" % defaultSigFile)
 parser.add_option("-S", "--sig-scale", dest="sigScale", default=defaultSigScale,
                   help="signal scale factor (default %.1f)" % defaultSigScale)
+parser.add_option("--stream", action="store_true", dest="stream", default=False,
+                  help="read, plot, and release the histograms one type at the time (bounded memory)")
 parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
                   help="print more details about what is going on")
 (options, args) = parser.parse_args()
@@ -43,6 +45,7 @@ prodTag         = options.tag
 signalFname     = options.sigFname
 signalScale     = options.sigScale
 justTest        = options.test
+streaming       = options.stream
 verbose         = options.verbose
 
 inputFileNames = glob.glob(inputDir+'/'+'*'+prodTag+'*.root') + glob.glob(signalFname)
@@ -50,20 +53,46 @@ print 'input files:\n'+'\n'.join(inputFileNames)
 inputFiles = [r.TFile.Open(f) for f in inputFileNames]
 
 
-histosByType = collections.defaultdict(list)
 classifier = HistoNameClassifier()
 
-for fname, infile in zip(inputFileNames, inputFiles) :
-    print '-'*3 + fname + '-'*3
-    samplename = guessSampleFromFilename(fname)
+def histoNamesToPlot() :
+    "names of the histograms to plot, from the first input file"
     histoNames = getAllHistoNames(inputFiles[0], onlyTH1=True)
     histoNames = [h for h in histoNames if any([h.startswith(p) for p in ['sr6', 'sr7', 'sr8', 'sr9']])]
     if justTest : histoNames = histoNames[:10] # just get 10 histos to run quick tests
-    histos = [infile.Get(hn) for hn in histoNames]
-    for h in histos :
-        setHistoType(h, classifier.histoType(h.GetName()))
-        setHistoSample(h, samplename)
-    organizeHistosByType(histosByType, histos)
+    return histoNames
+def loadAllHistos() :
+    "get all the histograms from all the files, organized by type"
+    histosByType = collections.defaultdict(list)
+    histoNames = histoNamesToPlot()
+    for fname, infile in zip(inputFileNames, inputFiles) :
+        print '-'*3 + fname + '-'*3
+        samplename = guessSampleFromFilename(fname)
+        histos = [infile.Get(hn) for hn in histoNames]
+        for h in histos :
+            setHistoType(h, classifier.histoType(h.GetName()))
+            setHistoSample(h, samplename)
+        organizeHistosByType(histosByType, histos)
+    return histosByType
+def streamHistosByType() :
+    """Same as loadAllHistos().iteritems(), but the histograms of one
+    type at the time are read from the files. They are detached from
+    the files and owned by python, so that they are released as soon as
+    the caller is done with them."""
+    samplenames = [guessSampleFromFilename(f) for f in inputFileNames]
+    histoNames = histoNamesToPlot()
+    namesByType = collections.OrderedDict()
+    for hn, type in zip(histoNames, classifier.classify(histoNames)) : namesByType.setdefault(type, []).append(hn)
+    for type, names in namesByType.iteritems() :
+        histos = []
+        for samplename, infile in zip(samplenames, inputFiles) :
+            for hn in names :
+                h = infile.Get(hn)
+                if not h : continue
+                h.SetDirectory(0)
+                r.SetOwnership(h, True)
+                histos.append(setHistoSample(setHistoType(h, type), samplename))
+        yield type, histos
 
 def isSignal(sampleName) : return 'WH_' in sampleName
 
@@ -152,7 +181,7 @@ def plotTopPad(pad, hSig, hBkg) :
 
 def plotHistos(histosDict={'ttbar':None, 'zjets':None},
                 outdir='./plots', extensions=['png',], # 'eps'],
-               verbose=False) :
+               verbose=False, closeCanvas=False) :
     allHistosEmpty = all([h.GetEntries()==0 for h in histosDict.values()])
     if allHistosEmpty : return
     hnames = [h.GetName() for h in histosDict.values()]
@@ -241,11 +270,13 @@ def plotHistos(histosDict={'ttbar':None, 'zjets':None},
     topPad.Update()
     can.Update()
     for ext in extensions : can.SaveAs(outdir+'/'+hname+'_lin'+'.'+ext)
+    if closeCanvas : can.Close()
 #    stack.SetMaximum(5.*stack.GetMaximum())
 #    stack.SetMinimum(0.25)
 #    can.SetLogy()
 #    for ext in extensions : can.SaveAs(outdir+'/'+hname+'_log'+'.'+ext)
 
-for k,v in histosByType.iteritems() :
-    plotHistos(histosDict=dict([(h.sample, h) for h in v]))
+histosByType = streamHistosByType() if streaming else loadAllHistos().iteritems()
+for k,v in histosByType :
+    plotHistos(histosDict=dict([(h.sample, h) for h in v]), closeCanvas=streaming)
 
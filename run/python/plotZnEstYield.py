@@ -21,6 +21,7 @@ import sys
 from rootUtils import importRoot
 r = importRoot()
 from PickleUtils import readFromPickle
+from significance import binomialExpZ
 from SampleUtils import ModeAWhDbPar, ModeAWhDbReqid
 
 #########
@@ -73,11 +74,9 @@ def sigBkgFromFilename(filename) :
 def findBestZn(countsPerSelBkg={}, countsPerSelSig={},
                sigScale=1.0, bkgRelErr=0.2) :
     selections = countsPerSelSig.keys()
-    znFunc = r.RooStats.NumberCountingUtils.BinomialExpZ
-    zns = dict([(sel, znFunc(sigScale*countsPerSelSig[sel],
-                             countsPerSelBkg[sel],
-                             bkgRelErr))
-                for sel in selections])
+    zns = dict(zip(selections, binomialExpZ([sigScale*countsPerSelSig[sel] for sel in selections],
+                                            [countsPerSelBkg[sel] for sel in selections],
+                                            bkgRelErr)))
     return max(zns.iteritems(), key=operator.itemgetter(1)) # returns (sel, Zn_value)
 def buildPadMaster(points, histoname='padmaster', histotitle='') :
     points = [dict(p) for p in points]
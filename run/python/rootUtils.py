@@ -9,8 +9,14 @@ try:
     import numpy as np
 except ImportError:
     print "missing numpy: some functions will not be available"
+try:
+    from root_numpy import tree2array
+except ImportError:
+    tree2array = None # fall back on TTree::Draw in treeToArrays
 from utils import verticalSlice
+import array
 import math
+import unittest
 
 def importRoot() :
     import ROOT as r
@@ -68,10 +74,8 @@ def getMinMaxFromTGraphAsymmErrors(gr) :
     y_eh = np.array([abs(gr.GetErrorYhigh(i)) for i in points])
     return (min(y-y_el), max(y+y_eh)) if points else None
 def getMinMaxFromTH1(h) :
-    bins = range(1, 1+h.GetNbinsX())
-    y   = np.array([h.GetBinContent(b) for b in bins])
-    y_e = np.array([h.GetBinError(b)   for b in bins])
-    return (min(y-y_e), max(y+y_e)) if bins else None
+    y, y_e = innerBins(binContentsArray(h)), innerBins(binErrorsArray(h))
+    return (min(y-y_e), max(y+y_e)) if len(y) else None
 def getMinMax(histosOrGraphs=[]) :
     def mM(obj) :
         cname = obj.Class().GetName()
@@ -118,19 +122,27 @@ def cloneAndFillHisto(histo, bincontents=[], suffix='', zeroErr=True) :
     h, bc= histo, bincontents
     assert h.GetNbinsX()==len(bc),"%d bincontents for %d bins"%(len(bc), h.GetNbinsX())
     h = h.Clone(h.GetName()+suffix)
-    for i, c in enumerate(bc) :
-        h.SetBinContent(i+1, c)
-        if zeroErr : h.SetBinError(i+1, 0.)
-    return h
+    contents = binContentsArray(h).copy()
+    contents[1:-1] = bc
+    sumw2 = None
+    if zeroErr :
+        sumw2 = binSumw2Array(h)
+        sumw2 = contents.copy() if sumw2 is None else sumw2.copy() # SetBinError would enable the sumw2
+        sumw2[1:-1] = 0.
+    return setBinContentsArray(h, contents, sumw2)
 
 def cumEffHisto(histoTemplate, bincontents=[], leftToRight=True) :
     h, bc= histoTemplate, bincontents
     assert h.GetNbinsX()==len(bc),"%d bincontents for %d bins"%(len(bc), h.GetNbinsX())
     h = h.Clone(h.GetName()+'_ce')
+    bc = np.asarray(bc, dtype=np.float64)
     tot = bc[-1] if leftToRight else bc[0]
-    for i, c in enumerate(bc) :
-        h.SetBinContent(i+1, c/tot if tot else 0.)
-        h.SetBinError(i+1, 0.)
+    contents = binContentsArray(h).copy()
+    contents[1:-1] = bc/tot if tot else 0.
+    sumw2 = binSumw2Array(h)
+    sumw2 = contents.copy() if sumw2 is None else sumw2.copy()
+    sumw2[1:-1] = 0.
+    setBinContentsArray(h, contents, sumw2)
     h.SetMinimum(0.0)
     h.SetMaximum(1.0)
     h.SetTitle('')
@@ -139,14 +151,9 @@ def cumEffHisto(histoTemplate, bincontents=[], leftToRight=True) :
 def maxSepVerticalLine(hSig, hBkg, yMin=0.0, yMax=1.0) :
     nxS, nxB = hSig.GetNbinsX(), hBkg.GetNbinsX()
     assert nxS==nxB,"maxSepVerticalLine : histos with differen binning (%d!=%d)"%(nxS,nxB)
-    bcS = [hSig.GetBinContent(i) for i in range(1,1+nxS)]
-    bcB = [hBkg.GetBinContent(i) for i in range(1,1+nxB)]
-    def indexMaxDist(bcS, bcB) :
-        return sorted([(i,d) for i,d in enumerate([abs(a-b) for a,b in zip(bcS, bcB)])],
-                      key= lambda x : x[1])[-1][0]
-    iMax = indexMaxDist(bcS, bcB)
+    sep = np.abs(innerBins(binContentsArray(hSig)) - innerBins(binContentsArray(hBkg)))
+    iMax = len(sep) - 1 - int(np.argmax(sep[::-1])) # last bin with the max separation, as the sorted() it replaces
     xPos = hSig.GetBinCenter(iMax+1)
-    sep = [abs(a-b) for a,b in zip(bcS, bcB)]
     return r.TLine(xPos, yMin, xPos, yMax)
 
 def topRightLabel(pad, label, xpos=None, ypos=None, align=33) :
@@ -160,31 +167,146 @@ def topRightLabel(pad, label, xpos=None, ypos=None, align=33) :
 def drawAtlasLabel(pad, xpos=None, ypos=None, align=33) :
     label = "#bf{#it{ATLAS}} Internal, #sqrt{s} = 8 TeV, 20.3 fb^{-1}"
     return topRightLabel(pad, label, xpos, ypos, align)
+def histoShape(h) :
+    "(nx+2[, ny+2[, nz+2]]): the number of bins along each axis, including the under/overflows"
+    dim = h.GetDimension()
+    return tuple(n+2 for n in [h.GetNbinsX(), h.GetNbinsY(), h.GetNbinsZ()][:dim])
+def bufferArray(buff, size, dtype) :
+    "numpy array sharing the memory of a PyROOT buffer (e.g. from TArrayD::GetArray)"
+    buff.SetSize(size)
+    return np.frombuffer(buff, dtype=dtype, count=size)
+arrayDtypes = [('TArrayD', np.float64), ('TArrayF', np.float32), ('TArrayI', np.int32),
+               ('TArrayS', np.int16), ('TArrayC', np.int8)]
+def binContentsArray(h) :
+    """Bin contents of a TH1/TH2/TH3, including the under/overflows, as
+    a numpy array indexed [ix, iy, iz] (see histoShape). This is a view
+    of the histogram buffer: writing to it changes the histogram (but
+    not its stats, see setBinContentsArray)."""
+    shape = histoShape(h)
+    dtype = next(d for c, d in arrayDtypes if h.InheritsFrom(c))
+    return bufferArray(h.GetArray(), h.GetSize(), dtype).reshape(shape[::-1]).T # root bins have x running fastest
+def binSumw2Array(h) :
+    "same as binContentsArray, for the sum of the squared weights; None if the histogram does not have them"
+    if not h.GetSumw2N() : return None
+    return bufferArray(h.GetSumw2().GetArray(), h.GetSize(), np.float64).reshape(histoShape(h)[::-1]).T
+def binErrorsArray(h) :
+    "bin errors as TH1::GetBinError (sqrt(sumw2), or sqrt(|content|) without sumw2)"
+    sumw2 = binSumw2Array(h)
+    return np.sqrt(sumw2) if sumw2 is not None else np.sqrt(np.abs(binContentsArray(h).astype(np.float64)))
+def setBinContentsArray(h, contents, sumw2=None) :
+    """Write back the arrays with the shape of binContentsArray
+    (contents and, optionally, sumw2, which is enabled if needed), then
+    recompute the histogram stats from the bin contents."""
+    np.copyto(binContentsArray(h), contents, casting='unsafe')
+    if sumw2 is not None :
+        if not h.GetSumw2N() : h.Sumw2()
+        np.copyto(binSumw2Array(h), sumw2)
+    h.ResetStats()
+    return h
+def innerBins(a) :
+    "drop the under/overflows from an array with the shape of binContentsArray"
+    return a[tuple(slice(1, -1) for d in a.shape)]
 def getBinIndices(h) :
     "Return a list of the internal indices used by TH1/TH2/TH3; see TH1::GetBin for info on internal mapping"
     cname = h.Class().GetName()
-    if   cname.startswith('TH1') :
-        return [h.GetBin(i)
-                for i in range(1, 1+h.GetNbinsX())]
-    elif cname.startswith('TH2') :
-        return [h.GetBin(i, j)
-                for i in range(1, 1+h.GetNbinsX())
-                for j in range(1, 1+h.GetNbinsY())]
-    elif cname.startswith('TH3') :
-        return [h.GetBin(i, j, k)
-                for i in range(1, 1+h.GetNbinsX())
-                for j in range(1, 1+h.GetNbinsY())
-                for k in range(1, 1+h.GetNbinsZ())]
-    else : return []
+    if not cname.startswith(('TH1', 'TH2', 'TH3')) : return []
+    bins = np.arange(h.GetSize()).reshape(histoShape(h)[::-1]).T # [ix, iy, iz] -> global bin
+    return [int(b) for b in innerBins(bins).ravel()]
 def getBinCenters(h) :
     bins = getBinIndices(h)
     return [h.GetBinCenter(b) for b in bins]
 def getBinContents(h) :
-    bins = getBinIndices(h)
-    return [h.GetBinContent(b) for b in bins]
+    return [float(c) for c in innerBins(binContentsArray(h)).ravel()]
 def binContentsWithUoflow(h) :
-    nBinsX = h.GetNbinsX()+1
-    return [h.GetBinContent(0)] + [h.GetBinContent(i) for i in range(1, nBinsX)] + [h.GetBinContent(nBinsX+1)]
+    return [float(c) for c in binContentsArray(h)]
+def binContents2dFolded(h) :
+    "array [ix, iy] of the TH2 bin contents, with the under/overflows folded in the first/last bins"
+    nx, ny = h.GetNbinsX(), h.GetNbinsY()
+    contents = binContentsArray(h).astype(np.float64) # copy
+    contents[1, :] += contents[0, :]
+    contents[nx, :] += contents[nx+1, :]
+    contents[:, 1] += contents[:, 0]
+    contents[:, ny] += contents[:, ny+1]
+    return contents[1:nx+1, 1:ny+1]
+def binEdges(axis) :
+    "array of the nbins+1 low edges of a TAxis"
+    return np.array([axis.GetBinLowEdge(b) for b in range(1, axis.GetNbins()+2)])
+def treeToArrays(tree, branches=[], start=0, stop=None) :
+    """Read the entries [start, stop) of some scalar branches (or
+    expressions) in bulk; return a dict of float64 numpy arrays.
+    Use root_numpy when available, otherwise TTree::Draw with at most
+    4 columns at the time (GetV1...GetV4).
+    """
+    nEntries = tree.GetEntries()
+    stop = nEntries if stop is None else min(stop, nEntries)
+    nToRead = max(0, stop-start)
+    if not nToRead : return dict((b, np.zeros(0)) for b in branches)
+    if tree2array :
+        arr = tree2array(tree, branches=branches, start=start, stop=stop)
+        return dict((b, np.asarray(arr[b], dtype=np.float64)) for b in branches)
+    columns = dict()
+    maxColumns = 4
+    tree.SetEstimate(nToRead+1)
+    for i in range(0, len(branches), maxColumns) :
+        chunk = branches[i:i+maxColumns]
+        nRead = tree.Draw(':'.join(chunk), '', 'goff', nToRead, start)
+        for j, b in enumerate(chunk) :
+            buff = getattr(tree, "GetV%d"%(j+1))()
+            buff.SetSize(nRead)
+            columns[b] = np.array(buff, dtype=np.float64) # copy: the buffers are reused by the next Draw
+    return columns
+def binIndicesTH1(h, values) :
+    "Vectorized TAxis::FindBin along x: 0 for underflow, nbins+1 for overflow"
+    xAx = h.GetXaxis()
+    nBins, xMin, xMax = xAx.GetNbins(), xAx.GetXmin(), xAx.GetXmax()
+    values = np.asarray(values, dtype=np.float64)
+    if xAx.GetXbins().GetSize() :
+        edges = np.array([xAx.GetBinLowEdge(b) for b in range(1, nBins+2)])
+        return np.searchsorted(edges, values, side='right')
+    bins = np.empty(len(values), dtype=np.int64)
+    under, over = values < xMin, values >= xMax
+    inRange = ~(under | over)
+    bins[under], bins[over] = 0, nBins+1
+    bins[inRange] = 1 + (nBins*(values[inRange]-xMin)/(xMax-xMin)).astype(np.int64)
+    return bins
+def fillHistoWithArrays(h, values, weights=None) :
+    """Same as calling h.Fill(v, w) for each value, but with one
+    bincount per array rather than one python call per entry. The
+    stats (entries, sumw, sumw2, sumwx, sumwx2) are updated as in TH1::Fill.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+    return fillHistosWithWeightMatrix([h], values, weights.reshape(-1, 1))[0]
+def fillHistosWithWeightMatrix(histos, values, weights) :
+    """Fill histos[k] with the values and the weights weights[:,k];
+    the histograms must have the same binning: the bin indices are
+    computed once and there is one bincount per column.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    assert weights.shape==(len(values), len(histos)),"weights %s for %d values and %d histos"%(str(weights.shape), len(values), len(histos))
+    if not len(values) or not len(histos) : return histos
+    h0 = histos[0]
+    nBins = h0.GetNbinsX()
+    bins = binIndicesTH1(h0, values)
+    inRange = (bins>0) & (bins<=nBins)
+    x = values[inRange]
+    for k, h in enumerate(histos) :
+        w = weights[:,k]
+        sumw  = np.bincount(bins, weights=w,   minlength=nBins+2)
+        sumw2 = np.bincount(bins, weights=w*w, minlength=nBins+2)
+        entries = h.GetEntries()
+        stats = array.array('d', 13*[0.0]) # 13 = TH1::kNstat, large enough for any TH1
+        h.GetStats(stats)
+        if not h.GetSumw2N() and (w!=1.0).any() : h.Sumw2() # as TH1::Fill with a weight
+        contents = binContentsArray(h)
+        contents += sumw.astype(contents.dtype)
+        if h.GetSumw2N() : binSumw2Array(h)[...] += sumw2
+        w = w[inRange]
+        for i, v in enumerate([w.sum(), (w*w).sum(), (w*x).sum(), (w*x*x).sum()]) : stats[i] += v
+        h.PutStats(stats)
+        h.SetEntries(entries + len(values))
+    return histos
 def reverseLegendOrder(leg) :
     "to be implemented"
 def integralAndError(h) :
@@ -259,3 +381,43 @@ def graphWithPoissonError(histo, fillZero=False) :
             gr.SetPointError(point, xErr, xErr, ed, eu)
     histo._poissonErr = gr # attach to histo for persistency
     return gr
+
+#
+# testing
+#
+class BinArraysVsGetBinContent(unittest.TestCase) :
+    "the buffer views should match the bin-by-bin accessors, and write back to the histogram"
+    def testTH2(self) :
+        h = r.TH2F('test_bin_arrays', '', 4, 0.0, 4.0, 3, 0.0, 3.0)
+        h.SetDirectory(0)
+        h.Sumw2()
+        for x, y, w in [(-1.0, 0.5, 1.0), (0.5, 0.5, 2.0), (3.5, 1.5, 3.0), (5.0, 4.0, 4.0), (2.5, 2.5, 0.5)] : h.Fill(x, y, w)
+        contents, sumw2 = binContentsArray(h), binSumw2Array(h)
+        self.assertEqual(contents.shape, (6, 5))
+        for i in range(6) :
+            for j in range(5) :
+                self.assertAlmostEqual(contents[i, j], h.GetBinContent(i, j))
+                self.assertAlmostEqual(sumw2[i, j], h.GetBinError(i, j)**2, places=5)
+        self.assertEqual(getBinContents(h), [h.GetBinContent(b) for b in getBinIndices(h)])
+        setBinContentsArray(h, 2.0*contents, 4.0*sumw2)
+        self.assertAlmostEqual(h.GetBinContent(1, 1), 4.0)
+        self.assertAlmostEqual(h.GetBinError(1, 1), 4.0, places=5)
+class ArrayFillVsTH1Fill(unittest.TestCase) :
+    "filling the same histogram several times with arrays should give the same bins and errors as TH1::Fill"
+    def testFillTwice(self) :
+        rnd = np.random.RandomState(2014)
+        h = r.TH1F('test_array_fill', '', 10, 0.0, 5.0)
+        reference = r.TH1F('test_array_fill_reference', '', 10, 0.0, 5.0)
+        for hh in [h, reference] : hh.SetDirectory(0)
+        for iFill in range(2) :
+            values, weights = rnd.uniform(-1.0, 6.0, 200), rnd.uniform(0.5, 1.5, 200)
+            fillHistoWithArrays(h, values, weights)
+            for v, w in zip(values, weights) : reference.Fill(v, w)
+        self.assertAlmostEqual(h.GetEntries(), reference.GetEntries())
+        self.assertAlmostEqual(h.GetMean(), reference.GetMean(), places=5)
+        for b in range(12) :
+            self.assertAlmostEqual(h.GetBinContent(b), reference.GetBinContent(b), places=4)
+            self.assertAlmostEqual(h.GetBinError(b), reference.GetBinError(b), places=4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,8 @@
 
 # Consider the distribution of one variable, and plot sensitivity Z_n
 # as a function of the minimum value of the variable.
+# With --histo2d, consider a TH2 and plot Z_n as a function of
+# (x_min, y_min), or (x_min, y_max) with --y-max.
 #
 # Inputs:
 # - the root files produced by SusyPlot, for signal and backgrounds
@@ -11,10 +13,15 @@
 
 
 import collections, optparse, os, sys, glob
+import numpy as np
 from rootUtils import importRoot
 r = importRoot()
 from NavUtils import getAllHistoNames, HistoNameClassifier, HistoType, organizeHistosByType, setHistoType, setHistoSample
 from SampleUtils import colors, guessSampleFromFilename
+from utils import filesIdentityKey, mkdirIfNeeded
+from rootUtils import getBinContents, binContents2dFolded, binEdges
+from selectionScan import bestCorner2d
+from significance import znArray
 
 #########
 # default parameters [begin]
@@ -25,6 +32,7 @@ defaultRefSyst  = 'NOM'
 defaultSigFile  = './anaplots/wA_noslep_WH_2Lep_2_Jan21_n0115.AnaHists.root'
 defaultInputDir = './anaplots/merged'
 defaultRegions  = ','.join(["sr%d"%i for i in [6,7,8,9]])
+defaultBkgStore = '/tmp/bkg_store'
 # default parameters [end]
 #########
 
@@ -37,10 +45,16 @@ parser.add_option("-t", "--tag", dest="tag", default=defaultTag,
                   help="production tag (default '%s')" % defaultTag)
 parser.add_option("-H", "--histo", dest="histo", default=defaultHisto,
                   help="histogram to get the counts from (default '%s')" % defaultHisto)
+parser.add_option("-2", "--histo2d", dest="histo2d", default=None,
+                  help="TH2 to scan the (x_min, y_min) corners of, instead of --histo")
+parser.add_option("-y", "--y-max", action="store_true", dest="yMax", default=False,
+                  help="with --histo2d, scan (x_min, y_max) instead of (x_min, y_min)")
 parser.add_option("-R", "--regions", dest="regions", default=defaultRegions,
                   help="plot regions (default '%s')" % str(defaultRegions))
 parser.add_option("-s", "--sig-file", dest="sig", default=defaultSigFile,
-                  help="signal file, default : %s" % defaultSigFile)
+                  help="signal file, or wildcard for several signal points, default : %s" % defaultSigFile)
+parser.add_option("-b", "--bkg-store", dest="bkgStore", default=defaultBkgStore,
+                  help="store the summed background histograms here, to reuse them with other signals (default '%s'; '' to disable)" % defaultBkgStore)
 parser.add_option("-S", "--syst", dest="syst", default=defaultRefSyst,
                   help="systematic (default '%s')" % defaultRefSyst)
 parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
@@ -50,9 +64,12 @@ channel         = options.channel
 inputDir        = options.inputdir
 signalFname     = options.sig
 prodTag         = options.tag
-referenceHisto  = options.histo
+is2d            = options.histo2d is not None
+referenceHisto  = options.histo2d if is2d else options.histo
+yMax            = options.yMax
 plotRegions     = options.regions.split(',')
 referenceSyst   = options.syst
+bkgStore        = options.bkgStore
 verbose         = options.verbose
 assert channel in validChannels,"Invalid channel %s (should be one of %s)" % (channel, str(validChannels))
 inputFileNames = glob.glob(inputDir+'/'+'*'+prodTag+'*.root') + glob.glob(signalFname)
@@ -61,62 +78,112 @@ assert len(inputFileNames)==len(inputFiles),"Cannot open some of the input files
 
 
 refHistoType = HistoType(pr='', ch=channel, var=referenceHisto, syst=referenceSyst)
-histosByType = collections.defaultdict(list)
 classifier = HistoNameClassifier()
 
-for fname, infile in zip(inputFileNames, inputFiles) :
+def isSignal(sampleName) : return 'WH_' in sampleName
+def readRefHistos(fname, infile) :
     samplename = guessSampleFromFilename(fname)
-    histoNames = [n for n in getAllHistoNames(infile, onlyTH1=True)
+    histoNames = [n for n in getAllHistoNames(infile, onlyTH1=not is2d, onlyTH2=is2d)
                   if refHistoType.matchAllAvailabeAttrs( classifier.histoType( n ) )]
     histos = [infile.Get(hn) for hn in histoNames]
     for h in histos :
         setHistoType(h, classifier.histoType(h.GetName()))
         setHistoSample(h, samplename)
-    histos = [h for h in histos if h.type.pr in plotRegions]
-    organizeHistosByType(histosByType, histos)
-refHistos = histosByType # already filtered histonames, all histosByType are refHistos
+    return [h for h in histos if h.type.pr in plotRegions]
 
-def isSignal(sampleName) : return 'WH_' in sampleName
-allSamples = list(set([h.sample for histos in refHistos.values() for h in histos]))
-allBkgNames  = [s for s in allSamples if not isSignal(s)]
-sigName = next(s for s in allSamples if isSignal(s))
-if verbose : print '\n'.join("%s : %s" % (s,l) for s,l in zip(['bkg','sig'], [str(allBkgNames), sigName]))
+sigFileNames = [f for f in inputFileNames if isSignal(str(guessSampleFromFilename(f)))]
+bkgFileNames = [f for f in inputFileNames if f not in sigFileNames]
+if verbose : print '\n'.join("%s : %s" % (s,l) for s,l in zip(['bkg','sig'], [str(bkgFileNames), str(sigFileNames)]))
+
+def sumBkgHistos(bkgFileNames) :
+    "dict[HistoType] of the background histograms summed over all the background files"
+    bkgHistosByType = dict()
+    for fname in bkgFileNames :
+        for h in readRefHistos(fname, inputFiles[inputFileNames.index(fname)]) :
+            t = h.type
+            if t in bkgHistosByType : bkgHistosByType[t].Add(h)
+            else : bkgHistosByType[t] = h
+    return bkgHistosByType
 
-bkgHistosByType, sigHistosByType = dict(), dict()
-for t,histos in histosByType.iteritems() :
-    for h in histos:
-        n = h.GetName()
-        if isSignal(h.sample) : sigHistosByType[t] = h
-        elif t in bkgHistosByType : bkgHistosByType[t].Add(h)
-        else : bkgHistosByType[t] = h
+def storedBkgHistos(bkgFileNames, storeDir) :
+    """Same as sumBkgHistos, but the sums are saved to a file in
+    storeDir keyed by the background files and by the histogram
+    selection, so that they are read back when only the signal changes."""
+    settings = repr((channel, referenceHisto, is2d, sorted(plotRegions), referenceSyst))
+    storeName = os.path.join(storeDir, 'bkg_histos_'+filesIdentityKey(bkgFileNames, settings)+'.root')
+    if os.path.exists(storeName) :
+        if verbose : print "reading the background histograms from %s"%storeName
+        storeFile = r.TFile.Open(storeName)
+        histos = [storeFile.Get(n) for n in getAllHistoNames(storeFile, onlyTH1=not is2d, onlyTH2=is2d)]
+        for h in histos :
+            h.SetDirectory(0)
+            setHistoType(h, classifier.histoType(h.GetName()))
+            setHistoSample(h, 'bkg')
+        storeFile.Close()
+        return dict((h.type, h) for h in histos)
+    bkgHistosByType = sumBkgHistos(bkgFileNames)
+    mkdirIfNeeded(storeDir)
+    tmpName = os.path.join(storeDir, '.tmp_%d_'%os.getpid()+os.path.basename(storeName))
+    storeFile = r.TFile.Open(tmpName, 'recreate')
+    storeFile.cd()
+    for h in bkgHistosByType.values() : h.Write()
+    storeFile.Close()
+    os.rename(tmpName, storeName)
+    return bkgHistosByType
+
+bkgHistosByType = storedBkgHistos(bkgFileNames, bkgStore) if bkgStore else sumBkgHistos(bkgFileNames)
 
 def buildHistoSigVsMinThres(bkgHisto, sigHisto, bkgErr=0.2) :
     assert bkgHisto.GetNbinsX()==sigHisto.GetNbinsX(),"need the same binning to build scan"
     h = bkgHisto.Clone(bkgHisto.GetName()+'significance')
     xAx = h.GetXaxis()
     xAx.SetTitle('minimum '+xAx.GetTitle())
-    bins = range(1, h.GetNbinsX()+1)[::-1]
-    nB, nS = 0., 0.
-    for b in bins :
-        nB = nB + bkgHisto.GetBinContent(b)
-        nS = nS + sigHisto.GetBinContent(b)
-        zn = r.RooStats.NumberCountingUtils.BinomialExpZ(nS, nB, bkgErr) if nB else 0.0
-        h.SetBinContent(b, zn)
-        h.SetBinError(b, 0.)
+    nB = np.cumsum(getBinContents(bkgHisto)[::-1])[::-1]
+    nS = np.cumsum(getBinContents(sigHisto)[::-1])[::-1]
+    for b, zn in enumerate(znArray(nS, nB, bkgErr, minSig=-np.inf)) :
+        h.SetBinContent(b+1, zn)
+        h.SetBinError(b+1, 0.)
     return h
 
-for t,hSig in sigHistosByType.iteritems() :
-    hBkg = bkgHistosByType[t]
-    hZn  = buildHistoSigVsMinThres(hBkg, hSig)
-    hZn.SetTitle(str(hBkg.type))
-    print "%s : max %.3f Z_n at %.2f" % (str(t), hZn.GetMaximum(), hZn.GetBinCenter(hZn.GetMaximumBin()))
-    s = "%s_%s_%s" % (t.pr, t.ch, t.var)
-    c = r.TCanvas(s, s, 800, 600)
-    c.cd()
-    hZn.SetStats(0)
-    hZn.Draw()
-    pname = s+'.png'
-    if os.path.exists(pname) : os.remove(pname)
-    c.SaveAs(s+'.png')
+def buildHistoSigVsCorner(bkgHisto, sigHisto, yMax=False, bkgErr=0.2) :
+    """TH2 of Z_n vs. (x_min, y_min) or (x_min, y_max); the bin (i, j)
+    is the corner at the low x edge of bin i and at the low (high) y
+    edge of bin j. Return the histogram and the best corner."""
+    assert (bkgHisto.GetNbinsX(), bkgHisto.GetNbinsY())==(sigHisto.GetNbinsX(), sigHisto.GetNbinsY()),"need the same binning to build scan"
+    xEdges, yEdges = binEdges(bkgHisto.GetXaxis()), binEdges(bkgHisto.GetYaxis())
+    zn, best = bestCorner2d(binContents2dFolded(sigHisto), binContents2dFolded(bkgHisto), xEdges, yEdges, yMax,
+                            bkgErr, minBkg=0.0, minSig=-np.inf)
+    h = bkgHisto.Clone(bkgHisto.GetName()+'significance')
+    h.Reset()
+    xAx, yAx = h.GetXaxis(), h.GetYaxis()
+    xAx.SetTitle('minimum '+xAx.GetTitle())
+    yAx.SetTitle(('maximum ' if yMax else 'minimum ')+yAx.GetTitle())
+    for (i, j), z in np.ndenumerate(zn) :
+        h.SetBinContent(i+1, j+1, z)
+    return h, best
 
-    
+multipleSignals = len(sigFileNames) > 1
+for sigFname in sigFileNames :
+    for hSig in readRefHistos(sigFname, inputFiles[inputFileNames.index(sigFname)]) :
+        t = hSig.type
+        if t not in bkgHistosByType : continue
+        hBkg = bkgHistosByType[t]
+        label = hSig.sample+' ' if multipleSignals else ''
+        if is2d :
+            hZn, (zn, nS, nB, xMin, yCut) = buildHistoSigVsCorner(hBkg, hSig, yMax)
+            print "%s%s : max %.3f Z_n (sig %.2f, bkg %.2f) at x > %.2f, y %s %.2f" % (label, str(t), zn, nS, nB,
+                                                                                    xMin, '<' if yMax else '>', yCut)
+        else :
+            hZn  = buildHistoSigVsMinThres(hBkg, hSig)
+            print "%s%s : max %.3f Z_n at %.2f" % (label, str(t),
+                                                  hZn.GetMaximum(), hZn.GetBinCenter(hZn.GetMaximumBin()))
+        hZn.SetTitle(str(hBkg.type))
+        s = "%s_%s_%s" % (t.pr, t.ch, t.var)
+        if multipleSignals : s = "%s_%s" % (hSig.sample, s)
+        c = r.TCanvas(s, s, 800, 600)
+        c.cd()
+        hZn.SetStats(0)
+        hZn.Draw('colz' if is2d else '')
+        pname = s+'.png'
+        if os.path.exists(pname) : os.remove(pname)
+        c.SaveAs(s+'.png')
@@ -0,0 +1,205 @@
+# Scan the signal-region thresholds of optimizeSelection on a grid
+#
+# The per-event variables come from derivedVariables. For each sample
+# and channel, the events are histogrammed in the number of grid
+# thresholds that they pass for each variable; the yields for all the
+# working points are then the reverse cumulative sums of this
+# histogram, so that the cost does not depend on the number of events
+# times the number of working points.
+#
+# davide.gerbaudo@gmail.com
+# April 2014
+
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from derivedVariables import derivedVariables, codeVersion, defaultCacheDir, dilepTypes, mZcandIsInWindow
+from utils import filesIdentityKey, sourceDigest, mkdirIfNeeded
+from significance import znArray
+from rootUtils import importRoot
+r = importRoot()
+
+cutDirections = {'pt0'     : '>',
+                 'pt1'     : '>',
+                 'detall'  : '<',
+                 'mtmax'   : '>',
+                 'ht'      : '>',
+                 'mlj'     : '<',
+                 'mljj'    : '<',
+                 'mtllmet' : '>',
+                 }
+defaultThresholds = {'pt0'     : [20.0, 25.0, 30.0, 35.0, 40.0],
+                     'pt1'     : [10.0, 15.0, 20.0, 25.0, 30.0, 35.0],
+                     'detall'  : [3.0, 2.5, 2.0, 1.75, 1.5, 1.25, 1.0],
+                     'mtmax'   : [0.0, 80.0, 90.0, 100.0, 110.0, 120.0, 130.0, 140.0],
+                     'ht'      : [0.0, 160.0, 180.0, 200.0, 220.0, 240.0, 260.0],
+                     'mlj'     : [200.0, 120.0, 100.0, 90.0, 80.0, 70.0],
+                     'mljj'    : [200.0, 140.0, 130.0, 120.0, 110.0, 100.0, 90.0],
+                     'mtllmet' : [0.0, 80.0, 90.0, 100.0, 110.0, 120.0, 130.0, 140.0, 150.0, 160.0],
+                     }
+
+def scanVariables(nj) :
+    "the variables with a threshold in passSelection (l3Veto and the ee Z veto are always applied)"
+    return ['pt0', 'pt1', 'detall', 'mtmax', 'ht', 'mlj', 'mtllmet'] if nj=='eq1j' else ['pt0', 'pt1', 'detall', 'ht', 'mljj', 'mtllmet']
+
+def llnjKey(ll, nj) : return "%s_%s"%(ll, nj)
+
+class ScanGrid(object) :
+    """Thresholds for each variable, ordered from the loosest to the
+    tightest one, so that an event passing the i-th threshold also
+    passes all the previous ones"""
+    def __init__(self, variables, thresholds=defaultThresholds) :
+        self.variables = variables
+        self.thresholds = [np.array(sorted(thresholds[v], reverse=cutDirections[v]=='<'), dtype=np.float64) for v in variables]
+    @property
+    def shape(self) : return tuple(len(t) for t in self.thresholds)
+    @property
+    def nPoints(self) : return int(np.prod(self.shape))
+    def workingPoint(self, index) :
+        "index is a tuple (or a flat index); return the list of thresholds"
+        if np.isscalar(index) : index = np.unravel_index(index, self.shape)
+        return [t[i] for t, i in zip(self.thresholds, index)]
+    def nPassedThresholds(self, variable, values) :
+        "for each event, the number of thresholds it passes (i.e. it passes all the indices < this number)"
+        thres = self.thresholds[self.variables.index(variable)]
+        values = np.asarray(values)
+        if cutDirections[variable]=='>' : return np.searchsorted(thres, values, side='left')
+        else : return np.searchsorted(-thres, -values, side='left') # thresholds are decreasing
+
+def channelMask(columns, ll, nj) :
+    "events in the ll/nj channel, passing the cuts that are not scanned"
+    mask = (np.asarray(columns['dilepType'])==dilepTypes.index(ll)) & ~mZcandIsInWindow(columns['mZcand'])
+    nJets = np.asarray(columns['nJets'])
+    mask &= (nJets==1) if nj=='eq1j' else (nJets>1)
+    if ll=='ee' : mask &= np.abs(np.asarray(columns['mll']) - 91.2) > 10.0
+    return mask
+
+def gridYields(columns, mask, grid) :
+    "array with grid.shape of the weighted yields at each working point"
+    nPassed = [grid.nPassedThresholds(v, np.asarray(columns[v])[mask]) for v in grid.variables]
+    dims = tuple(n+1 for n in grid.shape)
+    counts = np.bincount(np.ravel_multi_index(nPassed, dims), weights=np.asarray(columns['weight'])[mask],
+                         minlength=int(np.prod(dims))).reshape(dims)
+    for axis in range(len(dims)) : # yield[i] = sum of the events with nPassed > i
+        counts = np.flip(np.cumsum(np.flip(counts, axis), axis=axis), axis)
+    return counts[tuple(slice(1, None) for d in dims)]
+
+def sampleGridYields(columns, lls, njs, thresholds=defaultThresholds) :
+    "dict[ll_nj] of grid yields for one sample"
+    return dict((llnjKey(ll, nj), gridYields(columns, channelMask(columns, ll, nj), ScanGrid(scanVariables(nj), thresholds)))
+                for ll in lls for nj in njs)
+
+def totalGridYields(filenames, lls, njs, cacheDir=defaultCacheDir, storeDir=None, thresholds=defaultThresholds, verbose=False) :
+    """dict[ll_nj] of the grid yields summed over several samples (e.g.
+    all the backgrounds). With storeDir, the sum is stored in a .npz
+    file keyed by the input files, channels, thresholds and code
+    version, and it is computed only the first time."""
+    storeFile = None
+    if storeDir :
+        settings = repr((sorted(lls), sorted(njs), sorted((v, list(t)) for v, t in thresholds.iteritems())))
+        key = filesIdentityKey(filenames, settings + codeVersion() + sourceDigest([__file__]))
+        storeFile = os.path.join(storeDir, 'grid_yields_'+key+'.npz')
+        if os.path.exists(storeFile) :
+            if verbose : print "reading the stored grid yields from %s"%storeFile
+            stored = np.load(storeFile)
+            return dict((k, stored[k]) for k in stored.files)
+    total = None
+    for filename in filenames :
+        if verbose : print "grid yields for %s"%filename
+        yields = sampleGridYields(derivedVariables(filename, 'SusySel', cacheDir), lls, njs, thresholds)
+        total = yields if total is None else dict((k, total[k] + y) for k, y in yields.iteritems())
+    if storeFile and total is not None :
+        mkdirIfNeeded(storeDir)
+        tmpFd, tmpName = tempfile.mkstemp(dir=storeDir, prefix='.tmp_', suffix='.npz')
+        with os.fdopen(tmpFd, 'wb') as f : np.savez(f, **total)
+        os.rename(tmpName, storeFile)
+    return total
+
+def znValues(sig, bkg, bkgUnc=0.3, minBkg=4.0, minSig=0.01) :
+    "Zn at each working point; 0.0 where there is not enough signal or background (as in optimizeSelection.drawTop)"
+    return znArray(sig, bkg, bkgUnc, minBkg, minSig)
+
+def rankWorkingPoints(sig, bkg, grid, nTop=10, bkgUnc=0.3) :
+    "the nTop working points with the highest Zn, as a list of (zn, sig, bkg, thresholds)"
+    zn = znValues(sig, bkg, bkgUnc).ravel()
+    best = np.argsort(-zn, kind='mergesort')[:nTop]
+    return [(zn[i], sig.ravel()[i], bkg.ravel()[i], grid.workingPoint(i)) for i in best]
+
+def cornerYields2d(contents, yMax=False) :
+    """Yields for all the (x_min, y_min) corners, or (x_min, y_max)
+    with yMax. contents[i, j] is the content of the bin (x_i, y_j);
+    the result [i, j] is the sum over the bins with i' >= i and j' >= j
+    (j' <= j with yMax)."""
+    yields = np.cumsum(np.asarray(contents, dtype=np.float64)[::-1], axis=0)[::-1]
+    return np.cumsum(yields, axis=1) if yMax else np.cumsum(yields[:, ::-1], axis=1)[:, ::-1]
+
+def columnsHisto2d(columns, mask, xVar, yVar, xEdges, yEdges) :
+    "weighted 2d histogram of two event columns; the values outside the edges are folded in the first and last bins"
+    def fold(values, edges) :
+        edges = np.asarray(edges, dtype=np.float64)
+        return np.clip(np.asarray(values)[mask], edges[0], np.nextafter(edges[-1], edges[0]))
+    contents, _, _ = np.histogram2d(fold(columns[xVar], xEdges), fold(columns[yVar], yEdges), bins=[xEdges, yEdges],
+                                    weights=np.asarray(columns['weight'])[mask])
+    return contents
+
+def bestCorner2d(sigContents, bkgContents, xEdges, yEdges, yMax=False, bkgUnc=0.3, minBkg=4.0, minSig=0.01) :
+    """Zn for all the corners (see cornerYields2d) and the best one,
+    as (zn, sig, bkg, x_min, y_cut). The first x_min (and the first
+    y_min or last y_max) is equivalent to no cut, since the
+    under/overflows are folded in the edge bins."""
+    sig, bkg = cornerYields2d(sigContents, yMax), cornerYields2d(bkgContents, yMax)
+    zn = znValues(sig, bkg, bkgUnc, minBkg, minSig)
+    i, j = np.unravel_index(np.argmax(zn), zn.shape)
+    return zn, (zn[i, j], sig[i, j], bkg[i, j], xEdges[i], yEdges[j+1] if yMax else yEdges[j])
+
+def formatRankedTable(rankedPoints, grid, title='') :
+    header = ' '.join(["%8s"%c for c in ['Zn', 'sig', 'bkg']+[v+cutDirections[v] for v in grid.variables]])
+    lines = [title, header] if title else [header]
+    for zn, s, b, thresholds in rankedPoints :
+        lines.append(' '.join(["%8.3f"%zn, "%8.2f"%s, "%8.2f"%b]+["%8.2f"%t for t in thresholds]))
+    return '\n'.join(lines)
+
+#
+# testing
+#
+class GridVsMasks(unittest.TestCase) :
+    "the cumulative yields should be the same as the ones from explicit masks"
+    def testYields(self) :
+        rnd = np.random.RandomState(2014)
+        n = 1000
+        columns = dict((v, rnd.uniform(0.0, 300.0, n)) for v in ['pt0', 'pt1', 'ht', 'mlj'])
+        columns['weight'] = rnd.uniform(0.5, 1.5, n)
+        thresholds = {'pt0' : [20.0, 100.0, 200.0], 'pt1' : [10.0, 50.0], 'ht' : [0.0, 150.0], 'mlj' : [200.0, 100.0, 90.0]}
+        grid = ScanGrid(['pt0', 'pt1', 'ht', 'mlj'], thresholds)
+        mask = np.ones(n, dtype=bool)
+        yields = gridYields(columns, mask, grid)
+        self.assertEqual(yields.shape, grid.shape)
+        for i in range(grid.nPoints) :
+            index = np.unravel_index(i, grid.shape)
+            passed = mask.copy()
+            for v, t in zip(grid.variables, grid.workingPoint(index)) :
+                passed &= (columns[v] > t) if cutDirections[v]=='>' else (columns[v] < t)
+            self.assertAlmostEqual(yields[index], columns['weight'][passed].sum())
+
+class Corners2dVsMasks(unittest.TestCase) :
+    "the 2d cumulative yields should be the same as the ones from explicit masks"
+    def testYields(self) :
+        rnd = np.random.RandomState(2014)
+        n = 1000
+        columns = {'x' : rnd.uniform(-10.0, 110.0, n), 'y' : rnd.uniform(-10.0, 60.0, n), 'weight' : rnd.uniform(0.5, 1.5, n)}
+        xEdges, yEdges = np.linspace(0.0, 100.0, 11), np.linspace(0.0, 50.0, 6)
+        mask = np.ones(n, dtype=bool)
+        contents = columnsHisto2d(columns, mask, 'x', 'y', xEdges, yEdges)
+        self.assertAlmostEqual(contents.sum(), columns['weight'].sum())
+        x, y, w = columns['x'], columns['y'], columns['weight']
+        for yMax in [False, True] :
+            yields = cornerYields2d(contents, yMax)
+            for i in range(1, len(xEdges)-1) :
+                for j in range(0, len(yEdges)-2) if yMax else range(1, len(yEdges)-1) : # skip the folded bins
+                    passed = (x >= xEdges[i]) & ((y < yEdges[j+1]) if yMax else (y >= yEdges[j]))
+                    self.assertAlmostEqual(yields[i, j], w[passed].sum())
+
+if __name__ == "__main__":
+    unittest.main()
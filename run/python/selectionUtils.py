@@ -0,0 +1,270 @@
+#!/bin/env python
+
+# Evaluate TTreeFormula-like selection strings on columns of numpy arrays
+#
+# The selections used to make the HFT plots are written as TTreeFormula
+# expressions (see check_hft_trees.selectionFormulas). Here we parse the
+# subset of the syntax that we use (&&, ||, !, comparisons, arithmetic,
+# TMath::Abs) so that the same strings can be evaluated on arrays
+# read in bulk from the trees.
+#
+# davide.gerbaudo@gmail.com
+# April 2014
+
+import re
+import unittest
+import numpy as np
+
+tokenRegexp = re.compile(r'\s*(?:'
+                         r'(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+                         r'|(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:::[A-Za-z_][A-Za-z0-9_]*)*)'
+                         r'|(?P<op>&&|\|\||==|!=|<=|>=|<|>|!|\+|-|\*|/|\(|\)|,)'
+                         r')')
+functions = {'TMath::Abs'  : np.abs,
+             'fabs'        : np.abs,
+             'abs'         : np.abs,
+             'TMath::Sqrt' : np.sqrt,
+             'sqrt'        : np.sqrt,
+             }
+comparisons = {'<'  : np.less,
+               '>'  : np.greater,
+               '<=' : np.less_equal,
+               '>=' : np.greater_equal,
+               '==' : np.equal,
+               '!=' : np.not_equal,
+               }
+arithmetics = {'+' : np.add,
+               '-' : np.subtract,
+               '*' : np.multiply,
+               '/' : np.divide,
+               }
+
+def tokenize(formula='') :
+    tokens, pos, formula = [], 0, formula.strip()
+    while pos < len(formula) :
+        match = tokenRegexp.match(formula, pos)
+        if not match or match.end()==pos : raise ValueError("cannot parse '%s' at '%s'"%(formula, formula[pos:]))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+class FormulaParser(object) :
+    """Recursive-descent parser; the nodes are tuples:
+    ('num', value), ('var', name), ('call', function, args),
+    ('not', node), ('neg', node), ('cmp'|'arith', op, lhs, rhs),
+    ('and', nodes), ('or', nodes).
+    """
+    def __init__(self, formula) :
+        self.formula = formula
+        self.tokens = tokenize(formula)
+        self.pos = 0
+    def peek(self) : return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+    def next(self) :
+        token = self.peek()
+        self.pos += 1
+        return token
+    def expect(self, op) :
+        kind, value = self.next()
+        if value!=op : raise ValueError("expected '%s' in '%s', got '%s'"%(op, self.formula, value))
+    def parse(self) :
+        node = self.orExpr()
+        if self.pos!=len(self.tokens) : raise ValueError("trailing tokens in '%s' : %s"%(self.formula, str(self.tokens[self.pos:])))
+        return node
+    def orExpr(self) :
+        nodes = [self.andExpr()]
+        while self.peek()[1]=='||' :
+            self.next()
+            nodes.append(self.andExpr())
+        return nodes[0] if len(nodes)==1 else ('or', tuple(nodes))
+    def andExpr(self) :
+        nodes = [self.cmpExpr()]
+        while self.peek()[1]=='&&' :
+            self.next()
+            nodes.append(self.cmpExpr())
+        return nodes[0] if len(nodes)==1 else ('and', tuple(nodes))
+    def cmpExpr(self) :
+        node = self.addExpr()
+        if self.peek()[1] in comparisons :
+            op = self.next()[1]
+            node = ('cmp', op, node, self.addExpr())
+        return node
+    def addExpr(self) :
+        node = self.mulExpr()
+        while self.peek()[1] in ['+', '-'] :
+            op = self.next()[1]
+            node = ('arith', op, node, self.mulExpr())
+        return node
+    def mulExpr(self) :
+        node = self.unary()
+        while self.peek()[1] in ['*', '/'] :
+            op = self.next()[1]
+            node = ('arith', op, node, self.unary())
+        return node
+    def unary(self) :
+        op = self.peek()[1]
+        if op=='!' : self.next(); return ('not', self.unary())
+        if op=='-' : self.next(); return ('neg', self.unary())
+        if op=='+' : self.next(); return self.unary()
+        return self.primary()
+    def primary(self) :
+        kind, value = self.next()
+        if kind=='num' : return ('num', float(value))
+        if kind=='name' :
+            if self.peek()[1]!='(' : return ('var', value)
+            if value not in functions : raise ValueError("unknown function '%s' in '%s'"%(value, self.formula))
+            self.next()
+            args = [self.orExpr()]
+            while self.peek()[1]==',' :
+                self.next()
+                args.append(self.orExpr())
+            self.expect(')')
+            return ('call', value, tuple(args))
+        if value=='(' :
+            node = self.orExpr()
+            self.expect(')')
+            return node
+        raise ValueError("unexpected token '%s' in '%s'"%(value, self.formula))
+
+def parseFormula(formula='') : return FormulaParser(formula).parse()
+
+def formulaVariables(node) :
+    "set of the leaf names needed to evaluate a parsed formula"
+    kind = node[0]
+    if   kind=='num' : return set()
+    elif kind=='var' : return set([node[1]])
+    elif kind in ['not', 'neg'] : return formulaVariables(node[1])
+    elif kind in ['cmp', 'arith'] : return formulaVariables(node[2]) | formulaVariables(node[3])
+    elif kind=='call' : return set().union(*[formulaVariables(a) for a in node[2]])
+    else : return set().union(*[formulaVariables(n) for n in node[1]])
+
+def asBool(values) : return np.asarray(values)!=0
+
+def evaluateNode(node, columns) :
+    kind = node[0]
+    if   kind=='num'   : return node[1]
+    elif kind=='var'   : return columns[node[1]]
+    elif kind=='not'   : return ~asBool(evaluateNode(node[1], columns))
+    elif kind=='neg'   : return -evaluateNode(node[1], columns)
+    elif kind=='cmp'   : return comparisons[node[1]](evaluateNode(node[2], columns), evaluateNode(node[3], columns))
+    elif kind=='arith' : return arithmetics[node[1]](evaluateNode(node[2], columns), evaluateNode(node[3], columns))
+    elif kind=='call'  : return functions[node[1]](*[evaluateNode(a, columns) for a in node[2]])
+    elif kind=='and'   : return reduce(np.logical_and, [asBool(evaluateNode(n, columns)) for n in node[1]])
+    elif kind=='or'    : return reduce(np.logical_or,  [asBool(evaluateNode(n, columns)) for n in node[1]])
+    raise ValueError("unknown node %s"%str(node))
+
+def evaluateFormula(node, columns={}, nEntries=None) :
+    """Evaluate a parsed formula on a dict of arrays; constant
+    formulas (e.g. '1') are broadcast to nEntries"""
+    nEntries = nEntries if nEntries is not None else len(columns.itervalues().next()) if columns else 0
+    values = evaluateNode(node, columns)
+    return np.zeros(nEntries) + values
+
+def evaluateSelection(node, columns={}, nEntries=None) :
+    "boolean mask of the entries passing a parsed selection formula"
+    return evaluateFormula(node, columns, nEntries)!=0
+
+def formulaString(node) :
+    "inverse of parseFormula (up to whitespace and redundant parentheses)"
+    kind = node[0]
+    if   kind=='num'   : return repr(node[1])
+    elif kind=='var'   : return node[1]
+    elif kind=='not'   : return '!'+formulaString(node[1])
+    elif kind=='neg'   : return '-'+formulaString(node[1])
+    elif kind in ['cmp', 'arith'] : return "(%s%s%s)"%(formulaString(node[2]), node[1], formulaString(node[3]))
+    elif kind=='call'  : return "%s(%s)"%(node[1], ', '.join(formulaString(a) for a in node[2]))
+    elif kind=='and'   : return '('+' && '.join(formulaString(n) for n in node[1])+')'
+    elif kind=='or'    : return '('+' || '.join(formulaString(n) for n in node[1])+')'
+
+def atomicPredicates(node) :
+    "split a formula into the terms of its (possibly nested) top-level &&"
+    return [a for n in node[1] for a in atomicPredicates(n)] if node[0]=='and' else [node]
+
+class SelectionCompiler(object) :
+    """Compile several named selections into the list of their
+    distinct atomic predicates (the terms of the top-level &&).
+    Each predicate is evaluated once per batch and stored as one bit
+    of a per-event predicate bitmask; a selection passes when all its
+    predicate bits are set. The cost therefore scales with the number
+    of distinct cuts rather than with selections x cuts.
+    Both bitmasks are uint64, so at most 64 predicates and 64 selections.
+    """
+    maxBits = 64
+    def __init__(self, namedFormulas=[]) :
+        self.names = [n for n, f in namedFormulas]
+        self.predicates = []
+        self.requiredBits = [] # None for the selections that can never pass
+        indices = dict()
+        for name, formula in namedFormulas :
+            bits = 0
+            for atom in atomicPredicates(parseFormula(formula)) :
+                if atom[0]=='num' :
+                    if atom[1] : continue # always true, e.g. the '1' of the 'pre' regions
+                    bits = None
+                    break
+                if atom not in indices :
+                    indices[atom] = len(self.predicates)
+                    self.predicates.append(atom)
+                bits |= (1 << indices[atom])
+            self.requiredBits.append(bits)
+        if len(self.predicates) > self.maxBits : raise ValueError("%d predicates, max %d"%(len(self.predicates), self.maxBits))
+        if len(self.names) > self.maxBits : raise ValueError("%d selections, max %d"%(len(self.names), self.maxBits))
+    @property
+    def variables(self) : return set().union(*[formulaVariables(p) for p in self.predicates])
+    def predicateBitmask(self, columns={}, nEntries=None) :
+        "uint64 array, bit i set if the entry passes the i-th predicate"
+        nEntries = nEntries if nEntries is not None else len(columns.itervalues().next()) if columns else 0
+        bits = np.zeros(nEntries, dtype=np.uint64)
+        for i, p in enumerate(self.predicates) :
+            bits |= evaluateSelection(p, columns, nEntries).astype(np.uint64) << np.uint64(i)
+        return bits
+    def regionBitmask(self, columns={}, nEntries=None) :
+        "uint64 array, bit j set if the entry passes the j-th selection (same order as names)"
+        predBits = self.predicateBitmask(columns, nEntries)
+        bits = np.zeros(len(predBits), dtype=np.uint64)
+        for j, required in enumerate(self.requiredBits) :
+            if required is None : continue
+            required = np.uint64(required)
+            bits |= ((predBits & required) == required).astype(np.uint64) << np.uint64(j)
+        return bits
+    def regionMasks(self, regionBits) :
+        "unpack the region bitmask into a dict of boolean masks keyed by selection name"
+        return dict((n, ((regionBits >> np.uint64(j)) & np.uint64(1)).astype(bool)) for j, n in enumerate(self.names))
+    def summary(self) :
+        lines = ["%d selections, %d distinct predicates"%(len(self.names), len(self.predicates))]
+        lines += ["  [%2d] %s"%(i, formulaString(p)) for i, p in enumerate(self.predicates)]
+        return '\n'.join(lines)
+#
+# testing
+#
+class KnownFormulas(unittest.TestCase) :
+    def testPrecedence(self) :
+        columns = {'a' : np.array([1.0, 2.0, 3.0]), 'b' : np.array([0.0, 1.0, 0.0])}
+        for formula, expected in [('a>1 && b<1',           [False, False, True ]),
+                                  ('a>2 || b==1',          [False, True,  True ]),
+                                  ('!b && a<3',            [True,  False, False]),
+                                  ('(a<(2.0-0.5) || a>2.5)',[True,  False, True ]),
+                                  ('TMath::Abs(-a)<1.5',   [True,  False, False]),
+                                  ('1',                    [True,  True,  True ]),
+                                  ] :
+            self.assertEqual(list(evaluateSelection(parseFormula(formula), columns)), expected)
+    def testWeight(self) :
+        columns = {'eventweight' : np.array([0.5, 2.0]), 'syst_XSUP' : np.array([2.0, 1.5])}
+        self.assertEqual(list(evaluateFormula(parseFormula('eventweight * syst_XSUP'), columns)), [1.0, 3.0])
+    def testCompiler(self) :
+        columns = {'a' : np.array([1.0, 2.0, 3.0]), 'b' : np.array([0.0, 1.0, 0.0])}
+        formulas = [('sr',  '(a>1 && (b<1 && a<5) && a<5)'),
+                    ('pre', '(a>1 && 1 && a<5)'),
+                    ('bld', '(a>1 && b>=1)'),
+                    ('no',  '(a>1 && 0)')]
+        compiler = SelectionCompiler(formulas)
+        self.assertEqual(len(compiler.predicates), 4) # a>1, b<1, a<5, b>=1
+        masks = compiler.regionMasks(compiler.regionBitmask(columns))
+        for name, formula in formulas :
+            self.assertEqual(list(masks[name]), list(evaluateSelection(parseFormula(formula), columns)))
+    def testVariables(self) :
+        self.assertEqual(formulaVariables(parseFormula('(!isOS || L2qFlipWeight!=1.0) && TMath::Abs(deltaEtaLl)<1.5')),
+                         set(['isOS', 'L2qFlipWeight', 'deltaEtaLl']))
+
+if __name__ == "__main__":
+    unittest.main()
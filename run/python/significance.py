@@ -0,0 +1,169 @@
+#!/bin/env python
+
+# Vectorized version of RooStats::NumberCountingUtils::BinomialExpZ
+#
+# BinomialExpZ(s, b, relErr) is the significance corresponding to the
+# p-value I_x(s+b, 1/relErr^2+1), with x = 1/(1+tau) and
+# tau = 1/(b*relErr^2) (see NumberCountingUtils.cxx). Here the
+# regularized incomplete beta function and the normal quantile are
+# evaluated on whole arrays, so that a scan over many working points
+# does not need one RooStats call per point.
+# scipy.special is used when available; otherwise we fall back on a
+# numpy continued fraction for I_x and on a refined rational
+# approximation for the quantile.
+#
+# davide.gerbaudo@gmail.com
+# April 2014
+
+import math
+import unittest
+import numpy as np
+try:
+    from scipy.special import betainc, ndtri
+except ImportError:
+    betainc, ndtri = None, None
+
+CF_MAX_ITERATIONS = 100000
+CF_EPSILON = 1.0e-15
+CF_TINY = 1.0e-300
+
+lgamma = np.vectorize(math.lgamma, otypes=[np.float64])
+erfc = np.vectorize(math.erfc, otypes=[np.float64])
+
+def betaContinuedFraction(x, a, b) :
+    "continued fraction for I_x(a, b), evaluated with the modified Lentz method (Numerical Recipes betacf)"
+    qab, qap, qam = a+b, a+1.0, a-1.0
+    c = np.ones_like(x)
+    d = 1.0 - qab*x/qap
+    d = np.where(np.abs(d) < CF_TINY, CF_TINY, d)
+    d = 1.0/d
+    h = d.copy()
+    active = np.ones(x.shape, dtype=bool)
+    for m in xrange(1, CF_MAX_ITERATIONS+1) :
+        m2 = 2*m
+        aa = m*(b-m)*x/((qam+m2)*(a+m2))
+        d = 1.0 + aa*d
+        d = np.where(np.abs(d) < CF_TINY, CF_TINY, d)
+        c = 1.0 + aa/c
+        c = np.where(np.abs(c) < CF_TINY, CF_TINY, c)
+        d = 1.0/d
+        h = np.where(active, h*d*c, h)
+        aa = -(a+m)*(qab+m)*x/((a+m2)*(qap+m2))
+        d = 1.0 + aa*d
+        d = np.where(np.abs(d) < CF_TINY, CF_TINY, d)
+        c = 1.0 + aa/c
+        c = np.where(np.abs(c) < CF_TINY, CF_TINY, c)
+        d = 1.0/d
+        delta = d*c
+        h = np.where(active, h*delta, h)
+        active &= np.abs(delta-1.0) > CF_EPSILON
+        if not active.any() : break
+    return h
+
+def betaIncompleteArray(x, a, b) :
+    "regularized incomplete beta function I_x(a, b), as TMath::BetaIncomplete, on arrays"
+    x, a, b = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in [x, a, b]])
+    if betainc : return betainc(a, b, x)
+    result = np.where(x <= 0.0, 0.0, 1.0)
+    inside = (x > 0.0) & (x < 1.0)
+    if not inside.any() : return result
+    x, a, b = x[inside], a[inside], b[inside]
+    front = np.exp(lgamma(a+b) - lgamma(a) - lgamma(b) + a*np.log(x) + b*np.log1p(-x))
+    direct = x < (a+1.0)/(a+b+2.0)
+    values = np.empty(x.shape)
+    if direct.any() :
+        xd, ad, bd = x[direct], a[direct], b[direct]
+        values[direct] = front[direct]*betaContinuedFraction(xd, ad, bd)/ad
+    if (~direct).any() :
+        xs, as_, bs = 1.0-x[~direct], a[~direct], b[~direct]
+        values[~direct] = 1.0 - front[~direct]*betaContinuedFraction(xs, bs, as_)/bs
+    result[inside] = values
+    return result
+
+def normalQuantileArray(p) :
+    "inverse of the standard normal cdf; Acklam's rational approximation followed by one Halley step"
+    p = np.asarray(p, dtype=np.float64)
+    if ndtri : return ndtri(p)
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+         3.754408661907416e+00]
+    pLow = 0.02425
+    with np.errstate(divide='ignore', invalid='ignore') :
+        q = np.sqrt(-2.0*np.log(np.minimum(p, 1.0-p)))
+        tail = ((((c[0]*q+c[1])*q+c[2])*q+c[3])*q+c[4])*q+c[5]
+        tail /= (((d[0]*q+d[1])*q+d[2])*q+d[3])*q+1.0
+        qc = p - 0.5
+        rr = qc*qc
+        central = (((((a[0]*rr+a[1])*rr+a[2])*rr+a[3])*rr+a[4])*rr+a[5])*qc
+        central /= ((((b[0]*rr+b[1])*rr+b[2])*rr+b[3])*rr+b[4])*rr+1.0
+        z = np.where(p < pLow, tail, np.where(p > 1.0-pLow, -tail, central))
+        finite = np.isfinite(z)
+        e = 0.5*erfc(-z[finite]/math.sqrt(2.0)) - p[finite]
+        u = e*math.sqrt(2.0*math.pi)*np.exp(0.5*z[finite]*z[finite])
+        z[finite] = z[finite] - u/(1.0 + 0.5*z[finite]*u)
+    z = np.where(p <= 0.0, -np.inf, np.where(p >= 1.0, np.inf, z))
+    return z
+
+def binomialExpP(sig, bkg, relBkgErr) :
+    "p-value of RooStats::NumberCountingUtils::BinomialExpP, on arrays of (sig, bkg, relative bkg error)"
+    sig, bkg, relBkgErr = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in [sig, bkg, relBkgErr]])
+    with np.errstate(divide='ignore') :
+        tau = 1.0/bkg/(relBkgErr*relBkgErr)
+    auxiliary = 1.0/(relBkgErr*relBkgErr) # bkg*tau, without the nan at bkg==0
+    return betaIncompleteArray(1.0/(1.0+tau), sig+bkg, auxiliary+1.0)
+
+def binomialExpZ(sig, bkg, relBkgErr) :
+    "significance of RooStats::NumberCountingUtils::BinomialExpZ, on arrays of (sig, bkg, relative bkg error)"
+    return -normalQuantileArray(binomialExpP(sig, bkg, relBkgErr))
+
+def znArray(sig, bkg, relBkgErr=0.3, minBkg=0.0, minSig=0.0) :
+    "binomialExpZ where bkg > minBkg and sig > minSig, 0.0 elsewhere"
+    sig, bkg = np.asarray(sig, dtype=np.float64), np.asarray(bkg, dtype=np.float64)
+    values = np.zeros(np.broadcast(sig, bkg).shape)
+    valid = (bkg > minBkg) & (sig > minSig)
+    if valid.any() :
+        sig, bkg = np.broadcast_arrays(sig, bkg)
+        relBkgErr = np.broadcast_to(np.asarray(relBkgErr, dtype=np.float64), values.shape)
+        values[valid] = binomialExpZ(sig[valid], bkg[valid], relBkgErr[valid])
+    return values
+
+#
+# testing
+#
+class ArrayVsRooStats(unittest.TestCase) :
+    "the array implementation should give the same Zn as RooStats"
+    def testZn(self) :
+        from rootUtils import importRoot
+        r = importRoot()
+        zn = r.RooStats.NumberCountingUtils.BinomialExpZ
+        rnd = np.random.RandomState(2014)
+        sig = np.concatenate([rnd.uniform(0.01, 5.0, 200), rnd.uniform(5.0, 200.0, 200)])
+        bkg = np.concatenate([rnd.uniform(0.1, 10.0, 200), rnd.uniform(10.0, 5000.0, 200)])
+        relErr = rnd.uniform(0.05, 0.5, sig.size)
+        values = binomialExpZ(sig, bkg, relErr)
+        for s, b, e, v in zip(sig, bkg, relErr, values) :
+            self.assertAlmostEqual(v, zn(s, b, e), places=7)
+class FallbackVsScipy(unittest.TestCase) :
+    "the numpy fallback should agree with scipy.special where it is available"
+    def testBetaAndQuantile(self) :
+        global betainc, ndtri
+        if not betainc : return
+        rnd = np.random.RandomState(2014)
+        x, a, b = rnd.uniform(0.0, 1.0, 500), rnd.uniform(0.1, 1000.0, 500), rnd.uniform(1.0, 100.0, 500)
+        p = rnd.uniform(1.0e-12, 1.0, 500)
+        expectedBeta, expectedQuantile = betaIncompleteArray(x, a, b), normalQuantileArray(p)
+        scipyBetainc, scipyNdtri = betainc, ndtri
+        betainc, ndtri = None, None
+        try :
+            self.assertTrue(np.allclose(betaIncompleteArray(x, a, b), expectedBeta, rtol=1.0e-9, atol=1.0e-14))
+            self.assertTrue(np.allclose(normalQuantileArray(p), expectedQuantile, rtol=1.0e-9))
+        finally :
+            betainc, ndtri = scipyBetainc, scipyNdtri
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,14 +3,17 @@
 # davide.gerbaudo@gmail.com
 # March 2014
 
-# todo : replace the various range(...) with rootUtils.getBinIndices()
-
 import math
-import numpy as np
+import unittest
+try:
+    import numpy as np
+except ImportError:
+    print "missing numpy: the error bands will not be available"
+    np = None
 from rootUtils import importRoot
 r = importRoot()
 
-from rootUtils import integralAndError
+from rootUtils import integralAndError, binContentsArray, binErrorsArray, innerBins, binEdges
 
 def fakeSystVariations() :
     "syst variations for the fake estimate, see DiLeptonMatrixMethod::systematic_names"
@@ -52,6 +55,19 @@ def getAllVariations() :
 def fetchVariationHistos(input_fake_file=None, nominal_histo=None, variations=fakeSystVariations()) :
     nom_hname = nominal_histo.GetName()
     return dict([(v, input_fake_file.Get(nom_hname.replace('_NONE','_'+v))) for v in variations])
+def innerBinContents(h) :
+    "float64 array of the bin contents, without under/overflows"
+    return innerBins(binContentsArray(h)).astype(np.float64)
+def upDownErr2(nominal_bcs, vars_bcs) :
+    """Bin-by-bin err^2 from an array of nominal bin contents [bin]
+    and an array of varied ones [variation, bin]; the bins can also be
+    the ones of many histograms concatenated (see computeSysErr2Many).
+    The positive deltas go to 'up' and the negative ones to 'down'.
+    """
+    nominal_bcs = np.asarray(nominal_bcs, dtype=np.float64)
+    deltas = np.asarray(vars_bcs, dtype=np.float64).reshape((-1,)+nominal_bcs.shape) - nominal_bcs
+    return {'up'   : np.square(np.maximum(deltas, 0.0)).sum(axis=0),
+            'down' : np.square(np.minimum(deltas, 0.0)).sum(axis=0)}
 def computeSysErr2(nominal_histo=None, vars_histos={}) :
     """Add in quadrature the the bin-by-bin delta^2 for up&down
     systematic variations.  We do not know, and we do not care,
@@ -61,50 +77,41 @@ def computeSysErr2(nominal_histo=None, vars_histos={}) :
     This gives the most conservative error estimate.
     Return the err^2 for up and down.
     """
-    def bc(h) : return [h.GetBinContent(b) for b in range(1, 1+h.GetNbinsX())]
-    nom_bcs  = bc(nominal_histo)
-    vars_bcs = dict([(v, bc(h)) for v, h in vars_histos.iteritems()])
-    bins = range(nominal_histo.GetNbinsX())
-    deltas = [[vars_bcs[v][b] - nom_bcs[b] for v in vars_bcs.keys()] for b in bins]
-    def positive(ll) : return [l if not l<0.0 else 0.0 for l in ll ]
-    def negative(ll) : return [l if     l<0.0 else 0.0 for l in ll ]
-    def sumquad(ll) : return sum([l*l for l in ll])
-    up_e2s = np.array([sumquad(positive(deltas[b])) for b in bins])
-    do_e2s = np.array([sumquad(negative(deltas[b])) for b in bins])
-    return {'up' : up_e2s, 'down' : do_e2s}
+    return upDownErr2(innerBinContents(nominal_histo), [innerBinContents(h) for h in vars_histos.values()])
+def computeSysErr2Many(nominal_bcs={}, vars_bcs={}) :
+    """Same as computeSysErr2 for many histograms at once.
+    nominal_bcs is a dict {key : array of bin contents}, vars_bcs a dict
+    {variation : {key : array of bin contents}}. The bins of all the
+    keys are concatenated into one [variation, bin] array.
+    Return a dict {key : {'up' : err^2, 'down' : err^2}}.
+    """
+    keys = nominal_bcs.keys()
+    if not keys : return dict()
+    offsets = np.cumsum([0]+[len(nominal_bcs[k]) for k in keys])
+    nominal = np.concatenate([nominal_bcs[k] for k in keys])
+    varied = np.array([np.concatenate([vbcs[k] for k in keys]) for vbcs in vars_bcs.values()]).reshape(-1, len(nominal))
+    err2 = upDownErr2(nominal, varied)
+    return dict((k, dict((ud, e2[lo:hi]) for ud, e2 in err2.iteritems()))
+                for k, lo, hi in zip(keys, offsets[:-1], offsets[1:]))
 def computeStatErr2(nominal_histo=None) :
     "Compute the bin-by-bin stat err2"
-    bins = range(1, 1+nominal_histo.GetNbinsX())
-    bes = [nominal_histo.GetBinError(b)   for b in bins]
-    be2s = np.array([e*e for e in bes])
+    be2s = np.square(innerBins(binErrorsArray(nominal_histo)))
     return {'up' : be2s, 'down' : be2s}
 def computeFakeSysStatErr2(nominal_histo=None, vars_histos={}) :
     "Compute the bin-by-bin sum2 err including up&down fake systematic variations + stat. unc."
-    print "refactor, use computeStatErr2 and computeSysErr2"
-    def bc(h) : return [h.GetBinContent(b) for b in range(1, 1+h.GetNbinsX())]
-    def be(h) : return [h.GetBinError(b) for b in range(1, 1+h.GetNbinsX())]
-    nom_bcs  = bc(nominal_histo)
-    nom_be2s = [e*e for e in be(nominal_histo)]
-    vars_bcs = dict([(v, bc(h)) for v, h in vars_histos.iteritems()])
-    bins = range(nominal_histo.GetNbinsX())
-    deltas = [[vars_bcs[v][b] - nom_bcs[b] for v in vars_bcs.keys()] for b in bins]
-    def positive(ll) : return [l if not l<0.0 else 0.0 for l in ll ]
-    def negative(ll) : return [l if     l<0.0 else 0.0 for l in ll ]
-    def sumquad(ll) : return sum([l*l for l in ll])
-    up_e2s = np.array([sumquad(positive(deltas[b])) for b in bins]) + np.array(nom_be2s)
-    do_e2s = np.array([sumquad(negative(deltas[b])) for b in bins]) + np.array(nom_be2s)
-    return {'up' : up_e2s, 'down' : do_e2s}
+    sys_e2s, stat_e2s = computeSysErr2(nominal_histo, vars_histos), computeStatErr2(nominal_histo)
+    return dict((k, sys_e2s[k] + stat_e2s[k]) for k in ['up', 'down'])
 def fetchFakeSysHistosAndComputeSysErr2(input_fake_file=None, nominal_histo=None) :
     vars_histos = fetchVariationHistos(input_fake_file, nominal_histo)
     return computeFakeSysStatErr2(nominal_histo, vars_histos)
 def buildErrBandGraph(histo_tot_bkg, err2s) :
     h = histo_tot_bkg
-    bins = range(1, 1+h.GetNbinsX())
-    x = np.array([h.GetBinCenter (b) for b in bins])
-    y = np.array([h.GetBinContent(b) for b in bins])
-    ex_lo = ex_hi = np.array([0.5*h.GetBinWidth(b) for b in bins])
-    ey_lo, ey_hi = np.sqrt(err2s['down']), np.sqrt(err2s['up'])
-    gr = r.TGraphAsymmErrors(len(bins), x, y, ex_lo, ex_hi, ey_lo, ey_hi)
+    edges = binEdges(h.GetXaxis())
+    x = 0.5*(edges[:-1] + edges[1:])
+    y = innerBinContents(h)
+    ex_lo = ex_hi = 0.5*np.diff(edges)
+    ey_lo, ey_hi = [np.ascontiguousarray(np.sqrt(err2s[k]), dtype=np.float64) for k in ['down', 'up']]
+    gr = r.TGraphAsymmErrors(len(x), x, y, ex_lo, ex_hi, ey_lo, ey_hi)
     gr.SetMarkerSize(0)
     gr.SetFillStyle(3004)
     gr.SetFillColor(r.kGray+3)
@@ -157,46 +164,86 @@ def buildSystematicErrorBand(fake=None, simBkgs=[], variable='', selection='',
                              mcVariations = mcObjectVariations()+mcWeightVariations(),
                              verbose=False) :
     "build the syst error band accounting for fake, mc-object, and mc-weight systematics"
-    if verbose : print "buildSystematicErrorBand(%s, %s)"%(variable, selection)
+    return buildSystematicErrorBands(fake, simBkgs, [variable], [selection], fakeVariations, mcVariations, verbose)[(selection, variable)]
+#___________________________________________________________
+def buildSystematicErrorBands(fake=None, simBkgs=[], variables=[], selections=[],
+                              fakeVariations = fakeSystVariations(),
+                              mcVariations = mcObjectVariations()+mcWeightVariations(),
+                              verbose=False) :
+    """buildSystematicErrorBand for all the (selection, variable)
+    pairs; return a dict {(selection, variable) : error band}"""
+    keys = [(sel, var) for sel in selections for var in variables]
+    if verbose : print "buildSystematicErrorBands(%s, %s)"%(str(variables), str(selections))
     for g in [fake] + simBkgs : g.setSystNominal()
-    nominalFake   = fake.getHistogram(variable, selection)
-    nominalOthers = dict([(g.name, g.getHistogram(variable=variable, selection=selection)) for g in simBkgs])
+    nominalFakes  = dict((k, fake.getHistogram(variable=k[1], selection=k[0])) for k in keys)
+    nominalOthers = dict((k, dict([(g.name, g.getHistogram(variable=k[1], selection=k[0])) for g in simBkgs])) for k in keys)
 
-    fakeSysErrorBand  = buildFakeSystematicErrorBand(fake, nominalOthers, variable, selection, fakeVariations, verbose)
-    mcSysErrorBand    = buildMcSystematicErrorBand  (nominalFake, simBkgs, variable, selection, mcVariations, verbose)
+    fakeSysErrorBands = buildFakeSystematicErrorBands(fake, nominalOthers, variables, selections, fakeVariations, verbose)
+    mcSysErrorBands   = buildMcSystematicErrorBands  (nominalFakes, simBkgs, variables, selections, mcVariations, verbose)
 
-    totErrorBand = None
-    if fakeSysErrorBand and mcSysErrorBand : totErrorBand = addErrorBandsInQuadrature(fakeSysErrorBand, mcSysErrorBand)
-    elif fakeSysErrorBand : totErrorBand = fakeSysErrorBand
-    elif mcSysErrorBand : totErrorBand = mcSysErrorBand
-    return totErrorBand
+    totErrorBands = dict()
+    for k in keys :
+        fakeSysErrorBand, mcSysErrorBand = fakeSysErrorBands[k], mcSysErrorBands[k]
+        totErrorBand = None
+        if fakeSysErrorBand and mcSysErrorBand : totErrorBand = addErrorBandsInQuadrature(fakeSysErrorBand, mcSysErrorBand)
+        elif fakeSysErrorBand : totErrorBand = fakeSysErrorBand
+        elif mcSysErrorBand : totErrorBand = mcSysErrorBand
+        totErrorBands[k] = totErrorBand
+    return totErrorBands
+#___________________________________________________________
+def totBackgroundBinContents(histoFakeBkg=None, histosSimBkgs={}) :
+    "array version of buildTotBackgroundHisto: sum of the bin contents of the available histograms"
+    histos = [h for h in [histoFakeBkg] + histosSimBkgs.values() if h]
+    return np.sum([innerBinContents(h) for h in histos], axis=0) if histos else None
+#___________________________________________________________
+def buildErrBandGraphs(nominalTotBkgs={}, nominalBcs={}, variedBcs={}) :
+    """Build the band graphs for all keys, with the err^2 from
+    computeSysErr2Many on the arrays of the total bkg bin contents"""
+    err2s = computeSysErr2Many(nominalBcs, variedBcs)
+    return dict((k, buildErrBandGraph(h, err2s[k])) for k, h in nominalTotBkgs.iteritems())
 #___________________________________________________________
 def buildFakeSystematicErrorBand(fake=None, nominalHistosSimBkg={},
                                  variable='', selection='', variations=[], verbose=False) :
-    if verbose : print "buildFakeSystematicErrorBand(%s, %s), %s"%(variable, selection, str(variations))
+    key = (selection, variable)
+    return buildFakeSystematicErrorBands(fake, {key : nominalHistosSimBkg}, [variable], [selection], variations, verbose)[key]
+def buildFakeSystematicErrorBands(fake=None, nominalHistosSimBkg={},
+                                  variables=[], selections=[], variations=[], verbose=False) :
+    "nominalHistosSimBkg is a dict {(selection, variable) : {group : histo}}"
+    if verbose : print "buildFakeSystematicErrorBands(%s, %s), %s"%(str(variables), str(selections), str(variations))
+    keys = [(sel, var) for sel in selections for var in variables]
     fake.setSystNominal()
-    nominalTotBkg = buildTotBackgroundHisto(fake.getHistogram(variable, selection), nominalHistosSimBkg)
-    variedTotBkgs = dict()
+    nominalFakes = dict((k, fake.getHistogram(variable=k[1], selection=k[0])) for k in keys)
+    nominalTotBkgs = dict((k, buildTotBackgroundHisto(nominalFakes[k], nominalHistosSimBkg[k])) for k in keys)
+    nominalBcs = dict((k, totBackgroundBinContents(nominalFakes[k], nominalHistosSimBkg[k])) for k in keys)
+    variedBcs = dict()
     for sys in variations :
-        if verbose : print "buildFakeSystematicErrorBand(%s)"%sys
-        variedTotBkgs[sys] = buildTotBackgroundHisto(fake.setSyst(sys).getHistogram(variable=variable, selection=selection),
-                                                     nominalHistosSimBkg)
-    err2 = computeSysErr2(nominal_histo=nominalTotBkg, vars_histos=variedTotBkgs)
-    return buildErrBandGraph(nominalTotBkg, err2)
+        if verbose : print "buildFakeSystematicErrorBands(%s)"%sys
+        fake.setSyst(sys)
+        variedBcs[sys] = dict((k, totBackgroundBinContents(fake.getHistogram(variable=k[1], selection=k[0]),
+                                                           nominalHistosSimBkg[k]))
+                              for k in keys)
+    return buildErrBandGraphs(nominalTotBkgs, nominalBcs, variedBcs)
 #___________________________________________________________
 def buildMcSystematicErrorBand(fakeNominalHisto=None, simulatedBackgrounds=[],
                                variable='', selection='', variations=[], verbose=False) :
-    if verbose : print "buildMcSystematicErrorBand(%s, %s), %s"%(variable, selection, str(variations))
+    key = (selection, variable)
+    return buildMcSystematicErrorBands({key : fakeNominalHisto}, simulatedBackgrounds, [variable], [selection], variations, verbose)[key]
+def buildMcSystematicErrorBands(fakeNominalHistos={}, simulatedBackgrounds=[],
+                                variables=[], selections=[], variations=[], verbose=False) :
+    "fakeNominalHistos is a dict {(selection, variable) : histo}"
+    if verbose : print "buildMcSystematicErrorBands(%s, %s), %s"%(str(variables), str(selections), str(variations))
+    keys = [(sel, var) for sel in selections for var in variables]
+    def simHistos(k) : return dict((g.name, g.getHistogram(variable=k[1], selection=k[0])) for g in simulatedBackgrounds)
     for b in simulatedBackgrounds : b.setSystNominal()
-    nominalTotBkg = buildTotBackgroundHisto(fakeNominalHisto, dict((g.name, g.getHistogram(variable, selection))
-                                                                   for g in simulatedBackgrounds))
-    variedTotBkgs = dict()
+    nominalSims = dict((k, simHistos(k)) for k in keys)
+    nominalTotBkgs = dict((k, buildTotBackgroundHisto(fakeNominalHistos[k], nominalSims[k])) for k in keys)
+    nominalBcs = dict((k, totBackgroundBinContents(fakeNominalHistos[k], nominalSims[k])) for k in keys)
+    variedBcs = dict()
     for sys in variations :
-        if verbose : print "buildMcSystematicErrorBand(%s)"%sys
-        variedMcBkgs = dict((g.name, g.setSyst(sys).getHistogram(variable, selection)) for g in simulatedBackgrounds)
-        variedTotBkgs[sys] = buildTotBackgroundHisto(fakeNominalHisto, variedMcBkgs)
-    fakeErr2 = computeSysErr2(nominal_histo=nominalTotBkg, vars_histos=variedTotBkgs)
-    return buildErrBandGraph(nominalTotBkg, fakeErr2)
+        if verbose : print "buildMcSystematicErrorBands(%s)"%sys
+        for g in simulatedBackgrounds : g.setSyst(sys)
+        variedBcs[sys] = dict((k, totBackgroundBinContents(fakeNominalHistos[k], simHistos(k))) for k in keys)
+    return buildErrBandGraphs(nominalTotBkgs, nominalBcs, variedBcs)
 #___________________________________________________________
 def addErrorBandsInQuadrature(errBand1, errBand2) :
     sqrt = math.sqrt
@@ -221,3 +268,29 @@ def totalUpDownVariation(errBand) :
     down = [abs(errBand.GetErrorYlow (p)) for p in points]
     return sum(up), sum(down)
 #___________________________________________________________
+
+#
+# testing
+#
+class ArraysVsBinLoop(unittest.TestCase) :
+    "the array err^2 should match the bin-by-bin sum in quadrature"
+    def testErr2(self) :
+        def histo(name, contents) :
+            h = r.TH1F(name, '', len(contents), 0.0, 1.0)
+            h.SetDirectory(0)
+            for b, c in enumerate(contents) : h.SetBinContent(b+1, c)
+            return h
+        nominal = histo('nom', [1.0, 2.0, 3.0])
+        variations = {'a' : histo('a', [1.5, 1.0, 3.0]), 'b' : histo('b', [0.5, 2.5, 4.0])}
+        err2 = computeSysErr2(nominal, variations)
+        for b in range(3) :
+            deltas = [h.GetBinContent(b+1) - nominal.GetBinContent(b+1) for h in variations.values()]
+            self.assertAlmostEqual(err2['up'][b],   sum(d*d for d in deltas if d>0.0))
+            self.assertAlmostEqual(err2['down'][b], sum(d*d for d in deltas if d<0.0))
+        many = computeSysErr2Many({'x' : innerBinContents(nominal), 'y' : np.array([1.0])},
+                                  dict((v, {'x' : innerBinContents(h), 'y' : np.array([0.0])}) for v, h in variations.iteritems()))
+        self.assertTrue(np.allclose(many['x']['up'], err2['up']) and np.allclose(many['x']['down'], err2['down']))
+        self.assertEqual(list(many['y']['down']), [2.0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,6 +9,7 @@ import collections
 import difflib
 from functools import wraps
 import glob
+import hashlib
 import json
 import os
 import re
@@ -152,6 +153,22 @@ def sortedAs(d={}, sortedKeys=[]) :
     keys = [k for k in sortedKeys if k in allKeys] + [k for k in allKeys if k not in sortedKeys]
     #return collections.OrderedDict([(k, d[k]) for k in keys]) # OrderedDict not available in 2.6.5 ??
     return [(k, d[k]) for k in keys]
+def entryRanges(nEntries=0, shardSize=None) :
+    "split [0, nEntries) in consecutive [start, stop) ranges of at most shardSize entries"
+    if not shardSize or shardSize >= nEntries : return [(0, nEntries)]
+    return [(start, min(start+shardSize, nEntries)) for start in range(0, nEntries, shardSize)]
+def filesIdentityKey(filenames=[], extra='') :
+    "hash of the (path, size, mtime) of the files, plus any extra string; changes whenever one of the files does"
+    sha = hashlib.sha1(extra)
+    for f in sorted(os.path.abspath(f) for f in filenames) :
+        stat = os.stat(f)
+        sha.update('|'.join([f, str(stat.st_size), str(stat.st_mtime)]))
+    return sha.hexdigest()
+def sourceDigest(filenames=[]) :
+    "hash of the content of some source files (.pyc are replaced by their .py), to version what they compute"
+    sha = hashlib.sha1()
+    for f in filenames : sha.update(open(os.path.splitext(f)[0]+'.py' if f.endswith('.pyc') else f).read())
+    return sha.hexdigest()
 def remove_duplicates(seq=[]) :
     "see http://stackoverflow.com/questions/480214/how-do-you-remove-duplicates-from-a-list-in-python-whilst-preserving-order"
     seen = set()
@@ -171,5 +188,15 @@ class testGuessMdTag(unittest.TestCase) :
             gTag = guessMonthDayTag(s)
             self.assertEqual(tag, gTag)
 
+class testEntryRanges(unittest.TestCase) :
+    def testKnownValues(self) :
+        knownValues = [((10, None), [(0, 10)]),
+                       ((10, 20),   [(0, 10)]),
+                       ((10, 4),    [(0, 4), (4, 8), (8, 10)]),
+                       ((0, 4),     [(0, 0)]),
+                       ]
+        for args, ranges in knownValues :
+            self.assertEqual(entryRanges(*args), ranges)
+
 if __name__ == "__main__":
     unittest.main()
@@ -6,6 +6,7 @@
 # Jan 2014
 
 import glob
+import multiprocessing
 import os
 from rootUtils import importRoot
 r = importRoot()
@@ -16,6 +17,7 @@ from kin import (phi_mpi_pi,
                  getDilepType,
                  computeMt2, computeMt2j, computeMljj,
                  thirdLepZcandidateIsInWindow)
+from derivedVariables import derivedVariables, defaultCacheDir, dilepTypes, mZcandIsInWindow
 
 def buildFnamesDict(samples, dir='', tag='') :
     filenames = dict((s, glob.glob(dir+'/'+s+'_'+tag+'.root')) for s in samples)
@@ -37,58 +39,113 @@ def resetVars(v) :
 
 vars = r.vars()
 
+def outTreeFilename(sample, dilepChan, nJetChan) :
+    return '/tmp/'+sample+'_'+dilepChan+'_'+nJetChan+'.root'
+
+def nJetChanAccepts(nJetChan, nJets) :
+    "note: ge2j also accepts the events with one jet"
+    return not (nJets<1 or (nJets>1 and nJetChan=='eq1j'))
+
 def createOutTree(filenames, dilepChan, nJetChan, tag='', overwrite=False) :
-    assert dilepChan in ['ee','mm','em']
-    assert nJetChan in ['eq1j', 'ge2j']
-    outFilenames = dict()
+    return createOutTrees(filenames, [(dilepChan, nJetChan)], tag, overwrite)[(dilepChan, nJetChan)]
+
+def createOutTrees(filenames, channels, tag='', overwrite=False, nJobs=0, cacheDir=None) :
+    """Read each input file once, and write the training trees for all
+    the (dilepChan, nJetChan) channels; with nJobs>0 the files are
+    processed in parallel. With cacheDir, the variables are read from
+    the cache of derived variables. Return a dict[channel][sample] = filename"""
+    for dilepChan, nJetChan in channels :
+        assert dilepChan in ['ee','mm','em']
+        assert nJetChan in ['eq1j', 'ge2j']
+    outFilenames = dict((c, dict()) for c in channels)
+    tasks = []
     for sample, filename in filenames.iteritems() :
-        outFilename = '/tmp/'+sample+'_'+dilepChan+'_'+nJetChan+'.root'
-        if os.path.exists(outFilename) and not overwrite :
-            outFilenames[sample] = outFilename
-            continue
-        outFile = r.TFile.Open(outFilename, 'recreate')
+        for c in channels :
+            outFilename = outTreeFilename(sample, *c)
+            if os.path.exists(outFilename) and not overwrite : outFilenames[c][sample] = outFilename
+        missingChannels = [c for c in channels if sample not in outFilenames[c]]
+        if missingChannels : tasks.append((sample, filename, missingChannels, cacheDir))
+    if nJobs>0 and len(tasks)>1 :
+        pool = multiprocessing.Pool(processes=min(nJobs, len(tasks)))
+        results = pool.map(fillChannelTrees, tasks)
+        pool.close()
+        pool.join()
+    else :
+        results = [fillChannelTrees(t) for t in tasks]
+    for sample, sampleOutFilenames in results :
+        for c, outFilename in sampleOutFilenames.iteritems() : outFilenames[c][sample] = outFilename
+    return outFilenames
+
+def fillChannelTrees((sample, filename, channels, cacheDir)) :
+    "fill one output tree per channel, with one pass on the input; return (sample, dict[channel]=filename)"
+    outFiles, outTrees = dict(), dict()
+    for c in channels :
+        outFile = r.TFile.Open(outTreeFilename(sample, *c), 'recreate')
         outTree = r.TTree("training","Training tree")
         outTree.Branch('vars', vars, '/F:'.join(leafNames))
         outTree.SetDirectory(outFile)
-        file = r.TFile.Open(filename)
-        tree = file.Get(treename)
-        print "processing %s %s %s (%d entries)"%(sample, dilepChan, nJetChan, tree.GetEntries())
-        for iEvent, event in enumerate(tree) :
-            resetVars(vars)
-            l0 = addTlv(event.l0)
-            l1 = addTlv(event.l1)
-            met = addTlv(event.met)
-            jets = [addTlv(j) for j in event.jets]
-            lepts = [addTlv(l) for l in event.lepts]
-            pars = event.pars
-            dilepType = getDilepType(event.l0, event.l1)
-            nJets = len(jets)
-            if dilepType != dilepChan : continue
-            if nJets<1 or (nJets>1 and nJetChan=='eq1j') : continue
-            if thirdLepZcandidateIsInWindow(l0, l1, lepts, 20.0) : continue
-            mt0, mt1 = computeMt(l0.p4, met.p4), computeMt(l1.p4, met.p4)
-            vars.pt0 = l0.p4.Pt()
-            vars.pt1 = l1.p4.Pt()
-            vars.mll = (l0.p4+l1.p4).M()
-            vars.mtmin = min([mt0, mt1])
-            vars.mtmax = max([mt0, mt1])
-            vars.mtllmet = computeMt(l0.p4 + l1.p4, met.p4)
-            vars.ht = computeHt(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
-            vars.metrel = computeMetRel(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
-            vars.dphill = fabs(phi_mpi_pi(l0.p4.DeltaPhi(l1.p4)))
-            vars.detall = fabs(l0.p4.Eta() - l1.p4.Eta())
-            if nJets >1 :
-                j0, j1 = jets[0], jets[1]
-                vars.mt2j = computeMt2j(l0.p4, l1.p4, j0.p4, j1.p4, met.p4)
-                vars.mljj = computeMljj(l0.p4, l1.p4, j0.p4, j1.p4)
-                vars.dphijj = fabs(phi_mpi_pi(j0.p4.DeltaPhi(j1.p4)))
-                vars.detajj = fabs(j0.p4.Eta() - j1.p4.Eta())
-            outTree.Fill()
-        print "filled ",outTree.GetEntries()," entries"
-        outFile.Write()
-        outFile.Close()
-        outFilenames[sample] = outFile.GetName()
-    return outFilenames
+        outFiles[c], outTrees[c] = outFile, outTree
+    if cacheDir : fillChannelTreesFromCache(outTrees, derivedVariables(filename, treename, cacheDir), sample)
+    else : fillChannelTreesFromTree(outTrees, filename, sample)
+    outFilenames = dict()
+    for c in channels :
+        print "%s %s : filled %d entries"%(sample, ''.join(c), outTrees[c].GetEntries())
+        outFiles[c].Write()
+        outFiles[c].Close()
+        outFilenames[c] = outFiles[c].GetName()
+    return sample, outFilenames
+
+def fillChannelTreesFromCache(outTrees, columns, sample) :
+    "same as fillChannelTreesFromTree, from the cached derived variables"
+    nEvents = len(columns['weight'])
+    print "processing %s %s (%d entries, from cache)"%(sample, ' '.join(ll+nj for ll, nj in outTrees.keys()), nEvents)
+    dilepTypeCodes, nJets = columns['dilepType'], columns['nJets']
+    inZwindow = mZcandIsInWindow(columns['mZcand'], 20.0)
+    for iEvent in xrange(nEvents) :
+        if dilepTypeCodes[iEvent]<0 or inZwindow[iEvent] : continue
+        dilepType = dilepTypes[dilepTypeCodes[iEvent]]
+        eventTrees = [t for (ll, nj), t in outTrees.iteritems() if ll==dilepType and nJetChanAccepts(nj, nJets[iEvent])]
+        if not eventTrees : continue
+        for l in leafNames : setattr(vars, l, columns[l][iEvent])
+        for t in eventTrees : t.Fill()
+
+def fillChannelTreesFromTree(outTrees, filename, sample) :
+    "one pass on the input tree, computing the variables and filling the trees of the channels each event belongs to"
+    file = r.TFile.Open(filename)
+    tree = file.Get(treename)
+    print "processing %s %s (%d entries)"%(sample, ' '.join(ll+nj for ll, nj in outTrees.keys()), tree.GetEntries())
+    for iEvent, event in enumerate(tree) :
+        dilepType = getDilepType(event.l0, event.l1)
+        nJets = len(event.jets)
+        eventTrees = [t for (ll, nj), t in outTrees.iteritems() if ll==dilepType and nJetChanAccepts(nj, nJets)]
+        if not eventTrees : continue
+        resetVars(vars)
+        l0 = addTlv(event.l0)
+        l1 = addTlv(event.l1)
+        met = addTlv(event.met)
+        jets = [addTlv(j) for j in event.jets]
+        lepts = [addTlv(l) for l in event.lepts]
+        pars = event.pars
+        if thirdLepZcandidateIsInWindow(l0, l1, lepts, 20.0) : continue
+        mt0, mt1 = computeMt(l0.p4, met.p4), computeMt(l1.p4, met.p4)
+        vars.pt0 = l0.p4.Pt()
+        vars.pt1 = l1.p4.Pt()
+        vars.mll = (l0.p4+l1.p4).M()
+        vars.mtmin = min([mt0, mt1])
+        vars.mtmax = max([mt0, mt1])
+        vars.mtllmet = computeMt(l0.p4 + l1.p4, met.p4)
+        vars.ht = computeHt(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
+        vars.metrel = computeMetRel(met.p4, [l0.p4, l1.p4]+[j.p4 for j in jets])
+        vars.dphill = fabs(phi_mpi_pi(l0.p4.DeltaPhi(l1.p4)))
+        vars.detall = fabs(l0.p4.Eta() - l1.p4.Eta())
+        if nJets >1 :
+            j0, j1 = jets[0], jets[1]
+            vars.mt2j = computeMt2j(l0.p4, l1.p4, j0.p4, j1.p4, met.p4)
+            vars.mljj = computeMljj(l0.p4, l1.p4, j0.p4, j1.p4)
+            vars.dphijj = fabs(phi_mpi_pi(j0.p4.DeltaPhi(j1.p4)))
+            vars.detajj = fabs(j0.p4.Eta() - j1.p4.Eta())
+        for t in eventTrees : t.Fill()
+    file.Close()
 
 
 def train(sigFiles=[], bkgFiles=[], dilepChan='', nJetChan='') :
@@ -157,18 +214,13 @@ sigSamples = ["Herwigpp_sM_wA_noslep_notauhad_WH_2Lep_%d"%d for d in range(1,1+1
 bkgFilenanes = buildFnamesDict(bkgSamples, basedir+'/merged/', tag)
 sigFilenanes = buildFnamesDict(sigSamples, basedir, tag)
 
-for ll in ['ee','mm','em'] :
-    for nj in ['eq1j', 'ge2j'] :
-        print '-'*3+ll+nj+'-'*3
-        bkgTrainFilenanes = createOutTree(bkgFilenanes, ll, nj, tag=tag)
-        sigTrainFilenames = createOutTree(sigFilenanes, ll, nj, tag=tag)
-
-        bkgFiles = bkgTrainFilenanes.values()
-        sigFiles = [f for f in sigTrainFilenames.values()] # only one signal for now
-        train(sigFiles, bkgFiles, ll, nj)
-
-
-
-
-
-
+channels = [(ll, nj) for ll in ['ee','mm','em'] for nj in ['eq1j', 'ge2j']]
+nJobs = multiprocessing.cpu_count() # 0 : process the input files sequentially
+cacheDir = defaultCacheDir # None : compute the variables event by event from the trees
+bkgTrainFilenanes = createOutTrees(bkgFilenanes, channels, tag=tag, nJobs=nJobs, cacheDir=cacheDir)
+sigTrainFilenames = createOutTrees(sigFilenanes, channels, tag=tag, nJobs=nJobs, cacheDir=cacheDir)
+for ll, nj in channels :
+    print '-'*3+ll+nj+'-'*3
+    bkgFiles = bkgTrainFilenanes[(ll, nj)].values()
+    sigFiles = [f for f in sigTrainFilenames[(ll, nj)].values()] # only one signal for now
+    train(sigFiles, bkgFiles, ll, nj)